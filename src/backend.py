@@ -0,0 +1,618 @@
+# backend.py
+#
+# Copyright 2018 Zander Brown
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+from gi.repository import Gio, GLib, GdkPixbuf
+
+from .capture import Capture, StitchedCapture, scratch_file
+from . import trace
+
+from abc import ABC, abstractmethod
+from pathlib import Path
+
+import os
+import warnings
+
+
+# D-Bus errors meaning the shell won't take screenshots for us at all
+UNAVAILABLE = (
+    'org.freedesktop.DBus.Error.AccessDenied',
+    'org.freedesktop.DBus.Error.ServiceUnknown',
+    'org.freedesktop.DBus.Error.UnknownMethod',
+)
+
+
+# Timers wake this early, the rest of the wait is spun out
+SPIN = 2000
+
+
+def call_at(deadline, callback):
+    '''
+        Call callback on the main loop at deadline (in monotonic
+        microseconds), to well within a millisecond rather than whenever
+        a timeout that long happens to fire
+    '''
+    def wait():
+        remaining = deadline - GLib.get_monotonic_time()
+        if remaining > SPIN:
+            GLib.timeout_add((remaining - SPIN) // 1000, wait,
+                             priority=GLib.PRIORITY_HIGH)
+            return GLib.SOURCE_REMOVE
+        while GLib.get_monotonic_time() < deadline:
+            pass
+        callback()
+        return GLib.SOURCE_REMOVE
+
+    wait()
+
+
+class CaptureError(Exception):
+    '''Raised (or passed to the callback) when a capture doesn't happen'''
+    pass
+
+
+class CaptureBackend(ABC):
+    '''
+        Something that can grab the screen
+
+        Subclasses implement _capture and call done with a Capture once
+        they have one (or with an error if the attempt failed), the
+        callback passed to capture then gets the Capture (or None), the
+        error (or None) and the time taken in seconds
+
+        Delays are waited out here, not by the backend, with prepare
+        called first so the grab itself starts as soon as it's time.
+        lateness is how far past the deadline the last delayed grab
+        started, in seconds.
+
+        Backends that can capture an area set separate_monitors and
+        implement _capture_area, the rest have monitors cut out of one
+        capture of the whole screen.
+    '''
+
+    name = None
+    lateness = 0
+    separate_monitors = False
+
+    def capture(self, mode, callback, pointer=False, shadow=False, delay=0,
+                monitors=None, scheduled=None):
+        '''
+            monitors, for Screen, is a list of (x, y, width, height)
+            rectangles (Gdk.Monitor geometries) to capture separately,
+            all at once, into a StitchedCapture
+
+            scheduled, if given, is called with the deadline (monotonic
+            microseconds) when a delay starts, which may be a while
+            after asking if the capture had to wait in a CaptureQueue
+
+            Windows are always grabbed bare, shadow has one composited
+            under them here (see shadow.add_shadow)
+        '''
+        start = GLib.get_monotonic_time()
+        deadline = start + int(delay * GLib.USEC_PER_SEC)
+        # Selections wait for the user, not the clock
+        waited = delay > 0 and mode != 'Selection'
+
+        def done(capture=None, error=None):
+            elapsed = (GLib.get_monotonic_time() - start) / GLib.USEC_PER_SEC
+            if capture is None:
+                callback(capture, error, elapsed)
+                return
+            capture.mode = mode
+            if shadow and mode == 'Window':
+                from .shadow import add_shadow_async, default_scale
+
+                def shadowed(result, error):
+                    capture.discard()
+                    if error is not None:
+                        error = CaptureError(str(error))
+                    callback(result, error, elapsed)
+
+                add_shadow_async(capture, default_scale(), shadowed)
+            else:
+                callback(capture, error, elapsed)
+
+        def grab():
+            if waited:
+                late = GLib.get_monotonic_time() - deadline
+                self.lateness = late / GLib.USEC_PER_SEC
+                waiting.end(late_us=late)
+            try:
+                if monitors and mode == 'Screen':
+                    self._capture_monitors(monitors, done, pointer)
+                else:
+                    self._capture(mode, done, pointer)
+            except CaptureError as err:
+                done(error=err)
+
+        if waited:
+            try:
+                # Fail now, rather than after the delay
+                self.prepare(mode)
+            except CaptureError as err:
+                done(error=err)
+                return
+            waiting = trace.begin('delay', seconds=delay)
+            if scheduled is not None:
+                scheduled(deadline)
+            call_at(deadline, grab)
+        else:
+            grab()
+
+    def prepare(self, mode):
+        '''Get ready to capture mode without a moment's notice'''
+        pass
+
+    @abstractmethod
+    def _capture(self, mode, done, pointer):
+        pass
+
+    def _capture_area(self, area, done, pointer):
+        '''Capture just area, (x, y, width, height), like _capture'''
+        raise CaptureError(_('This backend can only capture whole screens'))
+
+    def _capture_monitors(self, monitors, done, pointer):
+        if not self.separate_monitors:
+            self._split_screen(monitors, done, pointer)
+            return
+        parts = [None] * len(monitors)
+        errors = []
+        remaining = [len(monitors)]
+        left = min(x for (x, y, w, h) in monitors)
+        top = min(y for (x, y, w, h) in monitors)
+
+        def part_done(index, capture=None, error=None):
+            parts[index] = capture
+            if error is not None:
+                errors.append(error)
+            remaining[0] -= 1
+            if remaining[0] > 0:
+                return
+            if errors:
+                for part in parts:
+                    if part is not None:
+                        part.discard()
+                done(error=errors[0])
+                return
+            placed = []
+            for ((x, y, width, height), part) in zip(monitors, parts):
+                # Pixels per logical pixel, for HiDPI monitors
+                ratio = part.get_size()[0] / width
+                placed.append((round((x - left) * ratio),
+                               round((y - top) * ratio), part))
+            done(StitchedCapture(placed))
+
+        # Every request goes out before any comes back
+        for (index, area) in enumerate(monitors):
+            try:
+                self._capture_area(area, lambda c=None, e=None, i=index:
+                                   part_done(i, c, e), pointer)
+            except CaptureError as err:
+                part_done(index, error=err)
+
+    def _split_screen(self, monitors, done, pointer):
+        '''_capture_monitors from a single capture of the whole screen'''
+        left = min(x for (x, y, w, h) in monitors)
+        top = min(y for (x, y, w, h) in monitors)
+        right = max(x + w for (x, y, w, h) in monitors)
+
+        def grabbed(capture=None, error=None):
+            if error is not None:
+                done(error=error)
+                return
+            try:
+                full = capture.pixbuf
+            except GLib.Error as err:
+                done(error=CaptureError(err.message))
+                return
+            finally:
+                capture.discard()
+            # Pixels per logical pixel, for HiDPI screens
+            ratio = full.props.width / (right - left)
+            placed = []
+            for (x, y, width, height) in monitors:
+                px = round((x - left) * ratio)
+                py = round((y - top) * ratio)
+                (pw, ph) = (min(full.props.width - px, round(width * ratio)),
+                            min(full.props.height - py,
+                                round(height * ratio)))
+                # Sharing the full frame's pixels, nothing is copied
+                part = Capture(pixbuf=full.new_subpixbuf(px, py, pw, ph))
+                placed.append((px, py, part))
+            done(StitchedCapture(placed))
+
+        self._capture('Screen', grabbed, pointer)
+
+    @staticmethod
+    def _collect(filename, done):
+        '''Pick up a capture a helper wrote to filename'''
+        try:
+            with trace.span('collect'):
+                capture = Capture.from_file(filename)
+            done(capture)
+        except GLib.Error as err:
+            done(error=CaptureError(err.message))
+
+
+class SpawnBackend(CaptureBackend):
+    '''Runs a new gnome-screenshot for every capture'''
+
+    name = 'spawn'
+
+    def __init__(self):
+        self._command = None
+
+    def prepare(self, mode):
+        # The helper itself can only be started when it's time, but
+        # finding it needn't wait
+        if self._command is None:
+            if Path('/.flatpak-info').exists():
+                prog = GLib.find_program_in_path('flatpak-spawn')
+                command = [prog, '--host', 'gnome-screenshot']
+            else:
+                prog = GLib.find_program_in_path('gnome-screenshot')
+                command = [prog]
+            if prog is None:
+                raise CaptureError(_('Failed to launch gnome-screenshot'))
+            self._command = command
+
+    def _capture(self, mode, done, pointer):
+        self.prepare(mode)
+        args = list(self._command)
+        if mode == 'Window':
+            args.append('-w')
+        elif mode == 'Selection':
+            args.append('-a')
+        if not mode == 'Selection' and pointer:
+            args.append('-p')
+        filename = scratch_file()
+        args.extend(['-f', filename])
+
+        def watch(pid, status):
+            helper.end(status=status)
+            GLib.spawn_close_pid(pid)
+            if status != 0:
+                GLib.unlink(filename)
+                msg = _('gnome-screenshot returned a non-zero status')
+                done(error=CaptureError(msg))
+            else:
+                self._collect(filename, done)
+
+        try:
+            flags = GLib.SpawnFlags.DO_NOT_REAP_CHILD
+            with trace.span('spawn', command=' '.join(args)):
+                (pid, sin, sout, serr) = GLib.spawn_async(args, flags=flags)
+        except GLib.Error:
+            GLib.unlink(filename)
+            raise CaptureError(_('Failed to launch gnome-screenshot'))
+        # Helper startup and the capture itself, we can't see between
+        helper = trace.begin('helper')
+        GLib.child_watch_add(GLib.PRIORITY_DEFAULT, pid, watch)
+
+
+class ShellBackend(CaptureBackend):
+    '''
+        Asks gnome-shell to take the screenshot over D-Bus, so there's
+        no process to start and the compositor already has the pixels
+    '''
+
+    name = 'shell'
+    separate_monitors = True
+
+    def __init__(self):
+        self._proxy = None
+
+    def _get_proxy(self):
+        if self._proxy is None:
+            flags = Gio.DBusProxyFlags.DO_NOT_LOAD_PROPERTIES | \
+                Gio.DBusProxyFlags.DO_NOT_CONNECT_SIGNALS
+            try:
+                self._proxy = Gio.DBusProxy.new_for_bus_sync(
+                    Gio.BusType.SESSION, flags, None,
+                    'org.gnome.Shell.Screenshot',
+                    '/org/gnome/Shell/Screenshot',
+                    'org.gnome.Shell.Screenshot',
+                    None)
+            except GLib.Error as err:
+                error = CaptureError(err.message)
+                error.denied = True
+                raise error
+        return self._proxy
+
+    def _call(self, method, params, callback):
+        call = trace.begin('shell-call', method=method)
+
+        def finish(proxy, res):
+            call.end()
+            try:
+                callback(proxy.call_finish(res).unpack())
+            except GLib.Error as err:
+                error = CaptureError(err.message)
+                name = Gio.DBusError.get_remote_error(err)
+                error.denied = name in UNAVAILABLE
+                callback(error)
+
+        self._get_proxy().call(method, params, Gio.DBusCallFlags.NONE,
+                               -1, None, finish)
+
+    def select_area(self, callback):
+        '''
+            Have the user drag out an area, callback gets (x, y, width,
+            height) or a CaptureError
+        '''
+        self._call('SelectArea', None, callback)
+
+    def _capture_area(self, area, done, pointer):
+        self._get_proxy()
+        filename = scratch_file()
+
+        def shot(result):
+            if isinstance(result, CaptureError):
+                GLib.unlink(filename)
+                done(error=result)
+            elif not result[0]:
+                GLib.unlink(filename)
+                msg = _('gnome-shell failed to take the screenshot')
+                done(error=CaptureError(msg))
+            else:
+                self._collect(filename, done)
+
+        params = GLib.Variant('(iiiibs)', tuple(area) + (False, filename))
+        self._call('ScreenshotArea', params, shot)
+
+    def prepare(self, mode):
+        # Connecting to the shell is the slow part of the first capture
+        self._get_proxy()
+
+    def _capture(self, mode, done, pointer):
+        self._get_proxy()
+        filename = scratch_file()
+
+        def shot(result):
+            if isinstance(result, CaptureError):
+                GLib.unlink(filename)
+                done(error=result)
+            elif not result[0]:
+                GLib.unlink(filename)
+                msg = _('gnome-shell failed to take the screenshot')
+                done(error=CaptureError(msg))
+            else:
+                self._collect(filename, done)
+
+        def area(result):
+            if isinstance(result, CaptureError):
+                GLib.unlink(filename)
+                done(error=result)
+                return
+            (x, y, width, height) = result
+            params = GLib.Variant('(iiiibs)',
+                                  (x, y, width, height, False, filename))
+            self._call('ScreenshotArea', params, shot)
+
+        if mode == 'Selection':
+            self.select_area(area)
+        elif mode == 'Window':
+            # With its frame, like gnome-screenshot
+            params = GLib.Variant('(bbbs)', (True, pointer, False, filename))
+            self._call('ScreenshotWindow', params, shot)
+        else:
+            params = GLib.Variant('(bbs)', (pointer, False, filename))
+            self._call('Screenshot', params, shot)
+
+
+class AutoBackend(CaptureBackend):
+    '''Prefers gnome-shell, falling back to gnome-screenshot'''
+
+    name = 'auto'
+
+    def __init__(self):
+        self._shell = ShellBackend()
+        self._spawn = SpawnBackend()
+        self._use_shell = True
+
+    @property
+    def separate_monitors(self):
+        # gnome-screenshot can only do the whole screen
+        return self._use_shell
+
+    def _capture_area(self, area, done, pointer):
+        self._shell._capture_area(area, done, pointer)
+
+    def _capture_monitors(self, monitors, done, pointer):
+        if not self._use_shell:
+            self._split_screen(monitors, done, pointer)
+            return
+
+        def fallback(capture=None, error=None):
+            if error is None or not getattr(error, 'denied', False):
+                done(capture, error)
+                return
+            warnings.warn('Shell capture unavailable ({}), using '
+                          'gnome-screenshot'.format(error))
+            self._use_shell = False
+            try:
+                self._split_screen(monitors, done, pointer)
+            except CaptureError as err:
+                done(error=err)
+
+        super()._capture_monitors(monitors, fallback, pointer)
+
+    def prepare(self, mode):
+        if self._use_shell:
+            try:
+                self._shell.prepare(mode)
+                return
+            except CaptureError as err:
+                if not getattr(err, 'denied', False):
+                    raise
+        self._spawn.prepare(mode)
+
+    def _capture(self, mode, done, pointer):
+        if not self._use_shell:
+            self._spawn._capture(mode, done, pointer)
+            return
+
+        def fallback(capture=None, error=None):
+            if error is None or not getattr(error, 'denied', False):
+                done(capture, error)
+                return
+            # Newer shells only let their own tools use the interface
+            warnings.warn('Shell capture unavailable ({}), using '
+                          'gnome-screenshot'.format(error))
+            self._use_shell = False
+            try:
+                self._spawn._capture(mode, done, pointer)
+            except CaptureError as err:
+                done(error=err)
+
+        try:
+            self._shell._capture(mode, fallback, pointer)
+        except CaptureError as err:
+            fallback(error=err)
+
+
+class RootWindowBackend(CaptureBackend):
+    '''
+        Copies the root window in process, X11 only and only whole
+        screens, but cheap enough to call several times a second (see
+        ring.FrameRing)
+    '''
+
+    name = 'root'
+    separate_monitors = True
+
+    @staticmethod
+    def available():
+        import gi
+        try:
+            gi.require_version('GdkX11', '3.0')
+            from gi.repository import Gdk, GdkX11
+        except (ImportError, ValueError):
+            return False
+        return isinstance(Gdk.Display.get_default(), GdkX11.X11Display)
+
+    def prepare(self, mode):
+        from gi.repository import Gdk
+
+        # Looked up once, not on the moment
+        Gdk.get_default_root_window()
+
+    def _capture(self, mode, done, pointer):
+        from gi.repository import Gdk
+
+        if mode != 'Screen' or not self.available():
+            error = CaptureError(_('Only whole screens on X11'))
+            error.denied = True
+            raise error
+        root = Gdk.get_default_root_window()
+        done(Capture(pixbuf=self.grab(0, 0, root.get_width(),
+                                      root.get_height())))
+
+    def _capture_area(self, area, done, pointer):
+        if not self.available():
+            raise CaptureError(_('Only whole screens on X11'))
+        done(Capture(pixbuf=self.grab(*area)))
+
+    def grab(self, x, y, width, height):
+        '''That area of the screen as a pixbuf, straight away'''
+        from gi.repository import Gdk
+
+        with trace.span('root-grab'):
+            pixbuf = Gdk.pixbuf_get_from_window(
+                Gdk.get_default_root_window(), x, y, width, height)
+        if pixbuf is None:
+            raise CaptureError(_('Failed to copy the screen'))
+        return pixbuf
+
+
+class FakeBackend(CaptureBackend):
+    '''
+        Produces a synthetic image without touching the display, for
+        measuring the rest of the pipeline on headless machines
+
+        The size can be set with KASBAH_FAKE_SIZE (eg 3840x2160), content
+        is either 'ui', flat colours that compress well, or 'noise',
+        which doesn't compress at all (the worst case for photos)
+    '''
+
+    name = 'fake'
+    separate_monitors = True
+
+    def __init__(self, width=None, height=None, content='ui'):
+        if width is None or height is None:
+            size = GLib.getenv('KASBAH_FAKE_SIZE') or '1920x1080'
+            (width, height) = (int(v) for v in size.split('x'))
+        self.width = width
+        self.height = height
+        self.content = content
+
+    def render(self):
+        if self.content == 'noise':
+            stride = self.width * 3
+            data = GLib.Bytes.new(os.urandom(stride * self.height))
+            return GdkPixbuf.Pixbuf.new_from_bytes(data,
+                                                   GdkPixbuf.Colorspace.RGB,
+                                                   False, 8, self.width,
+                                                   self.height, stride)
+        # Something that looks vaguely like a desktop
+        pixbuf = GdkPixbuf.Pixbuf.new(GdkPixbuf.Colorspace.RGB, False, 8,
+                                      self.width, self.height)
+        pixbuf.fill(0x3465a4ff)
+        bar = min(32, self.height)
+        pixbuf.new_subpixbuf(0, 0, self.width, bar).fill(0x000000ff)
+        win_w = self.width // 2
+        win_h = self.height // 2
+        win = pixbuf.new_subpixbuf(self.width // 4, self.height // 4,
+                                   win_w, win_h)
+        win.fill(0xf6f5f4ff)
+        if win_w > 16:
+            for y in range(bar, win_h - 12, 24):
+                line_w = (win_w - 16) * (1 + (y * 7) % 5) // 6
+                win.new_subpixbuf(8, y, line_w, 12).fill(0x2e3436ff)
+        return pixbuf
+
+    def _capture(self, mode, done, pointer):
+        # Grabbed now, handed over from the main loop like a real one
+        capture = Capture(pixbuf=self.render())
+
+        def finish():
+            done(capture)
+            return GLib.SOURCE_REMOVE
+
+        GLib.idle_add(finish)
+
+    def _capture_area(self, area, done, pointer):
+        (x, y, width, height) = area
+        part = FakeBackend(width, height, self.content)
+
+        def grab():
+            done(Capture(pixbuf=part.render()))
+            return GLib.SOURCE_REMOVE
+
+        GLib.idle_add(grab)
+
+
+BACKENDS = {
+    'auto': AutoBackend,
+    'shell': ShellBackend,
+    'spawn': SpawnBackend,
+    'fake': FakeBackend,
+}
+
+
+def new_backend(name):
+    '''Create the backend called name (see the backend setting)'''
+    return BACKENDS.get(name, AutoBackend)()
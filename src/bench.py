@@ -0,0 +1,838 @@
+# bench.py
+#
+# Copyright 2018 Zander Brown
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+# Run from the install (or source) directory with:
+#
+#     python3 -m kasbah.bench capture --backend fake
+#
+# The pipeline benchmark needs a display, on a headless box use:
+#
+#     xvfb-run -a python3 -m kasbah.bench pipeline --json results.json
+
+import argparse
+import gettext
+import json
+import os
+import resource
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+gettext.install('kasbah')
+
+import gi
+
+gi.require_version('Gtk', '3.0')
+
+from gi.repository import GLib, GdkPixbuf
+
+BENCHMARKS = {}
+
+
+def benchmark(f):
+    '''Makes f available as a subcommand'''
+    BENCHMARKS[f.__name__.replace('_', '-')] = f
+    return f
+
+
+def report(name, samples, unit='s'):
+    '''Print a one line summary of samples'''
+    samples = sorted(samples)
+    print('{:<32} n={:<4} min={:.4f}{u} median={:.4f}{u} max={:.4f}{u}'
+          .format(name, len(samples), samples[0],
+                  statistics.median(samples), samples[-1], u=unit))
+
+
+@benchmark
+def capture(args):
+    '''Time from asking a backend for a screenshot to having it in memory'''
+    from .backend import new_backend
+
+    backend = new_backend(args.backend)
+    loop = GLib.MainLoop()
+    samples = []
+
+    def done(capture, error, elapsed):
+        if error is not None:
+            print(error, file=sys.stderr)
+            loop.quit()
+            return
+        samples.append(elapsed)
+        if len(samples) < args.runs:
+            GLib.idle_add(shoot)
+        else:
+            loop.quit()
+
+    def shoot():
+        backend.capture(args.mode, done)
+        return GLib.SOURCE_REMOVE
+
+    GLib.idle_add(shoot)
+    loop.run()
+    if samples:
+        report(backend.name, samples)
+
+
+SIZES = {
+    '1080p': (1920, 1080),
+    '1440p': (2560, 1440),
+    '4k': (3840, 2160),
+    '8k': (7680, 4320),
+    # Three 4K monitors side by side
+    'triple-4k': (11520, 2160),
+}
+
+# Pretends to be gnome-screenshot, writing a synthetic PNG to -f. Kept
+# to the standard library so it starts about as fast as the real thing.
+STANDIN = '''#!{python}
+import os, struct, sys, zlib
+
+width, height = (int(v) for v in os.environ['KASBAH_STANDIN_SIZE'].split('x'))
+content = os.environ.get('KASBAH_STANDIN_CONTENT', 'ui')
+out = sys.argv[sys.argv.index('-f') + 1]
+
+def chunk(kind, data):
+    crc = zlib.crc32(data, zlib.crc32(kind))
+    return struct.pack('>I', len(data)) + kind + data + struct.pack('>I', crc)
+
+if content == 'noise':
+    raw = b''.join(b'\\0' + os.urandom(width * 3) for y in range(height))
+else:
+    # Flat UI: a panel, a window and some lines of text
+    desk = b'\\0' + b'\\x34\\x65\\xa4' * width
+    bar = b'\\0' + b'\\0\\0\\0' * width
+    left = b'\\x34\\x65\\xa4' * (width // 4)
+    right = b'\\x34\\x65\\xa4' * (width - width // 4 - width // 2)
+    page = b'\\0' + left + b'\\xf6\\xf5\\xf4' * (width // 2) + right
+    text = b'\\0' + left + b'\\x2e\\x34\\x36' * (width // 3) + \\
+        b'\\xf6\\xf5\\xf4' * (width // 2 - width // 3) + right
+    rows = []
+    for y in range(height):
+        if y < 32:
+            rows.append(bar)
+        elif height // 4 <= y < height * 3 // 4:
+            rows.append(text if y % 24 < 12 else page)
+        else:
+            rows.append(desk)
+    raw = b''.join(rows)
+
+with open(out, 'wb') as f:
+    f.write(b'\\x89PNG\\r\\n\\x1a\\n')
+    f.write(chunk(b'IHDR', struct.pack('>IIBBBBB', width, height, 8, 2, 0, 0, 0)))
+    f.write(chunk(b'IDAT', zlib.compress(raw, 6)))
+    f.write(chunk(b'IEND', b''))
+'''
+
+
+@benchmark
+def encode(args):
+    '''Encode time and size for each format at 1080p, 4K and 8K'''
+    from .backend import FakeBackend
+    from .encoder import available_formats, encode
+
+    variants = []
+    for fmt in available_formats():
+        if fmt.name == 'png':
+            variants.extend(('png', {'level': l}) for l in (1, 3, 6, 9))
+        else:
+            variants.append((fmt.name, {}))
+
+    for size in ('1080p', '4k', '8k'):
+        for content in ('ui', 'noise'):
+            pixbuf = FakeBackend(*SIZES[size], content=content).render()
+            for (name, options) in variants:
+                samples = []
+                for i in range(args.runs):
+                    start = time.perf_counter()
+                    out = encode(pixbuf, name, **options)
+                    samples.append(time.perf_counter() - start)
+                label = ' '.join([size, content, name] +
+                                 ['{}={}'.format(k, v)
+                                  for (k, v) in options.items()])
+                report(label, samples)
+                print('{:<32} {} bytes'.format('', len(out)))
+
+
+@benchmark
+def service(args):
+    '''
+        kasbah-capture against a service that has to be D-Bus activated
+        (the first run) and one that is already resident (the rest)
+
+        Needs an installed Kasbah, run on a session bus with no Kasbah
+        running for the cold number to mean anything
+    '''
+    import subprocess
+    import tempfile
+
+    with tempfile.TemporaryDirectory() as folder:
+        samples = []
+        for i in range(args.runs + 1):
+            path = '{}/{}.png'.format(folder, i)
+            start = time.perf_counter()
+            subprocess.run(['kasbah-capture', args.mode.lower(), path],
+                           check=True)
+            samples.append(time.perf_counter() - start)
+    report('cold', samples[:1])
+    report('warm', samples[1:])
+
+
+def percentiles(samples):
+    '''p50, p90 and p99 of samples'''
+    if len(samples) < 2:
+        return (samples[0],) * 3
+    cuts = statistics.quantiles(samples, n=100, method='inclusive')
+    return (cuts[49], cuts[89], cuts[98])
+
+
+def peak_rss():
+    '''Peak resident set of us and our children (the helpers) in KiB'''
+    return max(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+               resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss)
+
+
+def _load_app():
+    '''Register the gresource so the UI can be built, then import it'''
+    from gi.repository import Gio, Gdk
+
+    if Gdk.Display.get_default() is None:
+        sys.exit('No display, try running under xvfb-run -a')
+    here = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    res = Gio.Resource.load(os.path.join(here, 'kasbah.gresource'))
+    res._register()
+
+    from . import main
+    return main
+
+
+@benchmark
+def pipeline(args):
+    '''
+        The whole flow, from the screenshot action in KasbahWindow to
+        the capture being saved, with a stand-in gnome-screenshot
+
+        For each size and content type reports percentiles for the
+        capture, dialog map, thumbnail, clipboard and save stages, the
+        bytes each produced and the peak RSS after it. With --json the
+        results are written out, with the commit, to compare runs.
+    '''
+    os.environ['GSETTINGS_BACKEND'] = 'memory'
+    main = _load_app()
+    from gi.repository import Gtk, Gdk, Gio
+    from .save import KasbahSave
+    from .window import KasbahWindow
+
+    folder = tempfile.mkdtemp(prefix='kasbah-bench-')
+    standin = os.path.join(folder, 'gnome-screenshot')
+    with open(standin, 'w') as script:
+        script.write(STANDIN.format(python=sys.executable))
+    os.chmod(standin, 0o755)
+    os.environ['PATH'] = folder + os.pathsep + os.environ['PATH']
+
+    app = main.Application()
+    app.set_flags(app.get_flags() | Gio.ApplicationFlags.NON_UNIQUE)
+    app.settings.set_string('backend', 'spawn')
+    # Keep one capture in flight so the stages don't overlap
+    app.settings.set_int('max-concurrent-captures', 1)
+    app.register(None)
+
+    window = KasbahWindow(application=app)
+    window.props.mode = 'Screen'
+    window.delay.props.value = 0
+    clipboard = Gtk.Clipboard.get(Gdk.SELECTION_CLIPBOARD)
+    png = Gdk.Atom.intern('image/png', False)
+
+    results = []
+    loop = GLib.MainLoop()
+    cases = [(size, content) for size in args.sizes.split(',')
+             for content in ('ui', 'noise')]
+
+    def run_case(size, content):
+        os.environ['KASBAH_STANDIN_SIZE'] = '{}x{}'.format(*SIZES[size])
+        os.environ['KASBAH_STANDIN_CONTENT'] = content
+        stages = {name: {'samples': [], 'bytes': 0, 'peak_rss_kib': 0}
+                  for name in ('capture', 'dialog', 'thumbnail',
+                               'clipboard', 'save')}
+
+        def record(stage, start, written=0):
+            stages[stage]['samples'].append(time.perf_counter() - start)
+            stages[stage]['bytes'] = written
+            stages[stage]['peak_rss_kib'] = peak_rss()
+
+        def shoot(run):
+            start = time.perf_counter()
+
+            def watch(capture, error, elapsed):
+                if error is not None:
+                    print(error, file=sys.stderr)
+                    loop.quit()
+                    return
+                record('capture', start, len(capture.data.get_data()))
+                shown = time.perf_counter()
+                save = KasbahSave(capture, transient_for=window,
+                                  application=app)
+                save.connect('map-event',
+                             lambda w, e: record('dialog', shown))
+                save.preview.connect('notify::pixbuf',
+                                     lambda i, p: thumbnailed(save, shown))
+                save.show()
+
+            def thumbnailed(save, shown):
+                record('thumbnail', shown)
+                copied = time.perf_counter()
+                save.on_clipboard(None, None)
+                data = clipboard.wait_for_contents(png)
+                record('clipboard', copied, len(data.get_data()))
+
+                saving = time.perf_counter()
+                path = os.path.join(folder, '{}-{}-{}.png'
+                                    .format(size, content, run))
+
+                def saved(error):
+                    record('save', saving, os.path.getsize(path))
+                    os.unlink(path)
+                    save.destroy()
+                    if run + 1 < args.runs:
+                        shoot(run + 1)
+                    else:
+                        finish_case(size, content, stages)
+
+                save.capture.save_async(path, 'png', {}, Gio.Cancellable(),
+                                        lambda w, t: False, saved)
+
+            window.watch = watch
+            window.on_screenshot(None, None)
+
+        shoot(0)
+
+    def finish_case(size, content, stages):
+        for (stage, result) in stages.items():
+            (p50, p90, p99) = percentiles(result['samples'])
+            print('{:<10} {:<6} {:<10} p50={:.4f}s p90={:.4f}s p99={:.4f}s '
+                  '{} bytes, peak {} KiB'
+                  .format(size, content, stage, p50, p90, p99,
+                          result['bytes'], result['peak_rss_kib']))
+            results.append({
+                'size': size,
+                'content': content,
+                'stage': stage,
+                'runs': len(result['samples']),
+                'p50': p50,
+                'p90': p90,
+                'p99': p99,
+                'mean': statistics.mean(result['samples']),
+                'bytes': result['bytes'],
+                'peak_rss_kib': result['peak_rss_kib'],
+            })
+        if cases:
+            run_case(*cases.pop(0))
+        else:
+            loop.quit()
+
+    run_case(*cases.pop(0))
+    loop.run()
+
+    if args.json:
+        try:
+            commit = subprocess.run(['git', 'rev-parse', 'HEAD'],
+                                    capture_output=True, text=True,
+                                    cwd=os.path.dirname(__file__)).stdout
+        except OSError:
+            commit = ''
+        with open(args.json, 'w') as out:
+            json.dump({
+                'benchmark': 'pipeline',
+                'commit': commit.strip() or None,
+                'time': time.time(),
+                'host': os.uname().nodename,
+                'python': sys.version.split()[0],
+                'results': results,
+            }, out, indent=2)
+    shutil.rmtree(folder)
+
+
+@benchmark
+def startup(args):
+    '''
+        Time from exec to the first frame of the main window, exits
+        non-zero if the median is over --budget milliseconds so it can
+        catch regressions in CI (it needs a display, see pipeline)
+    '''
+    samples = []
+    for i in range(args.runs):
+        # The probe writes to this pipe, stdout is left to the app
+        (reading, writing) = os.pipe()
+        env = dict(os.environ, KASBAH_STARTUP_PROBE=str(writing),
+                   GSETTINGS_BACKEND='memory')
+        start = time.perf_counter()
+        probe = subprocess.Popen([args.command], env=env,
+                                 pass_fds=(writing,))
+        os.close(writing)
+        with os.fdopen(reading, 'rb') as pipe:
+            # Up to the first frame, not the teardown after it
+            if pipe.readline().strip() != b'drawn':
+                sys.exit('{} exited without drawing'.format(args.command))
+        samples.append(time.perf_counter() - start)
+        if probe.wait() != 0:
+            sys.exit('{} failed'.format(args.command))
+    report('startup', samples)
+    median = statistics.median(samples) * 1000
+    if median > args.budget:
+        sys.exit('Startup took {:.0f}ms, over the {}ms budget'
+                 .format(median, args.budget))
+
+
+@benchmark
+def template(args):
+    '''Cost of @GtkTemplate on a class, and of init_template per instance'''
+    from gi.repository import Gtk
+    from .gi_composites import GtkTemplate
+
+    children = 40
+    ui = ['<interface><template class="{name}" parent="GtkBox">']
+    ui.extend('<child><object class="GtkLabel" id="label{}"/></child>'
+              .format(i) for i in range(children))
+    ui.append('</template></interface>')
+    ui = '\n'.join(ui)
+
+    def init(self):
+        Gtk.Box.__init__(self)
+        self.init_template()
+
+    decorating = []
+    initing = []
+    with tempfile.TemporaryDirectory() as folder:
+        for run in range(args.runs):
+            name = 'KasbahBenchTemplate{}'.format(run)
+            path = os.path.join(folder, name + '.ui')
+            with open(path, 'w') as out:
+                out.write(ui.format(name=name))
+
+            attrs = {'__gtype_name__': name}
+            attrs.update(('label{}'.format(i), GtkTemplate.Child())
+                         for i in range(children))
+            attrs['__init__'] = init
+            klass = type(name, (Gtk.Box,), attrs)
+
+            start = time.perf_counter()
+            GtkTemplate(ui=path)(klass)
+            decorating.append(time.perf_counter() - start)
+
+            start = time.perf_counter()
+            klass()
+            initing.append(time.perf_counter() - start)
+    report('decorate', decorating)
+    report('init_template ({} children)'.format(children), initing)
+
+
+@benchmark
+def delay(args):
+    '''
+        How late a delayed capture's grab starts, with the fake backend,
+        against a plain GLib timeout of the same length (how delays were
+        waited out before). --runs captures of a quarter of a second.
+    '''
+    from .backend import FakeBackend
+
+    wait = 0.25
+    backend = FakeBackend(640, 480)
+    loop = GLib.MainLoop()
+
+    def run(label, shoot):
+        samples = []
+
+        def shot(late):
+            samples.append(late)
+            GLib.idle_add(next_run)
+
+        def next_run():
+            if len(samples) == args.runs:
+                loop.quit()
+            else:
+                shoot(shot)
+            return GLib.SOURCE_REMOVE
+
+        GLib.idle_add(next_run)
+        loop.run()
+        (p50, p90, p99) = percentiles([s * 1000 for s in samples])
+        print('{:<32} p50={:.3f} ms p90={:.3f} ms p99={:.3f} ms'.format(
+            label, p50, p90, p99))
+
+    def deadline(shot):
+        backend.capture('Screen', lambda c, e, t: shot(backend.lateness),
+                        delay=wait)
+
+    def timeout(shot):
+        due = time.perf_counter() + wait
+
+        def fired():
+            shot(time.perf_counter() - due)
+            return GLib.SOURCE_REMOVE
+
+        GLib.timeout_add(int(wait * 1000), fired)
+
+    run('backend delay', deadline)
+    run('timeout_add', timeout)
+
+
+@benchmark
+def dedup(args):
+    '''
+        Throughput of the dedup fingerprint in megapixels per second, the
+        perceptual hash with and without NumPy, then sha256 of the PNG
+        and the search through the recent hashes
+    '''
+    import hashlib
+    import random
+
+    from .backend import FakeBackend
+    from .encoder import encode
+    from . import dedup
+
+    hashers = [('dhash python', dedup._dhash_python)]
+    if dedup.numpy is not None:
+        hashers.insert(0, ('dhash numpy', dedup._dhash_numpy))
+    else:
+        print('NumPy is not installed, only timing the fallback')
+
+    def throughput(label, samples, megapixels):
+        report(label, samples)
+        print('{:<32} {:.1f} MP/s'.format(
+            '', megapixels / statistics.median(samples)))
+
+    for size in args.sizes.split(','):
+        pixbuf = FakeBackend(*SIZES[size]).render()
+        megapixels = pixbuf.props.width * pixbuf.props.height / 1e6
+        for (name, hasher) in hashers:
+            samples = []
+            for i in range(args.runs):
+                start = time.perf_counter()
+                hasher(pixbuf)
+                samples.append(time.perf_counter() - start)
+            throughput('{} {}'.format(size, name), samples, megapixels)
+
+        data = encode(pixbuf, 'png', level=1)
+        samples = []
+        for i in range(args.runs):
+            start = time.perf_counter()
+            hashlib.sha256(data).hexdigest()
+            samples.append(time.perf_counter() - start)
+        throughput('{} sha256'.format(size), samples, megapixels)
+
+    from .history import RECENT
+    hashes = [random.getrandbits(64) for i in range(RECENT)]
+    samples = []
+    for i in range(args.runs):
+        start = time.perf_counter()
+        dedup.nearest(random.getrandbits(64), hashes)
+        samples.append(time.perf_counter() - start)
+    report('nearest of {}'.format(RECENT), samples)
+
+
+@benchmark
+def edit(args):
+    '''
+        Replaying a blur, a pixelate and an arrow on a 400 pixel wide
+        preview (each change while editing) and at full size (saving)
+    '''
+    from .backend import FakeBackend
+    from .edit import Arrow, Blur, EditList, Pixelate
+
+    if not EditList.available():
+        print('NumPy is not installed, editing needs it')
+        return
+    for size in args.sizes.split(','):
+        (width, height) = SIZES[size]
+        pixbuf = FakeBackend(width, height).render()
+        edits = EditList()
+        edits.add(Blur((0, 0), (width // 2, height // 2)))
+        edits.add(Pixelate((width // 2, height // 2), (width, height)))
+        edits.add(Arrow((width // 4, height // 4), (width // 2, height // 2)))
+        scale = 400 / width
+        preview = pixbuf.scale_simple(400, max(1, round(height * scale)),
+                                      GdkPixbuf.InterpType.BILINEAR)
+        for (label, source, at) in (('preview', preview, scale),
+                                    ('full', pixbuf, 1)):
+            samples = []
+            for i in range(args.runs):
+                start = time.perf_counter()
+                edits.render(source, at)
+                samples.append(time.perf_counter() - start)
+            report('{} {}'.format(size, label), samples)
+        edits.shutdown()
+
+
+@benchmark
+def shadow(args):
+    '''
+        Adding the window shadow to a window half the size of the
+        screen, first with nothing cached and then again at the same
+        size (toggling the shadow, or shot after shot of one window)
+    '''
+    from .backend import FakeBackend
+    from . import shadow
+
+    for size in args.sizes.split(','):
+        (width, height) = SIZES[size]
+        window = FakeBackend(width // 2, height // 2).render()
+        for scale in (1, 2):
+            for (label, clear) in (('cold', True), ('cached', False)):
+                samples = []
+                for i in range(args.runs):
+                    if clear:
+                        shadow._kernel.cache_clear()
+                        shadow._profile.cache_clear()
+                    start = time.perf_counter()
+                    shadow.add_shadow(window, scale)
+                    samples.append(time.perf_counter() - start)
+                report('{} @{}x {}'.format(size, scale, label), samples)
+
+
+@benchmark
+def memory(args):
+    '''
+        Eight 4K captures open at once (as if in save dialogs) under a
+        budget that fits two, used round and round: what stays resident,
+        what's let go and how long bringing it back takes. Half have
+        their PNG to decode again, half have to be spilled.
+    '''
+    from .backend import FakeBackend
+    from .capture import Capture
+    from .encoder import encode
+    from .memory import PixelStore
+
+    (width, height) = SIZES['4k']
+    pixbuf = FakeBackend(width, height).render()
+    data = GLib.Bytes.new(encode(pixbuf, 'png', level=1))
+    store = PixelStore(2 * pixbuf.get_byte_length())
+    captures = []
+    for i in range(8):
+        if i % 2:
+            capture = Capture(data=data)
+        else:
+            capture = Capture(pixbuf=pixbuf.copy())
+        store.add(capture)
+        captures.append(capture)
+    samples = []
+    for run in range(args.runs):
+        for capture in captures:
+            start = time.perf_counter()
+            capture.pixbuf
+            samples.append(time.perf_counter() - start)
+    report('pixbuf', samples)
+    print('{:<32} {}'.format('', store.stats()))
+    for capture in captures:
+        store.remove(capture)
+
+
+@benchmark
+def tiles(args):
+    '''
+        Bytes written by the tile store against a PNG per capture, for
+        a run of captures where a small part of the screen changes (a
+        clock ticking over) each time
+    '''
+    from .backend import FakeBackend
+    from .encoder import encode
+    from .tiles import TileStore
+
+    for size in args.sizes.split(','):
+        base = FakeBackend(*SIZES[size]).render()
+        with tempfile.TemporaryDirectory() as folder:
+            store = TileStore(os.path.join(folder, 'store'))
+            (png, stored, samples) = (0, 0, [])
+            for run in range(args.runs):
+                pixbuf = base.copy()
+                clock = pixbuf.new_subpixbuf(pixbuf.props.width - 96, 8,
+                                             80, 16)
+                clock.fill((run * 37 % 256) << 24 | 0xff)
+                png += len(encode(pixbuf, 'png', level=6))
+                start = time.perf_counter()
+                (changed, total, written) = store.write(
+                    pixbuf, os.path.join(folder, '{}.tiles'.format(run)))
+                samples.append(time.perf_counter() - start)
+                stored += written
+            report('{} tiles'.format(size), samples)
+            print('{:<32} png={} bytes tiles={} bytes ({:.1f}x less)'
+                  .format('', png, stored, png / stored))
+
+
+@benchmark
+def monitors(args):
+    '''
+        Three 4K monitors with the fake backend: capturing and encoding
+        the whole desktop as one image, against each monitor on its own
+        with the encodes running side by side
+    '''
+    from concurrent.futures import ThreadPoolExecutor
+    from .backend import FakeBackend
+    from .encoder import encode
+
+    (width, height) = SIZES['4k']
+    areas = [(n * width, 0, width, height) for n in range(3)]
+    backend = FakeBackend(width * 3, height)
+    pool = ThreadPoolExecutor(max_workers=len(areas))
+    loop = GLib.MainLoop()
+
+    for (name, monitors) in (('whole desktop', None), ('per monitor', areas)):
+        samples = []
+
+        def done(capture, error, elapsed):
+            if error is not None:
+                print(error, file=sys.stderr)
+                loop.quit()
+                return
+            parts = [capture] if monitors is None else \
+                [part for (x, y, part) in capture.parts]
+            list(pool.map(lambda c: encode(c.pixbuf, 'png', level=1),
+                          parts))
+            samples.append(time.perf_counter() - start[0])
+            if len(samples) < args.runs:
+                GLib.idle_add(shoot)
+            else:
+                loop.quit()
+
+        def shoot():
+            start[0] = time.perf_counter()
+            backend.capture('Screen', done, monitors=monitors)
+            return GLib.SOURCE_REMOVE
+
+        start = [0]
+        GLib.idle_add(shoot)
+        loop.run()
+        report(name, samples)
+    pool.shutdown()
+
+
+@benchmark
+def zoom(args):
+    '''
+        The zoom preview on a 100 megapixel capture: making the tile
+        of the whole thing zoomed out from nothing, making a tile at
+        actual size, then drawing a 1080p view of tiles already made
+        (what has to fit in a frame for 60 fps)
+    '''
+    from gi.repository import Gdk
+    import cairo
+
+    if Gdk.Display.get_default() is None:
+        sys.exit('No display, try running under xvfb-run -a')
+    from .backend import FakeBackend
+    from .capture import Capture
+    from .zoom import KasbahZoom
+
+    capture = Capture(pixbuf=FakeBackend(13440, 7560).render())
+    view = KasbahZoom(capture)
+    for (label, key) in (('zoomed out', (view.top_level, 0, 0)),
+                         ('actual size', (0, 20, 10))):
+        samples = []
+        for run in range(args.runs):
+            start = time.perf_counter()
+            view._tile(key)
+            samples.append(time.perf_counter() - start)
+        report('tile {}'.format(label), samples)
+
+    allocation = Gdk.Rectangle()
+    (allocation.width, allocation.height) = SIZES['1080p']
+    view.size_allocate(allocation)
+    view.zoom = 0.3
+    cr = cairo.Context(cairo.ImageSurface(cairo.FORMAT_ARGB32,
+                                          *SIZES['1080p']))
+    view.on_draw(view, cr)
+    for key in view.wanted:
+        view.tiles[key] = view._tile(key)
+    samples = []
+    for run in range(args.runs * 10):
+        start = time.perf_counter()
+        view.on_draw(view, cr)
+        samples.append(time.perf_counter() - start)
+    report('draw {} tiles'.format(len(view.wanted)), samples)
+    view.destroy()
+
+
+@benchmark
+def record(args):
+    '''
+        Recording 1080p at 30 frames a second for --runs seconds, to an
+        APNG and (if it's installed) through ffmpeg to WebM, reporting
+        dropped frames and CPU use. Frames come from the fake backend,
+        pre-rendered, so this measures encoding and writing, not the
+        grab itself.
+    '''
+    from .backend import FakeBackend
+    from .record import Recorder, new_writer
+
+    (width, height) = SIZES['1080p']
+    base = FakeBackend(width, height).render()
+    frames = []
+    for i in range(30):
+        # Something moving, so every frame is different
+        frame = base.copy()
+        frame.new_subpixbuf(i * 60, height // 2, 64, 64).fill(0xcc0000ff)
+        frames.append(frame)
+    ticks = iter(range(1 << 62))
+
+    targets = ['recording.apng']
+    if GLib.find_program_in_path('ffmpeg'):
+        targets.append('recording.webm')
+
+    with tempfile.TemporaryDirectory() as folder:
+        for name in targets:
+            path = os.path.join(folder, name)
+            writer = new_writer(path, width, height, False, 30)
+            recorder = Recorder(writer,
+                                lambda: frames[next(ticks) % len(frames)],
+                                30)
+            loop = GLib.MainLoop()
+
+            def finished(stats, error):
+                if error is not None:
+                    print(error, file=sys.stderr)
+                print('{:<32} {} ({:.1f} s, {} bytes)'.format(
+                    name, stats, stats.elapsed, os.path.getsize(path)))
+                loop.quit()
+
+            def stop():
+                recorder.stop()
+                return GLib.SOURCE_REMOVE
+
+            recorder.start(finished)
+            GLib.timeout_add(args.runs * 1000, stop)
+            loop.run()
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(prog='kasbah.bench')
+    parser.add_argument('name', choices=sorted(BENCHMARKS))
+    parser.add_argument('--backend', default='fake')
+    parser.add_argument('--mode', default='Screen')
+    parser.add_argument('--runs', type=int, default=5)
+    parser.add_argument('--sizes', default=','.join(SIZES))
+    parser.add_argument('--json', help='write the results here')
+    parser.add_argument('--command', default='kasbah',
+                        help='the kasbah to start (startup)')
+    parser.add_argument('--budget', type=int, default=1000,
+                        help='allowed startup in milliseconds (startup)')
+    args = parser.parse_args(argv)
+    BENCHMARKS[args.name](args)
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
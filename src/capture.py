@@ -0,0 +1,385 @@
+# capture.py
+#
+# Copyright 2018 Zander Brown
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+from gi.repository import GLib, GdkPixbuf
+
+from .encoder import encode, get_format
+from . import trace
+
+from pathlib import Path
+
+import errno
+import fcntl
+import os
+import struct
+import tempfile
+import threading
+import warnings
+
+# Stream in big chunks so slow disks get large writes
+CHUNK_SIZE = 4 * 1024 * 1024
+
+# linux/fs.h, share extents with the source on btrfs/xfs
+FICLONE = 0x40049409
+
+
+def scratch_file():
+    '''
+        Somewhere for a helper to write a single capture
+
+        Outside of flatpak this is in XDG_RUNTIME_DIR, which is tmpfs,
+        so the image never reaches the disk. Every call gets a new name
+        so captures can't trample each other.
+    '''
+    if Path('/.flatpak-info').exists():
+        # The host can't see our runtime dir, but it can see the cache
+        parent = GLib.get_user_cache_dir()
+    else:
+        parent = GLib.get_user_runtime_dir()
+    folder = GLib.build_filenamev([parent, 'kasbah'])
+    GLib.mkdir_with_parents(folder, 0o700)
+    (fd, filename) = tempfile.mkstemp(suffix='.png', dir=folder)
+    os.close(fd)
+    return filename
+
+
+def run_async(work, callback):
+    '''
+        work() in a worker thread, callback gets (result, None) or
+        (None, the exception) back on the main loop, so a failure can't
+        leave it waiting forever
+    '''
+    def finish(result, error):
+        callback(result, error)
+        return GLib.SOURCE_REMOVE
+
+    def run():
+        try:
+            result = work()
+        except Exception as err:
+            GLib.idle_add(finish, None, err)
+        else:
+            GLib.idle_add(finish, result, None)
+
+    threading.Thread(target=run, daemon=True).start()
+
+
+class Capture(object):
+    '''
+        A screenshot held in memory until it's saved
+
+        data is the encoded image exactly as the backend produced it
+        (or None) and is written out untouched when saving as that
+        format. The pixbuf is only decoded when something wants pixels.
+
+        When a helper wrote the capture, filename is its scratch file,
+        which saving will try to link or clone rather than copy. Call
+        discard once the capture is finished with.
+    '''
+
+    def __init__(self, data=None, pixbuf=None, mime_type='image/png',
+                 filename=None):
+        self.data = data
+        self.mime_type = mime_type
+        self.filename = filename
+        # Set by the backend, Screen, Window or Selection
+        self.mode = None
+        # The PixelStore looking after the pixbuf, if any
+        self.store = None
+        self._pixbuf = pixbuf
+        self._loading = threading.Lock()
+
+    @classmethod
+    def from_file(cls, filename):
+        '''Take over filename, a scratch file written by a helper'''
+        # The mapping stays valid after the file is gone
+        mapped = GLib.MappedFile.new(filename, False)
+        return cls(data=mapped.get_bytes(), filename=filename)
+
+    def discard(self):
+        '''Remove the scratch file, data stays usable'''
+        if self.filename is not None:
+            GLib.unlink(self.filename)
+            self.filename = None
+
+    @property
+    def pixbuf(self):
+        '''
+            The decoded image, made the first time it's asked for, or
+            brought back if the store has let it go since
+        '''
+        with self._loading:
+            if self._pixbuf is None:
+                if self.store is not None:
+                    self._pixbuf = self.store.reload(self)
+                if self._pixbuf is None:
+                    self._pixbuf = self._decode()
+            pixbuf = self._pixbuf
+        if self.store is not None:
+            self.store.touch(self, pixbuf)
+        return pixbuf
+
+    def loaded_pixbuf(self):
+        '''
+            The pixbuf if it can be had without decoding, in memory or
+            back from the store, else None
+        '''
+        with self._loading:
+            if self._pixbuf is None and self.store is not None:
+                self._pixbuf = self.store.reload(self)
+            pixbuf = self._pixbuf
+        if pixbuf is not None and self.store is not None:
+            self.store.touch(self, pixbuf)
+        return pixbuf
+
+    def _decode(self):
+        with trace.span('decode'):
+            loader = GdkPixbuf.PixbufLoader.new_with_mime_type(
+                self.mime_type)
+            loader.write_bytes(self.data)
+            loader.close()
+            return loader.get_pixbuf()
+
+    def can_decode(self):
+        '''Whether the pixbuf can be made again once it's let go'''
+        return self.data is not None
+
+    def release(self, spill):
+        '''
+            Let go of the pixbuf, having spill(pixbuf) keep it somewhere
+            first if it can't be decoded again. False if there wasn't one.
+        '''
+        with self._loading:
+            if self._pixbuf is None:
+                return False
+            if not self.can_decode():
+                spill(self._pixbuf)
+            self._pixbuf = None
+            return True
+
+    def get_size(self):
+        '''(width, height) without decoding, where we can'''
+        if self._pixbuf is None and self.data is not None and \
+                self.mime_type == 'image/png':
+            # The IHDR chunk always comes first. A slice of the Bytes,
+            # get_data on the whole thing would copy all of it.
+            header = GLib.Bytes.new_from_bytes(self.data, 16, 8).get_data()
+            return struct.unpack('>II', header)
+        return (self.pixbuf.props.width, self.pixbuf.props.height)
+
+    def thumbnail_async(self, width, cancellable, callback):
+        '''
+            Make a preview width pixels wide in a worker thread, callback
+            gets the pixbuf (or None on failure) back on the main loop
+
+            Encoded captures are decoded straight to the target size,
+            the full size pixbuf isn't kept (or made, for formats that
+            can decode at a smaller size)
+        '''
+        pixbuf = self._pixbuf
+        data = self.data
+        # Nothing to decode, the pixbuf is all there is
+        need_pixbuf = pixbuf is None and data is None
+
+        def finish(thumb):
+            if not cancellable.is_cancelled():
+                callback(thumb)
+            return GLib.SOURCE_REMOVE
+
+        def size_prepared(loader, full_width, full_height):
+            height = max(1, round(full_height * width / full_width))
+            loader.set_size(width, height)
+
+        def work():
+            thumb = None
+            timer = trace.begin('thumbnail', width=width)
+            try:
+                source = self.pixbuf if need_pixbuf else pixbuf
+                if source is not None:
+                    height = max(1, round(source.props.height * width /
+                                          source.props.width))
+                    mode = GdkPixbuf.InterpType.BILINEAR
+                    thumb = source.scale_simple(width, height, mode)
+                else:
+                    loader = GdkPixbuf.PixbufLoader.new_with_mime_type(
+                        self.mime_type)
+                    loader.connect('size-prepared', size_prepared)
+                    loader.write_bytes(data)
+                    loader.close()
+                    thumb = loader.get_pixbuf()
+            except GLib.Error as err:
+                warnings.warn('Failed to make thumbnail: ' + err.message)
+            timer.end()
+            GLib.idle_add(finish, thumb)
+
+        threading.Thread(target=work, daemon=True).start()
+
+    def save_async(self, path, fmt, options,
+                   cancellable, progress, callback):
+        '''
+            Write the image to path, which mustn't exist, as the format
+            called fmt in a worker thread. options are passed on to
+            encoder.encode. progress gets (written, total) and callback
+            gets None or the OSError/GLib.Error, both on the main loop.
+
+            If fmt is what the backend gave us it isn't re-encoded, the
+            scratch file is hard linked if it's on the same
+            filesystem, then cloned (reflink) or copied with
+            copy_file_range, before falling back to writing data in
+            large chunks. Cancelling removes the partial file.
+        '''
+        if get_format(fmt).mime_type == self.mime_type:
+            source = self.filename
+            data = self.data
+        else:
+            source = data = None
+
+        def report(written, total):
+            GLib.idle_add(progress, written, total)
+
+        def finish(error):
+            callback(error)
+            return GLib.SOURCE_REMOVE
+
+        def work():
+            try:
+                if source is None or \
+                        not _fast_copy(source, path, cancellable, report):
+                    if data is not None:
+                        buf = data.get_data()
+                    else:
+                        with trace.span('encode', format=fmt):
+                            buf = encode(self.pixbuf, fmt, **options)
+                    with trace.span('write', bytes=len(buf)):
+                        _write(buf, path, cancellable, report)
+                error = None
+            except (OSError, GLib.Error) as err:
+                error = err
+            GLib.idle_add(finish, error)
+
+        threading.Thread(target=work, daemon=True).start()
+
+
+class StitchedCapture(Capture):
+    '''
+        Captures of several monitors, taken separately, that only become
+        one image if something asks for the pixbuf
+
+        parts is a list of (x, y, Capture), x and y being where that
+        capture goes in the combined image. Saving each part on its own
+        never pays for the stitching, or the decoding, of the rest.
+    '''
+
+    def __init__(self, parts):
+        super().__init__(mime_type=None)
+        self.parts = parts
+
+    def get_size(self):
+        sizes = [(x, y) + part.get_size() for (x, y, part) in self.parts]
+        return (max(x + w for (x, y, w, h) in sizes),
+                max(y + h for (x, y, w, h) in sizes))
+
+    def discard(self):
+        for (x, y, part) in self.parts:
+            part.discard()
+
+    def can_decode(self):
+        # Stitched again from the parts
+        return True
+
+    def _decode(self):
+        with trace.span('stitch', parts=len(self.parts)):
+            (width, height) = self.get_size()
+            alpha = any(p.pixbuf.props.has_alpha for (x, y, p) in self.parts)
+            stitched = GdkPixbuf.Pixbuf.new(GdkPixbuf.Colorspace.RGB, alpha,
+                                            8, width, height)
+            # Black where no monitor covers (differing sizes)
+            stitched.fill(0x000000ff)
+            for (x, y, part) in self.parts:
+                source = part.pixbuf
+                source.copy_area(0, 0, source.props.width,
+                                 source.props.height, stitched, x, y)
+            return stitched
+
+
+def _cancelled():
+    return OSError(errno.ECANCELED, os.strerror(errno.ECANCELED))
+
+
+def _fast_copy(source, path, cancellable, report):
+    '''
+        Try to get source to path without moving the bytes through
+        userspace, returns False if we have to stream it ourselves
+    '''
+    try:
+        os.link(source, path)
+        return True
+    except OSError as err:
+        if err.errno not in (errno.EXDEV, errno.EPERM, errno.EMLINK):
+            raise
+
+    with open(source, 'rb') as src:
+        total = os.fstat(src.fileno()).st_size
+        fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o666)
+        try:
+            try:
+                fcntl.ioctl(fd, FICLONE, src.fileno())
+                return True
+            except OSError:
+                pass
+            copied = 0
+            try:
+                while copied < total:
+                    if cancellable.is_cancelled():
+                        break
+                    n = os.copy_file_range(src.fileno(), fd,
+                                           min(CHUNK_SIZE, total - copied))
+                    if n == 0:
+                        break
+                    copied += n
+                    report(copied, total)
+            except (OSError, AttributeError):
+                pass
+            if copied == total:
+                return True
+        finally:
+            os.close(fd)
+    if cancellable.is_cancelled():
+        os.unlink(path)
+        raise _cancelled()
+    # Couldn't do it in the kernel, _write starts from scratch
+    os.unlink(path)
+    return False
+
+
+def _write(buf, path, cancellable, report):
+    '''Write buf to path in CHUNK_SIZE pieces'''
+    view = memoryview(buf)
+    total = len(view)
+    fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o666)
+    try:
+        written = 0
+        while written < total:
+            if cancellable.is_cancelled():
+                raise _cancelled()
+            written += os.write(fd, view[written:written + CHUNK_SIZE])
+            report(written, total)
+    except OSError:
+        os.close(fd)
+        os.unlink(path)
+        raise
+    os.close(fd)
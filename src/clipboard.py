@@ -0,0 +1,81 @@
+# clipboard.py
+#
+# Copyright 2018 Zander Brown
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+from gi.repository import Gtk, Gdk, GLib
+
+from .encoder import available_formats, encode
+from . import trace
+
+import warnings
+
+
+class ClipboardProvider(Gtk.Invisible):
+    '''
+        Puts a Capture on the clipboard without encoding anything up
+        front, unlike Gtk.Clipboard.set_image
+
+        Each format is only encoded the first time somebody pastes it
+        and then kept, so pasting again costs nothing. If the capture
+        still has the bytes the backend gave us those are handed out
+        as they are.
+    '''
+
+    def __init__(self):
+        super().__init__()
+        self.selection = Gdk.SELECTION_CLIPBOARD
+        self.capture = None
+        self.cache = {}
+        self.connect('selection-get', self.on_get)
+        self.connect('selection-clear-event', self.on_clear)
+
+    def offer(self, capture):
+        '''Take ownership of the clipboard with capture'''
+        self.capture = capture
+        self.cache = {}
+        if capture.data is not None:
+            self.cache[capture.mime_type] = capture.data.get_data()
+
+        Gtk.selection_clear_targets(self, self.selection)
+        formats = available_formats()
+        # Offer the one we already have first, it's free
+        formats.sort(key=lambda f: f.mime_type != capture.mime_type)
+        for (info, fmt) in enumerate(formats):
+            target = Gdk.Atom.intern(fmt.mime_type, False)
+            self.selection_add_target(self.selection, target, info)
+        self.formats = formats
+        time = Gtk.get_current_event_time()
+        return Gtk.selection_owner_set(self, self.selection, time)
+
+    def on_get(self, widget, selection_data, info, time):
+        fmt = self.formats[info]
+        data = self.cache.get(fmt.mime_type)
+        if data is None:
+            try:
+                with trace.span('clipboard-encode', format=fmt.name):
+                    data = encode(self.capture.pixbuf, fmt.name)
+            except GLib.Error as err:
+                warnings.warn('Failed to encode {}: {}'.format(
+                    fmt.name, err.message))
+                return
+            self.cache[fmt.mime_type] = data
+        selection_data.set(selection_data.get_target(), 8, data)
+
+    def on_clear(self, widget, event):
+        # Somebody else owns the clipboard now
+        self.capture = None
+        self.cache = {}
+        return False
@@ -0,0 +1,70 @@
+# countdown.py
+#
+# Copyright 2018 Zander Brown
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+from gi.repository import Gtk, GLib
+
+# Gone this long before the deadline, so it isn't in the screenshot
+HIDE_AHEAD = 150000
+# How often the count goes down, in milliseconds
+TICK = 100
+
+
+class KasbahCountdown(Gtk.Window):
+    '''
+        The seconds left until a delayed capture, in a popup at the top
+        of the screen that never takes focus from the window about to
+        be captured
+    '''
+
+    __gtype_name__ = 'KasbahCountdown'
+
+    def __init__(self, deadline, **kwargs):
+        super().__init__(type=Gtk.WindowType.POPUP, accept_focus=False,
+                         **kwargs)
+        # Monotonic microseconds, like CaptureBackend's
+        self.deadline = deadline
+        self.label = Gtk.Label(visible=True, margin=12)
+        self.label.get_style_context().add_class('osd')
+        self.add(self.label)
+        self.get_style_context().add_class('osd')
+        self.set_position(Gtk.WindowPosition.CENTER)
+        self.timer = None
+        self.connect('destroy', self.on_destroy)
+
+    def start(self):
+        '''Show the count, if there's long enough left to be worth it'''
+        if self.deadline - GLib.get_monotonic_time() <= HIDE_AHEAD:
+            self.destroy()
+            return
+        self.tick()
+        self.show()
+        self.timer = GLib.timeout_add(TICK, self.tick)
+
+    def tick(self):
+        left = self.deadline - GLib.get_monotonic_time()
+        if left <= HIDE_AHEAD:
+            self.timer = None
+            self.destroy()
+            return GLib.SOURCE_REMOVE
+        self.label.set_markup('<span size="xx-large">{:.1f}</span>'.format(
+            left / GLib.USEC_PER_SEC))
+        return GLib.SOURCE_CONTINUE
+
+    def on_destroy(self, win):
+        if self.timer is not None:
+            GLib.source_remove(self.timer)
+            self.timer = None
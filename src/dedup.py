@@ -0,0 +1,152 @@
+# dedup.py
+#
+# Copyright 2018 Zander Brown
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+# Spotting captures we've already saved, so jobs that shoot the same
+# screen over and over don't fill the disk with copies of it.
+#
+# Each capture gets a sha256 of its bytes (exact copies) and a 64 bit
+# dHash, which survives the odd changed pixel (a blinking cursor, the
+# clock), compared by the number of bits that differ.
+
+from gi.repository import GdkPixbuf
+
+from .pixels import as_array, numpy
+
+import errno
+import hashlib
+import os
+
+# dHash compares HASH_SIZE + 1 columns in each of HASH_SIZE rows
+HASH_SIZE = 8
+
+# Pixels sampled per grid cell along each axis, plenty for an average
+SAMPLES = 8
+
+# ITU-R BT.601 luma
+LUMA = (0.299, 0.587, 0.114)
+
+
+class Fingerprint(object):
+    def __init__(self, content, dhash):
+        self.content = content
+        self.dhash = dhash
+
+
+def _dhash_numpy(pixbuf):
+    (rows, cols) = (HASH_SIZE, HASH_SIZE + 1)
+    pixels = as_array(pixbuf)
+    # Every step-th pixel is the downscaled copy, the averages below
+    # don't need more than SAMPLES per cell each way
+    step = max(1, min(pixbuf.props.height // rows,
+                      pixbuf.props.width // cols) // SAMPLES)
+    small = pixels[::step, ::step, :3]
+    luma = small @ numpy.array(LUMA, dtype=numpy.float32)
+    (height, width) = luma.shape
+    (height, width) = (height - height % rows, width - width % cols)
+    grid = luma[:height, :width] \
+        .reshape(rows, height // rows, cols, width // cols).mean(axis=(1, 3))
+    bits = numpy.packbits(grid[:, 1:] > grid[:, :-1])
+    return int.from_bytes(bits.tobytes(), 'big')
+
+
+def _dhash_python(pixbuf):
+    small = pixbuf.scale_simple(HASH_SIZE + 1, HASH_SIZE,
+                                GdkPixbuf.InterpType.BILINEAR)
+    data = small.get_pixels()
+    (n, stride) = (small.props.n_channels, small.props.rowstride)
+    value = 0
+    for y in range(HASH_SIZE):
+        row = [sum(w * c for (w, c) in zip(LUMA, data[o:o + 3]))
+               for o in range(y * stride, y * stride + (HASH_SIZE + 1) * n,
+                              n)]
+        for x in range(HASH_SIZE):
+            value = (value << 1) | (row[x + 1] > row[x])
+    return value
+
+
+def dhash(pixbuf):
+    '''The 64 bit difference hash of pixbuf'''
+    big_enough = pixbuf.props.width >= (HASH_SIZE + 1) and \
+        pixbuf.props.height >= HASH_SIZE
+    if numpy is not None and big_enough:
+        return _dhash_numpy(pixbuf)
+    return _dhash_python(pixbuf)
+
+
+def distance(a, b):
+    '''How many bits differ between the hashes a and b'''
+    return bin(a ^ b).count('1')
+
+
+def nearest(target, hashes):
+    '''(index, distance) of the closest of hashes to target'''
+    if numpy is None or len(hashes) < 64:
+        return min(((i, distance(target, h)) for (i, h) in enumerate(hashes)),
+                   key=lambda found: found[1], default=(None, None))
+    differ = numpy.array(hashes, dtype=numpy.uint64) ^ numpy.uint64(target)
+    counts = numpy.unpackbits(differ.view(numpy.uint8)) \
+        .reshape(-1, 64).sum(axis=1)
+    best = int(counts.argmin())
+    return (best, int(counts[best]))
+
+
+def fingerprint(capture):
+    '''
+        The Fingerprint of capture, worked out once and kept on it.
+        Always from the full size pixbuf so hashes of captures that came
+        through the dialog and through the service can be compared.
+    '''
+    found = getattr(capture, 'fingerprint', None)
+    if found is not None:
+        return found
+    if capture.data is not None:
+        data = capture.data.get_data()
+    else:
+        data = capture.pixbuf.read_pixel_bytes().get_data()
+    content = hashlib.sha256(data).hexdigest()
+    capture.fingerprint = Fingerprint(content, dhash(capture.pixbuf))
+    return capture.fingerprint
+
+
+def save_async(history, capture, path, fmt, options, threshold,
+               cancellable, progress, callback):
+    '''
+        Capture.save_async, except that if capture is within threshold
+        bits of a recent screenshot in history path becomes a symlink to
+        that file. callback gets (error, original), original being the
+        history Entry linked to or None.
+    '''
+    def saved(error):
+        callback(error, None)
+
+    def found(original):
+        if original is None:
+            capture.save_async(path, fmt, options, cancellable, progress,
+                               saved)
+            return
+        error = None
+        if cancellable.is_cancelled():
+            error = OSError(errno.ECANCELED, os.strerror(errno.ECANCELED))
+        else:
+            try:
+                os.symlink(os.path.realpath(original.path), path)
+            except OSError as err:
+                error = err
+        callback(error, original)
+
+    history.find_duplicate(capture, os.path.splitext(path)[1], threshold,
+                           found)
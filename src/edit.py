@@ -0,0 +1,314 @@
+# edit.py
+#
+# Copyright 2018 Zander Brown
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+# Redacting (blur, pixelate, fill) and marking up (boxes, arrows) a
+# capture before it's saved. Edits are kept as a list and replayed, on
+# the preview while editing and at full size only when saving.
+
+from gi.repository import Gdk
+import cairo
+
+from .capture import Capture, run_async
+from .pixels import as_array, numpy, to_pixbuf
+from . import trace
+
+from abc import ABC, abstractmethod
+from concurrent.futures import ThreadPoolExecutor
+
+import math
+import os
+
+# Rows of a redaction handled by each job
+BAND = 256
+
+
+def _bands(height, step):
+    '''(top, bottom) for each band of rows, each step rows apart'''
+    return [(top, min(height, top + step)) for top in range(0, height, step)]
+
+
+def _box(array, radius, axis):
+    '''Box blur of array along axis, edges repeated, as int32'''
+    size = 2 * radius + 1
+    pad = [(0, 0)] * array.ndim
+    pad[axis] = (radius + 1, radius)
+    total = numpy.pad(array, pad, mode='edge').cumsum(axis=axis,
+                                                      dtype=numpy.int32)
+    length = array.shape[axis]
+    upper = numpy.take(total, range(size, size + length), axis=axis)
+    lower = numpy.take(total, range(length), axis=axis)
+    return (upper - lower) // size
+
+
+class Operation(ABC):
+    '''
+        One edit, dragged out from start to end, both (x, y) in the
+        capture's pixels. Redactions change pixels through NumPy,
+        annotations are drawn with cairo.
+    '''
+
+    redaction = True
+
+    def __init__(self, start, end):
+        self.start = start
+        self.end = end
+
+    def area(self, scale, shape, margin=0):
+        '''
+            (x, y, width, height) at scale, margin pixels (of the
+            capture) bigger each way, clipped to the array's shape
+        '''
+        (x0, x1) = sorted((self.start[0], self.end[0]))
+        (y0, y1) = sorted((self.start[1], self.end[1]))
+        left = max(0, math.floor((x0 - margin) * scale))
+        top = max(0, math.floor((y0 - margin) * scale))
+        right = min(shape[1], math.ceil((x1 + margin) * scale))
+        bottom = min(shape[0], math.ceil((y1 + margin) * scale))
+        return (left, top, max(0, right - left), max(0, bottom - top))
+
+    @abstractmethod
+    def apply(self, array, scale, pool):
+        '''Edit array, a writable (height, width, channels) uint8 array'''
+        pass
+
+
+class Banded(Operation):
+    '''A redaction done a band of rows at a time on the pool'''
+
+    def apply(self, array, scale, pool):
+        (x, y, width, height) = self.area(scale, array.shape)
+        if width == 0 or height == 0:
+            return
+        region = array[y:y + height, x:x + width]
+        # Read from a copy, the bands overlap where they read
+        source = region.copy()
+        list(pool.map(lambda band: self.band(source, region, scale, *band),
+                      _bands(height, self.step(scale))))
+
+    def step(self, scale):
+        return BAND
+
+    @abstractmethod
+    def band(self, source, region, scale, top, bottom):
+        pass
+
+
+class Blur(Banded):
+    '''A box blur, radius pixels each way'''
+
+    def __init__(self, start, end, radius=16):
+        super().__init__(start, end)
+        self.radius = radius
+
+    def band(self, source, region, scale, top, bottom):
+        radius = max(1, round(self.radius * scale))
+        # The rows either side that this band's pixels reach
+        above = max(0, top - radius)
+        below = min(source.shape[0], bottom + radius)
+        blurred = _box(_box(source[above:below], radius, 0), radius, 1)
+        region[top:bottom] = blurred[top - above:bottom - above]
+
+
+class Pixelate(Banded):
+    '''Blocks of block pixels, each the average of its colours'''
+
+    def __init__(self, start, end, block=16):
+        super().__init__(start, end)
+        self.block = block
+
+    def step(self, scale):
+        # Whole blocks in each band
+        block = max(1, round(self.block * scale))
+        return max(1, BAND // block) * block
+
+    def band(self, source, region, scale, top, bottom):
+        block = max(1, round(self.block * scale))
+        rows = source[top:bottom]
+        (height, width) = rows.shape[:2]
+        ys = numpy.arange(0, height, block)
+        xs = numpy.arange(0, width, block)
+        sums = numpy.add.reduceat(numpy.add.reduceat(
+            rows.astype(numpy.uint32), ys, axis=0), xs, axis=1)
+        # The last row and column of blocks can be short
+        tall = numpy.diff(numpy.append(ys, height))
+        wide = numpy.diff(numpy.append(xs, width))
+        means = sums // (tall[:, None, None] * wide[None, :, None])
+        region[top:bottom] = numpy.repeat(numpy.repeat(means, tall, axis=0),
+                                          wide, axis=1)
+
+
+class Fill(Operation):
+    '''Solid colour, (r, g, b) 0 to 255'''
+
+    def __init__(self, start, end, color=(0, 0, 0)):
+        super().__init__(start, end)
+        self.color = color
+
+    def apply(self, array, scale, pool):
+        (x, y, width, height) = self.area(scale, array.shape)
+        region = array[y:y + height, x:x + width]
+        region[..., :3] = self.color
+        if array.shape[2] == 4:
+            region[..., 3] = 255
+
+
+class Annotation(Operation):
+    '''Drawn over the pixels, color is (r, g, b) 0 to 1'''
+
+    redaction = False
+
+    def __init__(self, start, end, color=(0.9, 0.1, 0.1), width=4):
+        super().__init__(start, end)
+        self.color = color
+        self.width = width
+
+    def apply(self, array, scale, pool):
+        # Only the pixels the drawing can reach go through cairo
+        margin = math.ceil(self.width * 4)
+        (x, y, width, height) = self.area(scale, array.shape, margin)
+        if width == 0 or height == 0:
+            return
+        region = array[y:y + height, x:x + width]
+        surface = cairo.ImageSurface(cairo.FORMAT_ARGB32, width, height)
+        cr = cairo.Context(surface)
+        Gdk.cairo_set_source_pixbuf(cr, to_pixbuf(region), 0, 0)
+        cr.paint()
+        cr.translate(-x, -y)
+        cr.scale(scale, scale)
+        cr.set_source_rgb(*self.color)
+        cr.set_line_width(self.width)
+        cr.set_line_cap(cairo.LINE_CAP_ROUND)
+        cr.set_line_join(cairo.LINE_JOIN_ROUND)
+        self.draw(cr)
+        drawn = Gdk.pixbuf_get_from_surface(surface, 0, 0, width, height)
+        region[...] = as_array(drawn)[..., :array.shape[2]]
+
+    @abstractmethod
+    def draw(self, cr):
+        pass
+
+
+class Box(Annotation):
+    def draw(self, cr):
+        (x0, x1) = sorted((self.start[0], self.end[0]))
+        (y0, y1) = sorted((self.start[1], self.end[1]))
+        cr.rectangle(x0, y0, x1 - x0, y1 - y0)
+        cr.stroke()
+
+
+class Arrow(Annotation):
+    '''From start, pointing at end'''
+
+    def draw(self, cr):
+        (x0, y0) = self.start
+        (x1, y1) = self.end
+        angle = math.atan2(y1 - y0, x1 - x0)
+        head = self.width * 4
+        cr.move_to(x0, y0)
+        cr.line_to(x1, y1)
+        cr.stroke()
+        cr.move_to(x1, y1)
+        for side in (-1, 1):
+            cr.line_to(x1 - head * math.cos(angle + side * math.pi / 6),
+                       y1 - head * math.sin(angle + side * math.pi / 6))
+        cr.close_path()
+        cr.fill()
+
+
+TOOLS = {
+    'blur': Blur,
+    'pixelate': Pixelate,
+    'fill': Fill,
+    'box': Box,
+    'arrow': Arrow,
+}
+
+
+class EditList(object):
+    '''
+        The edits made to a capture, in order, applied by replaying
+        them. Nothing happens to the capture itself until rasterize.
+
+        Needs NumPy, check available() first.
+    '''
+
+    def __init__(self):
+        self.operations = []
+        self.pool = None
+
+    @staticmethod
+    def available():
+        return numpy is not None
+
+    def __len__(self):
+        return len(self.operations)
+
+    def add(self, operation):
+        self.operations.append(operation)
+
+    def undo(self):
+        if self.operations:
+            self.operations.pop()
+
+    def _get_pool(self):
+        if self.pool is None:
+            self.pool = ThreadPoolExecutor(max_workers=os.cpu_count() or 1)
+        return self.pool
+
+    def render(self, pixbuf, scale=1):
+        '''
+            A new pixbuf of the edits applied to pixbuf, which is the
+            capture at scale (a preview for instance)
+        '''
+        with trace.span('edit', operations=len(self.operations),
+                        width=pixbuf.props.width):
+            array = numpy.array(as_array(pixbuf))
+            pool = self._get_pool()
+            for operation in list(self.operations):
+                operation.apply(array, scale, pool)
+            return to_pixbuf(array)
+
+    def render_async(self, pixbuf, scale, callback):
+        '''
+            render in a worker, callback gets (pixbuf, None) or (None,
+            the error) on the main loop
+        '''
+        # Not on the pool, render waits on it
+        run_async(lambda: self.render(pixbuf, scale), callback)
+
+    def rasterize_async(self, capture, callback):
+        '''
+            callback gets (a new Capture of the edits applied to capture
+            at full size, or capture itself when there aren't any, None)
+            or (None, the error)
+        '''
+        if not self.operations:
+            callback(capture, None)
+            return
+
+        def work():
+            # The full size pixbuf is decoded in the worker too
+            edited = Capture(pixbuf=self.render(capture.pixbuf))
+            edited.mode = capture.mode
+            return edited
+
+        run_async(work, callback)
+
+    def shutdown(self):
+        if self.pool is not None:
+            self.pool.shutdown(wait=False)
+            self.pool = None
@@ -0,0 +1,170 @@
+# encoder.py
+#
+# Copyright 2018 Zander Brown
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+from gi.repository import GLib, GdkPixbuf
+
+from concurrent.futures import ThreadPoolExecutor
+
+import os
+import struct
+import zlib
+
+
+class Format(object):
+    def __init__(self, name, mime_type, extension, label):
+        self.name = name
+        self.mime_type = mime_type
+        self.extension = extension
+        self.label = label
+
+
+FORMATS = [
+    Format('png', 'image/png', '.png', 'PNG'),
+    Format('jpeg', 'image/jpeg', '.jpg', 'JPEG'),
+    Format('webp', 'image/webp', '.webp', 'WebP'),
+]
+
+# Raw bytes given to each deflate worker, about what pigz uses
+BAND_SIZE = 1024 * 1024
+
+# Deflate only looks back this far, so it's all a band needs of the last
+WINDOW_SIZE = 32 * 1024
+
+_pool = None
+
+
+def _get_pool():
+    global _pool
+    if _pool is None:
+        _pool = ThreadPoolExecutor(max_workers=os.cpu_count() or 1)
+    return _pool
+
+
+def get_format(name):
+    for fmt in FORMATS:
+        if fmt.name == name:
+            return fmt
+    return FORMATS[0]
+
+
+def available_formats():
+    '''The FORMATS the installed gdk-pixbuf loaders can write'''
+    writable = set()
+    for info in GdkPixbuf.Pixbuf.get_formats():
+        if info.is_writable():
+            writable.update(info.get_mime_types())
+    # PNG we do ourselves
+    return [f for f in FORMATS if f.name == 'png' or f.mime_type in writable]
+
+
+def encode(pixbuf, name, level=6, quality=90):
+    '''Encode pixbuf as the format called name, returns bytes'''
+    if name == 'png':
+        return encode_png(pixbuf, level)
+    elif name == 'jpeg':
+        if pixbuf.props.has_alpha:
+            pixbuf = pixbuf.composite_color_simple(
+                pixbuf.props.width, pixbuf.props.height,
+                GdkPixbuf.InterpType.NEAREST, 255, 1, 0xffffff, 0xffffff)
+        (ok, buf) = pixbuf.save_to_bufferv('jpeg', ['quality'],
+                                            [str(quality)])
+        return buf
+    elif name == 'webp':
+        try:
+            (ok, buf) = pixbuf.save_to_bufferv('webp', ['lossless'], ['true'])
+        except GLib.Error:
+            # Older loaders don't know lossless, this is the closest
+            (ok, buf) = pixbuf.save_to_bufferv('webp', ['quality'], ['100'])
+        return buf
+    raise ValueError('Unknown format ' + name)
+
+
+def chunk(kind, data):
+    '''A PNG chunk of type kind holding data'''
+    crc = zlib.crc32(data, zlib.crc32(kind))
+    return struct.pack('>I', len(data)) + kind + data + struct.pack('>I', crc)
+
+
+def _deflate_band(raw, dictionary, level, last):
+    if dictionary:
+        compressor = zlib.compressobj(level, zlib.DEFLATED, -15,
+                                      zdict=dictionary)
+    else:
+        compressor = zlib.compressobj(level, zlib.DEFLATED, -15)
+    mode = zlib.Z_FINISH if last else zlib.Z_SYNC_FLUSH
+    return compressor.compress(raw) + compressor.flush(mode)
+
+
+def deflate(raw, level=6):
+    '''
+        zlib compress raw, splitting it into bands that are deflated at
+        the same time on the worker pool
+
+        Like pigz each band is primed with the end of the one before it
+        and all but the last end on a byte boundary (Z_SYNC_FLUSH), so
+        gluing them together gives a single valid stream. zlib drops
+        the GIL so this really does use every core.
+    '''
+    view = memoryview(raw)
+    bands = range(0, len(view), BAND_SIZE)
+    futures = []
+    for offset in bands:
+        band = view[offset:offset + BAND_SIZE]
+        dictionary = bytes(view[max(0, offset - WINDOW_SIZE):offset])
+        last = offset + BAND_SIZE >= len(view)
+        futures.append(_get_pool().submit(_deflate_band, band, dictionary,
+                                          level, last))
+    if not futures:
+        futures.append(_get_pool().submit(_deflate_band, b'', b'',
+                                          level, True))
+
+    # FLEVEL in the header is only a hint, but get it right anyway
+    flevel = 0 if level < 2 else 1 if level < 6 else 2 if level == 6 else 3
+    header = 0x7800 | (flevel << 6)
+    header += 31 - header % 31
+    body = b''.join(f.result() for f in futures)
+    return struct.pack('>H', header) + body + \
+        struct.pack('>I', zlib.adler32(view))
+
+
+PNG_SIGNATURE = b'\x89PNG\r\n\x1a\n'
+
+
+def scanlines(pixbuf):
+    '''pixbuf's rows as PNG scanlines, ready to deflate'''
+    stride = pixbuf.props.rowstride
+    pixels = pixbuf.read_pixel_bytes().get_data()
+    row = pixbuf.props.width * pixbuf.props.n_channels
+    # Every scanline gets filter type 0 (none), other filters compress
+    # photos better but cost a pass over every byte in Python
+    return b''.join(b'\0' + pixels[y * stride:y * stride + row]
+                    for y in range(pixbuf.props.height))
+
+
+def png_header(width, height, has_alpha):
+    '''The signature and IHDR chunk'''
+    colour = 6 if has_alpha else 2
+    ihdr = struct.pack('>IIBBBBB', width, height, 8, colour, 0, 0, 0)
+    return PNG_SIGNATURE + chunk(b'IHDR', ihdr)
+
+
+def encode_png(pixbuf, level=6):
+    '''Write pixbuf as a PNG using every core to compress it'''
+    return png_header(pixbuf.props.width, pixbuf.props.height,
+                      pixbuf.props.has_alpha) + \
+        chunk(b'IDAT', deflate(scanlines(pixbuf), level)) + \
+        chunk(b'IEND', b'')
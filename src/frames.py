@@ -0,0 +1,91 @@
+# frames.py
+#
+# Copyright 2018 Zander Brown
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+from gi.repository import Gtk, Gio, GLib
+from .gi_composites import GtkTemplate
+
+
+@GtkTemplate(ui='/org/gnome/Kasbah/frames.ui')
+class KasbahFrames(Gtk.ApplicationWindow):
+    '''
+        Pick one of the frames the FrameRing was holding when this
+        opened and hand it to KasbahSave
+    '''
+
+    __gtype_name__ = 'KasbahFrames'
+
+    preview = GtkTemplate.Child()
+    scale = GtkTemplate.Child()
+    when = GtkTemplate.Child()
+
+    def __init__(self, frames, **kwargs):
+        super().__init__(**kwargs)
+        self.init_template()
+        # Our own copy, the ring carries on without us
+        self.frames = frames
+        self.opened = GLib.get_monotonic_time()
+        self.cancellable = None
+
+        action = Gio.SimpleAction.new("cancel", None)
+        action.connect("activate", lambda a, p: self.destroy())
+        self.add_action(action)
+
+        action = Gio.SimpleAction.new("use", None)
+        action.connect("activate", self.on_use)
+        action.set_enabled(bool(frames))
+        self.add_action(action)
+
+        self.connect('destroy', self.on_destroy)
+        adjustment = self.scale.get_adjustment()
+        adjustment.props.upper = max(0, len(frames) - 1)
+        if frames:
+            # Start on the newest
+            adjustment.props.value = len(frames) - 1
+            self.on_scale(self.scale)
+        else:
+            self.when.props.label = _('No recent frames')
+
+    def on_destroy(self, win):
+        if self.cancellable is not None:
+            self.cancellable.cancel()
+
+    def current(self):
+        return self.frames[int(self.scale.get_value())]
+
+    @GtkTemplate.Callback
+    def on_scale(self, scale):
+        frame = self.current()
+        ago = (self.opened - frame.time) / GLib.USEC_PER_SEC
+        self.when.props.label = _('{:.1f} seconds ago').format(ago)
+        # Only the preview of the frame last asked for matters
+        if self.cancellable is not None:
+            self.cancellable.cancel()
+        self.cancellable = Gio.Cancellable()
+        frame.to_capture().thumbnail_async(640, self.cancellable,
+                                           self.on_thumbnail)
+
+    def on_thumbnail(self, pixbuf):
+        if pixbuf is not None:
+            self.preview.props.pixbuf = pixbuf
+
+    def on_use(self, act, p):
+        from .save import KasbahSave
+
+        KasbahSave(self.current().to_capture(),
+                   transient_for=self.props.transient_for,
+                   application=self.props.application).show()
+        self.destroy()
@@ -18,7 +18,6 @@
 
 from os.path import abspath, join
 
-import inspect
 import warnings
 
 from gi.repository import Gio
@@ -28,6 +27,10 @@ from gi.repository import Gtk
 
 __all__ = ['GtkTemplate']
 
+# Resolved through introspection once, not for every child of every
+# instance
+_get_template_child = Gtk.Widget.get_template_child
+
 class GtkTemplateWarning(UserWarning):
     pass
 
@@ -75,26 +78,32 @@ def _register_template(cls, template_bytes):
     bound_methods = set()
     bound_widgets = set()
 
-    # Walk the class, find marked callbacks and child attributes
-    for name in dir(cls):
-
-        o = getattr(cls, name, None)
-
-        if inspect.ismethod(o):
-            if hasattr(o, '_gtk_callback'):
+    # Only look at what Python classes define. dir() would also list
+    # every GI attribute of the widget, and resolving those through
+    # introspection is most of the cost of registering a template.
+    seen = set()
+    for klass in cls.__mro__:
+        if klass is object or klass.__module__.startswith('gi.'):
+            continue
+        for (name, o) in klass.__dict__.items():
+            if name in seen:
+                continue
+            seen.add(name)
+
+            if callable(o) and hasattr(o, '_gtk_callback'):
                 bound_methods.add(name)
                 # Don't need to call this, as connect_func always gets called
                 #cls.bind_template_callback_full(name, o)
-        elif isinstance(o, _Child):
-            cls.bind_template_child_full(name, True, 0)
-            bound_widgets.add(name)
+            elif isinstance(o, _Child):
+                cls.bind_template_child_full(name, True, 0)
+                bound_widgets.add(name)
 
     # Have to setup a special connect function to connect at template init
     # because the methods are not bound yet
     cls.set_connect_func(_connect_func, cls)
 
-    cls.__gtemplate_methods__ = bound_methods
-    cls.__gtemplate_widgets__ = bound_widgets
+    cls.__gtemplate_methods__ = frozenset(bound_methods)
+    cls.__gtemplate_widgets__ = tuple(sorted(bound_widgets))
 
     base_init_template = cls.init_template
     cls.init_template = lambda s: _init_template(s, cls, base_init_template)
@@ -114,10 +123,12 @@ def _init_template(self, cls, base_init_template):
 
     base_init_template(self)
 
-    for name in self.__gtemplate_widgets__:
-        widget = self.get_template_child(cls, name)
-        self.__dict__[name] = widget
-
+    # Each instance has its own children, so they are fetched each time,
+    # but nothing about which ones or how is worked out again
+    children = {name: _get_template_child(self, cls, name)
+                for name in cls.__gtemplate_widgets__}
+    self.__dict__.update(children)
+    for widget in children.values():
         if widget is None:
             # Bug: if you bind a template child, and one of them was
             #      not present, then the whole template is broken (and
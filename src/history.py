@@ -0,0 +1,319 @@
+# history.py
+#
+# Copyright 2018 Zander Brown
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+from gi.repository import GLib, GdkPixbuf
+
+from concurrent.futures import ThreadPoolExecutor
+
+import hashlib
+import os
+import sqlite3
+import warnings
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS captures (
+    id INTEGER PRIMARY KEY,
+    path TEXT NOT NULL,
+    time INTEGER NOT NULL,
+    mode TEXT,
+    width INTEGER,
+    height INTEGER,
+    hash TEXT
+);
+CREATE INDEX IF NOT EXISTS captures_by_time ON captures (time DESC, id DESC);
+CREATE INDEX IF NOT EXISTS captures_by_hash ON captures (hash);
+'''
+
+# Run in order on databases from older versions, user_version says how
+# many have been applied
+MIGRATIONS = [
+    # Dedup: what was captured (see dedup.fingerprint) and the entry a
+    # symlinked copy refers to
+    '''
+    ALTER TABLE captures ADD COLUMN content TEXT;
+    ALTER TABLE captures ADD COLUMN dhash INTEGER;
+    ALTER TABLE captures ADD COLUMN ref INTEGER;
+    CREATE INDEX captures_by_content ON captures (content);
+    ''',
+]
+
+COLUMNS = 'id, path, time, mode, width, height, hash, content, dhash, ref'
+
+# How many of the newest entries a capture is compared with
+RECENT = 512
+
+# freedesktop.org thumbnail sizes
+NORMAL = ('normal', 128)
+LARGE = ('large', 256)
+
+
+def _idle(callback, *args):
+    '''Run callback(*args) once on the main loop'''
+    def run():
+        callback(*args)
+        return GLib.SOURCE_REMOVE
+    GLib.idle_add(run)
+
+
+def _signed(value):
+    '''SQLite integers are signed 64 bit, hashes aren't'''
+    return value - (1 << 64) if value >= (1 << 63) else value
+
+
+class Entry(object):
+    def __init__(self, row):
+        (self.id, self.path, self.time, self.mode, self.width, self.height,
+         self.hash, self.content, self.dhash, self.ref) = row
+        if self.dhash is not None:
+            self.dhash &= (1 << 64) - 1
+
+
+def thumbnail_path(path, flavour=NORMAL):
+    '''Where the thumbnail spec says path's thumbnail lives'''
+    uri = GLib.filename_to_uri(path, None)
+    name = hashlib.md5(uri.encode()).hexdigest() + '.png'
+    return GLib.build_filenamev([GLib.get_user_cache_dir(), 'thumbnails',
+                                 flavour[0], name])
+
+
+def _fresh_thumbnail(path, flavour=NORMAL):
+    '''path's spec thumbnail if there is one and it's up to date'''
+    try:
+        pixbuf = GdkPixbuf.Pixbuf.new_from_file(thumbnail_path(path,
+                                                               flavour))
+        if pixbuf.get_option('tEXt::Thumb::MTime') == \
+                str(int(os.stat(path).st_mtime)):
+            return pixbuf
+    except (GLib.Error, OSError):
+        pass
+    return None
+
+
+def write_thumbnail(path, pixbuf=None, flavour=NORMAL):
+    '''
+        Make the spec thumbnail for path, from pixbuf if we already have
+        a small copy (the save preview) so the image needn't be decoded
+    '''
+    size = flavour[1]
+    if pixbuf is None:
+        pixbuf = _fresh_thumbnail(path, LARGE)
+    if pixbuf is None:
+        # Nothing smaller to go on, the whole image has to be decoded
+        pixbuf = GdkPixbuf.Pixbuf.new_from_file_at_scale(path, size, size,
+                                                         True)
+    elif pixbuf.props.width > size or pixbuf.props.height > size:
+        scale = size / max(pixbuf.props.width, pixbuf.props.height)
+        pixbuf = pixbuf.scale_simple(
+            max(1, round(pixbuf.props.width * scale)),
+            max(1, round(pixbuf.props.height * scale)),
+            GdkPixbuf.InterpType.BILINEAR)
+    uri = GLib.filename_to_uri(path, None)
+    mtime = str(int(os.stat(path).st_mtime))
+    target = thumbnail_path(path, flavour)
+    GLib.mkdir_with_parents(GLib.path_get_dirname(target), 0o700)
+    # Written aside and renamed, as the spec asks, so readers never
+    # see half a thumbnail
+    partial = '{}.kasbah-{}'.format(target, os.getpid())
+    pixbuf.savev(partial, 'png',
+                 ['tEXt::Thumb::URI', 'tEXt::Thumb::MTime',
+                  'tEXt::Software'],
+                 [uri, mtime, 'Kasbah'])
+    os.rename(partial, target)
+    return pixbuf
+
+
+def file_hash(path):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as source:
+        for block in iter(lambda: source.read(1024 * 1024), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+class History(object):
+    '''
+        Every saved screenshot, in an SQLite index in the data dir
+
+        Writes (hashing, thumbnailing and inserting) happen on worker
+        threads, reads are small indexed pages done on the caller's
+        thread. Nothing here decodes a full size image unless there's
+        no thumbnail to be had any other way.
+    '''
+
+    def __init__(self, filename=None):
+        if filename is None:
+            folder = GLib.build_filenamev([GLib.get_user_data_dir(),
+                                           'kasbah'])
+            GLib.mkdir_with_parents(folder, 0o700)
+            filename = GLib.build_filenamev([folder, 'history.db'])
+        self.filename = filename
+        self.db = self._connect()
+        self.db.executescript(SCHEMA)
+        self._migrate()
+        # One writer, so inserts never fight over the database
+        self.writer = ThreadPoolExecutor(max_workers=1)
+        self.thumbnailers = ThreadPoolExecutor(
+            max_workers=os.cpu_count() or 1)
+        self.writer_db = None
+
+    def _connect(self):
+        db = sqlite3.connect(self.filename, check_same_thread=False)
+        db.execute('PRAGMA journal_mode=WAL')
+        return db
+
+    def _migrate(self):
+        version = self.db.execute('PRAGMA user_version').fetchone()[0]
+        for (number, script) in enumerate(MIGRATIONS[version:], version + 1):
+            with self.db:
+                self.db.executescript(script)
+                self.db.execute('PRAGMA user_version = {}'.format(number))
+
+    def _get_writer_db(self):
+        '''The writer thread's own connection'''
+        if self.writer_db is None:
+            self.writer_db = self._connect()
+        return self.writer_db
+
+    def record(self, path, capture, thumbnail=None, callback=None,
+               original=None):
+        '''
+            Add path (just saved from capture) to the index. thumbnail
+            is a small copy if there is one. original is the Entry path
+            links to when it's a duplicate. callback gets the new Entry
+            on the main loop.
+
+            The fingerprint is only stored if dedup already worked it
+            out (see find_duplicate), saving never decodes for it.
+        '''
+        (width, height) = capture.get_size()
+
+        def insert():
+            db = self._get_writer_db()
+            found = getattr(capture, 'fingerprint', None)
+            try:
+                if found is None and original is not None:
+                    from . import dedup
+                    found = dedup.fingerprint(capture)
+                if original is not None:
+                    digest = original.hash
+                    ref = original.ref or original.id
+                else:
+                    digest = file_hash(path)
+                    ref = None
+                row = (path, int(os.lstat(path).st_mtime), capture.mode,
+                       width, height, digest,
+                       found.content if found is not None else None,
+                       _signed(found.dhash) if found is not None else None,
+                       ref)
+            except (OSError, GLib.Error) as err:
+                warnings.warn('Failed to record {}: {}'.format(path, err))
+                return
+            with db:
+                cursor = db.execute(
+                    'INSERT INTO captures (path, time, mode, width, height,'
+                    ' hash, content, dhash, ref)'
+                    ' VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)', row)
+            if callback is not None:
+                _idle(callback, Entry((cursor.lastrowid,) + row))
+
+        self.writer.submit(insert)
+        if thumbnail is None:
+            # Scaling pixels we still have beats decoding the file
+            thumbnail = capture.loaded_pixbuf()
+        if thumbnail is not None:
+            self.thumbnailers.submit(self._thumbnail, path, thumbnail)
+        # Otherwise it's made when the history is next looked at
+
+    def _thumbnail(self, path, pixbuf=None):
+        try:
+            return write_thumbnail(path, pixbuf)
+        except (GLib.Error, OSError) as err:
+            warnings.warn('Failed to thumbnail {}: {}'.format(path, err))
+
+    def count(self):
+        return self.db.execute('SELECT COUNT(*) FROM captures').fetchone()[0]
+
+    def page(self, after=None, limit=100):
+        '''
+            The next limit entries, newest first, after the Entry after.
+            Keyset rather than OFFSET so later pages are as quick as the
+            first.
+        '''
+        query = 'SELECT ' + COLUMNS + ' FROM captures'
+        params = ()
+        if after is not None:
+            query += ' WHERE (time, id) < (?, ?)'
+            params = (after.time, after.id)
+        query += ' ORDER BY time DESC, id DESC LIMIT ?'
+        return [Entry(row) for row in
+                self.db.execute(query, params + (limit,))]
+
+    def find_duplicate(self, capture, extension, threshold, callback):
+        '''
+            callback gets the newest Entry, with a file ending in
+            extension that still exists, that capture is an exact copy
+            of or whose dHash is within threshold bits of capture's, or
+            None, on the main loop
+
+            Runs on the writer thread so a capture recorded just before
+            is always seen.
+        '''
+        def usable(entry):
+            return entry.path.endswith(extension) and \
+                os.path.exists(entry.path)
+
+        # Not at the top, it brings NumPy in with it
+        from . import dedup
+
+        def search():
+            db = self._get_writer_db()
+            try:
+                found = dedup.fingerprint(capture)
+            except GLib.Error as err:
+                warnings.warn('Failed to fingerprint capture: {}'.format(err))
+                _idle(callback, None)
+                return
+            query = 'SELECT ' + COLUMNS + ' FROM captures WHERE {} ' \
+                    'ORDER BY time DESC, id DESC LIMIT ?'
+            same = [Entry(row) for row in db.execute(
+                query.format('content = ?'), (found.content, RECENT))]
+            match = next((e for e in same if usable(e)), None)
+            if match is None:
+                recent = [Entry(row) for row in db.execute(
+                    query.format('dhash IS NOT NULL'), (RECENT,))]
+                recent = [e for e in recent if e.path.endswith(extension)]
+                (index, bits) = dedup.nearest(found.dhash,
+                                              [e.dhash for e in recent])
+                if index is not None and bits <= threshold and \
+                        usable(recent[index]):
+                    match = recent[index]
+            _idle(callback, match)
+
+        self.writer.submit(search)
+
+    def thumbnail_async(self, entry, callback):
+        '''
+            callback gets entry's thumbnail (or None) on the main loop,
+            using the cached one if it's still fresh
+        '''
+        def work():
+            pixbuf = _fresh_thumbnail(entry.path)
+            if pixbuf is None and os.path.exists(entry.path):
+                pixbuf = self._thumbnail(entry.path)
+            _idle(callback, pixbuf)
+
+        self.thumbnailers.submit(work)
@@ -0,0 +1,106 @@
+# historyview.py
+#
+# Copyright 2018 Zander Brown
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+from gi.repository import Gtk, Gio, GLib, Pango
+from .gi_composites import GtkTemplate
+
+import warnings
+
+# Rows added each time the bottom is reached
+PAGE_SIZE = 100
+
+
+@GtkTemplate(ui='/org/gnome/Kasbah/history.ui')
+class KasbahHistory(Gtk.ApplicationWindow):
+    '''
+        Browses the history a page at a time, so opening it costs the
+        same with fifty entries or fifty thousand. Thumbnails come from
+        the thumbnail cache on worker threads as rows are added.
+    '''
+
+    __gtype_name__ = 'KasbahHistory'
+
+    header = GtkTemplate.Child()
+    scrolled = GtkTemplate.Child()
+    listbox = GtkTemplate.Child()
+
+    def __init__(self, history, **kwargs):
+        super().__init__(**kwargs)
+        self.init_template()
+        self.history = history
+        self.last = None
+        self.done = False
+
+        count = history.count()
+        self.header.props.subtitle = \
+            _('{} screenshots').format(count) if count else None
+        self.load_page()
+
+    def load_page(self):
+        if self.done:
+            return
+        entries = self.history.page(self.last, PAGE_SIZE)
+        if len(entries) < PAGE_SIZE:
+            self.done = True
+        for entry in entries:
+            self.listbox.add(self.make_row(entry))
+        if entries:
+            self.last = entries[-1]
+
+    def make_row(self, entry):
+        row = Gtk.ListBoxRow(visible=True)
+        row.entry = entry
+        box = Gtk.Box(spacing=12, border_width=6, visible=True)
+        image = Gtk.Image(icon_name='image-x-generic-symbolic',
+                          pixel_size=64, width_request=128,
+                          height_request=72, visible=True)
+        box.pack_start(image, False, False, 0)
+
+        labels = Gtk.Box(orientation=Gtk.Orientation.VERTICAL,
+                         valign=Gtk.Align.CENTER, spacing=3, visible=True)
+        name = Gtk.Label(label=GLib.path_get_basename(entry.path),
+                         ellipsize=Pango.EllipsizeMode.MIDDLE,
+                         xalign=0, visible=True)
+        when = GLib.DateTime.new_from_unix_local(entry.time)
+        details = _('{width}×{height}, {time}').format(
+            width=entry.width, height=entry.height,
+            time=when.format('%x %X'))
+        info = Gtk.Label(label=details, xalign=0, visible=True)
+        info.get_style_context().add_class('dim-label')
+        labels.pack_start(name, False, False, 0)
+        labels.pack_start(info, False, False, 0)
+        box.pack_start(labels, True, True, 0)
+        row.add(box)
+
+        def loaded(pixbuf):
+            if pixbuf is not None:
+                image.props.pixbuf = pixbuf
+        self.history.thumbnail_async(entry, loaded)
+        return row
+
+    @GtkTemplate.Callback
+    def on_edge(self, scrolled, pos):
+        if pos == Gtk.PositionType.BOTTOM:
+            self.load_page()
+
+    @GtkTemplate.Callback
+    def on_row_activated(self, listbox, row):
+        uri = GLib.filename_to_uri(row.entry.path, None)
+        try:
+            Gio.AppInfo.launch_default_for_uri(uri, None)
+        except GLib.Error as err:
+            warnings.warn('Failed to open {}: {}'.format(uri, err.message))
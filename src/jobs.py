@@ -0,0 +1,96 @@
+# jobs.py
+#
+# Copyright 2018 Zander Brown
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+from gi.repository import GObject
+
+from .backend import CaptureError, new_backend
+from . import trace
+
+from collections import deque
+
+
+class CaptureJob(object):
+    def __init__(self, mode, callback, options):
+        self.mode = mode
+        self.callback = callback
+        self.options = options
+        self.queued = trace.begin('queued')
+
+
+class CaptureQueue(GObject.Object):
+    '''
+        Every capture in the application goes through here
+
+        Up to max-concurrent-captures run at once (including any that
+        are still counting down their delay) and up to queue-depth more
+        wait their turn, anything past that is refused. Each job gets
+        its own Capture and callback, so nothing is shared between them.
+    '''
+
+    __gtype_name__ = 'KasbahCaptureQueue'
+
+    def __init__(self, settings):
+        super().__init__()
+        self.settings = settings
+        self.backend = None
+        self.waiting = deque()
+        self._running = 0
+
+    @GObject.Property(type=int, nick='Captures in progress')
+    def running(self):
+        return self._running
+
+    def _get_backend(self):
+        name = self.settings.get_string('backend')
+        if self.backend is None or self.backend.name != name:
+            self.backend = new_backend(name)
+        return self.backend
+
+    def submit(self, mode, callback, **options):
+        '''
+            Queue a capture, callback gets (capture, error, elapsed) like
+            CaptureBackend.capture. Returns False if the queue is full.
+        '''
+        limit = self.settings.get_int('max-concurrent-captures')
+        depth = self.settings.get_int('queue-depth')
+        # A free slot takes the job straight away, whatever the depth
+        if self._running >= limit and len(self.waiting) >= depth:
+            error = CaptureError(_('Too many screenshots are waiting'))
+            callback(None, error, 0)
+            return False
+        self.waiting.append(CaptureJob(mode, callback, options))
+        self._next()
+        return True
+
+    def _next(self):
+        limit = self.settings.get_int('max-concurrent-captures')
+        while self.waiting and self._running < limit:
+            job = self.waiting.popleft()
+            job.queued.end()
+            self._running += 1
+            self.notify('running')
+            self._get_backend().capture(job.mode,
+                                        self._finisher(job),
+                                        **job.options)
+
+    def _finisher(self, job):
+        def done(capture, error, elapsed):
+            self._running -= 1
+            self.notify('running')
+            job.callback(capture, error, elapsed)
+            self._next()
+        return done
@@ -15,30 +15,350 @@
 # You should have received a copy of the GNU Affero General Public License
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
+import os
 import sys
+import warnings
 import gi
 
 gi.require_version('Gtk', '3.0')
 
 from gi.repository import Gtk, Gio, GLib
 
-from .window import KasbahWindow
+from . import trace
 
 
 class Application(Gtk.Application):
     def __init__(self):
         super().__init__(application_id='org.gnome.Kasbah',
-                         flags=Gio.ApplicationFlags.FLAGS_NONE)
+                         flags=Gio.ApplicationFlags.HANDLES_COMMAND_LINE)
+        self.clipboard = None
+        self.history = None
+        self.tile_store = None
+        self.ring = None
+        self.pixel_store = None
+        self.ring_held = False
+        self.queue = None
+        self.service = None
+        self.settings = Gio.Settings.new('org.gnome.Kasbah')
+
+        flag = GLib.OptionFlags.NONE
+        arg = GLib.OptionArg
+        self.add_main_option('mode', ord('m'), flag, arg.STRING,
+                             _('What to capture: screen, window or area'),
+                             _('MODE'))
+        self.add_main_option('delay', ord('d'), flag, arg.DOUBLE,
+                             _('Seconds to wait before capturing'),
+                             _('SECONDS'))
+        self.add_main_option('pointer', ord('p'), flag, arg.NONE,
+                             _('Include the pointer'), None)
+        self.add_main_option('output', ord('o'), flag, arg.STRING_ARRAY,
+                             _('Where to send the capture without showing '
+                               'a window: a file, - for stdout, clipboard, '
+                               'tiles:FILE for a tile manifest or an '
+                               'http(s) URL to POST to. Can be repeated'),
+                             _('OUTPUT'))
+        self.add_main_option('format', ord('f'), flag, arg.STRING,
+                             _('Image format: png, jpeg or webp'),
+                             _('FORMAT'))
+        self.add_main_option('record', ord('r'), flag, arg.DOUBLE,
+                             _('Record for SECONDS to the --output file '
+                               '(.apng, or anything ffmpeg can write) '
+                               'instead of taking a screenshot'),
+                             _('SECONDS'))
+        self.add_main_option('fps', 0, flag, arg.DOUBLE,
+                             _('Frames a second when recording'),
+                             _('FPS'))
+        self.add_main_option('profile', 0, flag, arg.FILENAME,
+                             _('Write a trace of where the time goes'),
+                             _('FILE'))
+
+    def do_startup(self):
+        Gtk.Application.do_startup(self)
+
+        if self.get_flags() & Gio.ApplicationFlags.IS_SERVICE:
+            # Started by D-Bus activation, stay around for the next
+            # scripted capture rather than paying for startup again.
+            # Started by hand we go when the last window does.
+            self.props.inactivity_timeout = 10 * 60 * 1000
+
+        # gapplication action org.gnome.Kasbah capture "('screen', '/path')"
+        action = Gio.SimpleAction.new('capture', GLib.VariantType('(ss)'))
+        action.connect('activate', self.on_capture)
+        self.add_action(action)
+
+        self.add_action(self.settings.create_action('retro'))
+        # Nothing to import or start unless it's wanted
+        # (and the ring may turn it straight back off while it's made)
+        self.settings.connect('changed::retro', lambda s, k:
+                              s.get_boolean(k) and self.get_ring())
+        if self.settings.get_boolean('retro'):
+            self.get_ring()
+
+    def do_dbus_register(self, connection, object_path):
+        Gtk.Application.do_dbus_register(self, connection, object_path)
+        self.get_service().register(connection, object_path)
+        return True
+
+    def do_dbus_unregister(self, connection, object_path):
+        if self.service is not None:
+            self.service.unregister()
+        Gtk.Application.do_dbus_unregister(self, connection, object_path)
+
+    def do_handle_local_options(self, options):
+        outputs = options.lookup_value('output', GLib.VariantType('as'))
+        profile = options.lookup_value('profile', GLib.VariantType('ay'))
+        if profile is not None:
+            trace.enable(profile.get_bytestring().decode())
+        if profile is not None or \
+                (outputs is not None and '-' in outputs.unpack()):
+            # Only this process can write to our stdout or be traced
+            flags = self.get_flags() | Gio.ApplicationFlags.NON_UNIQUE
+            self.set_flags(flags)
+        return -1
+
+    def do_command_line(self, command_line):
+        options = command_line.get_options_dict().end().unpack()
+        if 'output' not in options:
+            self.activate()
+            return 0
+        if 'record' in options:
+            self.record_headless(command_line, options)
+            return 0
+        if 'format' in options:
+            from .encoder import available_formats
+
+            names = [f.name for f in available_formats()]
+            if options['format'] not in names:
+                printerr(command_line, 'Unknown format {}, try {}'.format(
+                    options['format'], ', '.join(names)))
+                return 1
+        self.capture_headless(command_line, options)
+        return 0
+
+    def capture_headless(self, command_line, options):
+        '''Handle kasbah --output, without any UI'''
+        from .sinks import fan_out, new_sink
+
+        settings = self.settings
+        mode = options.get('mode', settings.get_string('mode'))
+        mode = {'Selection': 'area'}.get(mode, mode).lower()
+        fmt = options.get('format', settings.get_string('format'))
+        cwd = command_line.get_cwd() or GLib.get_current_dir()
+        sinks = [new_sink(self, o, cwd) for o in options['output']]
+        capture_options = {
+            'pointer': options.get('pointer', False),
+            'delay': options.get('delay', 0),
+        }
+        encode_options = {
+            'level': settings.get_int('png-compression'),
+            'quality': settings.get_int('jpeg-quality'),
+        }
+
+        def sent(capture, failed):
+            capture.discard()
+            for (sink, error) in failed:
+                printerr(command_line,
+                         'Failed to write {}: {}'.format(sink, error))
+            command_line.set_exit_status(1 if failed else 0)
+            broken = [sink for (sink, error) in failed]
+            if any(sink.main_thread and sink not in broken for sink in sinks):
+                self.serve_clipboard()
+            self.release()
+
+        def captured(capture, error, elapsed):
+            if error is not None:
+                printerr(command_line, 'Screenshot failed: {}'.format(error))
+                command_line.set_exit_status(1)
+                self.release()
+                return
+            fan_out(capture, fmt, encode_options, sinks,
+                    lambda failed: sent(capture, failed))
+
+        # Held until every sink is done, command_line goes with it
+        self.hold()
+        self.get_service().capture(mode, capture_options, captured)
+
+    def record_headless(self, command_line, options):
+        '''Handle kasbah --record, without any UI'''
+        from .backend import CaptureError, RootWindowBackend
+        from .record import Recorder, find_area, new_writer
+
+        mode = options.get('mode', self.settings.get_string('mode'))
+        mode = {'Selection': 'area'}.get(mode, mode).lower()
+        fps = options.get('fps', 30)
+        cwd = command_line.get_cwd() or GLib.get_current_dir()
+        path = options['output'][0]
+        if not GLib.path_is_absolute(path):
+            path = GLib.build_filenamev([cwd, path])
+
+        def fail(error):
+            printerr(command_line, 'Recording failed: {}'.format(error))
+            command_line.set_exit_status(1)
+            self.release()
+
+        def finished(stats, error):
+            if error is not None:
+                fail(error)
+                return
+            printerr(command_line, str(stats))
+            self.release()
+
+        def found(area):
+            if isinstance(area, Exception):
+                fail(area)
+                return
+            backend = RootWindowBackend()
+            try:
+                # The first frame says whether there's alpha
+                alpha = backend.grab(*area).props.has_alpha
+                writer = new_writer(path, area[2], area[3], alpha, fps)
+            except (OSError, CaptureError) as err:
+                fail(err)
+                return
+            recorder = Recorder(writer, lambda: backend.grab(*area), fps)
+
+            def stop():
+                recorder.stop()
+                return GLib.SOURCE_REMOVE
+
+            recorder.start(finished)
+            GLib.timeout_add(int(options['record'] * 1000), stop)
+
+        def begin():
+            find_area(mode, found)
+            return GLib.SOURCE_REMOVE
+
+        self.hold()
+        GLib.timeout_add(int(options.get('delay', 0) * 1000), begin)
+
+    def serve_clipboard(self):
+        '''Stay running until someone else takes the clipboard'''
+        clipboard = self.get_clipboard()
+
+        def cleared(widget, event):
+            clipboard.disconnect(handler)
+            self.release()
+            return False
+
+        handler = clipboard.connect('selection-clear-event', cleared)
+        self.hold()
+
+    def on_capture(self, act, p):
+        (mode, path) = p.unpack()
+        fmt = self.settings.get_string('format')
+
+        def saved(error):
+            if error is not None:
+                warnings.warn('Failed to save {}: {}'.format(path, error))
+
+        def captured(capture, error, elapsed):
+            if error is not None:
+                warnings.warn('Screenshot failed: {}'.format(error))
+            else:
+                self.get_service().save(capture, path, fmt, saved)
+
+        self.get_service().capture(mode, {}, captured)
+
+    def get_queue(self):
+        '''The CaptureQueue every capture goes through'''
+        if self.queue is None:
+            from .jobs import CaptureQueue
+            self.queue = CaptureQueue(self.settings)
+        return self.queue
+
+    def get_service(self):
+        '''The CaptureService other processes capture through'''
+        if self.service is None:
+            from .service import CaptureService
+            self.service = CaptureService(self)
+        return self.service
+
+    def get_clipboard(self):
+        '''The ClipboardProvider, which lives as long as we do'''
+        if self.clipboard is None:
+            from .clipboard import ClipboardProvider
+            self.clipboard = ClipboardProvider()
+        return self.clipboard
+
+    def get_history(self):
+        '''The screenshot History, opened the first time it's needed'''
+        if self.history is None:
+            from .history import History
+            self.history = History()
+        return self.history
+
+    def get_ring(self):
+        '''
+            The FrameRing, while it's recording the application is held
+            so the frames are there when the window is next opened
+        '''
+        if self.ring is None:
+            from .ring import FrameRing
+            self.ring = FrameRing(self.settings)
+            self.ring.connect('notify::recording', self.on_recording)
+            self.on_recording(self.ring)
+        return self.ring
+
+    def on_recording(self, ring, pspec=None):
+        if ring.props.recording and not self.ring_held:
+            self.hold()
+        elif self.ring_held and not ring.props.recording:
+            self.release()
+        self.ring_held = ring.props.recording
+
+    def get_pixel_store(self):
+        '''The PixelStore keeping open captures under pixel-memory'''
+        if self.pixel_store is None:
+            from .memory import MIB, PixelStore
+            self.pixel_store = PixelStore(
+                self.settings.get_int('pixel-memory') * MIB)
+            self.settings.connect(
+                'changed::pixel-memory', lambda s, k:
+                self.pixel_store.set_budget(s.get_int(k) * MIB))
+        return self.pixel_store
+
+    def get_tile_store(self):
+        '''The TileStore kept between captures so it can compare them'''
+        if self.tile_store is None:
+            from .tiles import TileStore
+            self.tile_store = TileStore()
+        return self.tile_store
 
     def do_activate(self):
         win = self.props.active_window
         if not win:
+            from .window import KasbahWindow
+
             win = KasbahWindow(application=self)
+            probe = GLib.getenv('KASBAH_STARTUP_PROBE')
+            if probe:
+                # For bench startup, write to the fd it gave us when
+                # there's a frame on screen (timed from there, not from
+                # exit) then quit
+                def drawn(w, cr):
+                    win.disconnect(handler)
+                    os.write(int(probe), b'drawn\n')
+                    os.close(int(probe))
+                    GLib.idle_add(self.quit)
+
+                handler = win.connect_after('draw', drawn)
         win.present()
 
 
+def printerr(command_line, message):
+    '''Print message on the stderr of whoever ran command_line'''
+    if hasattr(command_line, 'printerr_literal'):
+        command_line.printerr_literal(message + '\n')
+    else:
+        # GLib < 2.80 has no binding for this, use our own stderr
+        print(message, file=sys.stderr)
+
+
 def main(version):
     app = Application()
+    if GLib.getenv('KASBAH_STARTUP_PROBE'):
+        # Measure a real startup even if Kasbah is already running
+        app.set_flags(app.get_flags() | Gio.ApplicationFlags.NON_UNIQUE)
     Gtk.Window.set_default_icon_name('org.gnome.Kasbah')
     GLib.set_application_name(_('Kasbah'))
     return app.run(sys.argv)
@@ -0,0 +1,185 @@
+# memory.py
+#
+# Copyright 2018 Zander Brown
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+from gi.repository import GLib, GdkPixbuf
+
+from . import trace
+
+from collections import OrderedDict
+
+import threading
+import time
+import warnings
+import zlib
+
+MIB = 1024 * 1024
+
+
+class PixelStats(object):
+    '''
+        A snapshot of a PixelStore: bytes of pixels held as they are and
+        compressed, how many pixbufs have been let go and how
+        many brought back, reload_time being seconds spent on that
+    '''
+
+    def __init__(self, resident, spilled, evictions, reloads, reload_time):
+        self.resident = resident
+        self.spilled = spilled
+        self.evictions = evictions
+        self.reloads = reloads
+        self.reload_time = reload_time
+
+    def __str__(self):
+        mean = self.reload_time / self.reloads if self.reloads else 0
+        return _('{resident:.1f} MiB resident, {spilled:.1f} MiB spilled, '
+                 '{evictions} evictions, {reloads} reloads '
+                 '({mean:.1f} ms each)').format(
+                     resident=self.resident / MIB,
+                     spilled=self.spilled / MIB,
+                     evictions=self.evictions, reloads=self.reloads,
+                     mean=mean * 1000)
+
+
+class PixelStore(object):
+    '''
+        Keeps the decoded pixbufs of the captures added to it under
+        budget bytes between them
+
+        Once over budget the least recently used pixbufs are let go.
+        Captures that still have their encoded data just decode again
+        when they're next needed. The rest (grabbed straight to a
+        pixbuf, edited or cropped) have their pixels compressed and kept
+        that way until they're wanted again, screenshots being mostly
+        flat colour that's a small fraction of the size. Nothing is
+        written anywhere the pixels could outlive us. The most recently
+        used pixbuf is always kept, even if it's over budget on its own.
+    '''
+
+    def __init__(self, budget):
+        self.budget = budget
+        self.lock = threading.Lock()
+        # capture -> bytes, least recently used first
+        self.resident = OrderedDict()
+        self.size = 0
+        # capture -> (compressed, width, height, has_alpha, rowstride)
+        self.spilled = {}
+        self.evictions = 0
+        self.reloads = 0
+        self.reload_time = 0
+
+    def add(self, capture):
+        '''Look after capture's pixbuf from now on'''
+        capture.store = self
+        if capture._pixbuf is not None:
+            self.touch(capture, capture._pixbuf)
+
+    def remove(self, capture):
+        '''Stop looking after capture, once it's finished with'''
+        if not capture.can_decode() and capture.store is self:
+            # Can't be decoded again and the clipboard may still have
+            # it, so pixels only we have go back before we forget them
+            pixbuf = self.reload(capture)
+            if pixbuf is not None:
+                capture._pixbuf = pixbuf
+        with self.lock:
+            self.size -= self.resident.pop(capture, 0)
+            self.spilled.pop(capture, None)
+        capture.store = None
+
+    def set_budget(self, budget):
+        with self.lock:
+            self.budget = budget
+            victims = self._over_budget()
+        self._evict(victims)
+
+    def touch(self, capture, pixbuf):
+        '''capture's pixbuf has just been used, called by Capture'''
+        with self.lock:
+            if capture in self.resident:
+                self.resident.move_to_end(capture)
+                return
+            self.resident[capture] = pixbuf.get_byte_length()
+            self.size += self.resident[capture]
+            victims = self._over_budget()
+        self._evict(victims)
+
+    def _over_budget(self):
+        victims = []
+        while self.size > self.budget and len(self.resident) > 1:
+            (capture, length) = self.resident.popitem(last=False)
+            self.size -= length
+            victims.append((capture, length))
+        return victims
+
+    def _evict(self, victims):
+        for (capture, length) in victims:
+            with trace.span('evict'):
+                try:
+                    if not capture.release(lambda p, c=capture:
+                                           self._write(c, p)):
+                        continue
+                except (MemoryError, zlib.error) as err:
+                    # Still has its pixbuf, so it's just resident again
+                    warnings.warn('Failed to spill pixels: {}'.format(err))
+                    with self.lock:
+                        if capture not in self.resident:
+                            self.resident[capture] = length
+                            self.resident.move_to_end(capture, last=False)
+                            self.size += length
+                    continue
+            with self.lock:
+                self.evictions += 1
+                # Used again while we were getting to it
+                self.size -= self.resident.pop(capture, 0)
+
+    def _write(self, capture, pixbuf):
+        pixels = pixbuf.read_pixel_bytes().get_data()
+        # zlib drops the GIL, and the fastest level already gets most
+        # of what there is from flat colour
+        compressed = zlib.compress(pixels, 1)
+        with self.lock:
+            self.spilled[capture] = (compressed, pixbuf.props.width,
+                                     pixbuf.props.height,
+                                     pixbuf.props.has_alpha,
+                                     pixbuf.props.rowstride)
+
+    def reload(self, capture):
+        '''
+            capture's pixbuf back from its compressed pixels, or None if
+            it wasn't spilled. Called by Capture when it finds it's gone.
+        '''
+        with self.lock:
+            record = self.spilled.pop(capture, None)
+        if record is None:
+            return None
+        start = time.perf_counter()
+        (compressed, width, height, has_alpha, rowstride) = record
+        with trace.span('reload', bytes=len(compressed)):
+            pixels = zlib.decompress(compressed)
+            pixbuf = GdkPixbuf.Pixbuf.new_from_bytes(
+                GLib.Bytes.new(pixels), GdkPixbuf.Colorspace.RGB, has_alpha,
+                8, width, height, rowstride)
+        with self.lock:
+            self.reloads += 1
+            self.reload_time += time.perf_counter() - start
+        return pixbuf
+
+    def stats(self):
+        with self.lock:
+            spilled = sum(len(r[0]) for r in self.spilled.values())
+            return PixelStats(self.size, spilled, self.evictions,
+                              self.reloads, self.reload_time)
@@ -0,0 +1,227 @@
+# overlay.py
+#
+# Copyright 2018 Zander Brown
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+from gi.repository import Gtk, Gdk, Gio, GLib, PangoCairo
+import cairo
+
+from .capture import Capture
+from .encoder import get_format
+
+# Drags smaller than this (in pixels each way) are taken as clicks
+MIN_SIZE = 4
+
+
+class KasbahOverlay(Gtk.Window):
+    '''
+        Selection mode, on a screenshot we already have
+
+        The whole screen is captured once and shown frozen, full screen.
+        Any number of areas can be dragged out over it, each comes back
+        as a Capture of a new_subpixbuf of the one frame, so cropping
+        copies nothing. Return hands them back one by one, Ctrl+S to
+        have them all saved at once, Backspace drops the last area and
+        Escape gives up.
+
+        callback gets (crops, save_all), crops being empty if cancelled.
+    '''
+
+    __gtype_name__ = 'KasbahOverlay'
+
+    def __init__(self, capture, callback, **kwargs):
+        super().__init__(decorated=False, app_paintable=True, **kwargs)
+        self.capture = capture
+        self.callback = callback
+        self.full = capture.pixbuf
+        # Areas in the capture's pixels
+        self.regions = []
+        # The area being dragged out, in window coordinates
+        self.start = None
+        self.end = None
+        self.surface = None
+        self.done = False
+
+        self.add_events(Gdk.EventMask.BUTTON_PRESS_MASK |
+                        Gdk.EventMask.BUTTON_RELEASE_MASK |
+                        Gdk.EventMask.POINTER_MOTION_MASK)
+        self.connect('draw', self.on_draw)
+        self.connect('button-press-event', self.on_press)
+        self.connect('motion-notify-event', self.on_motion)
+        self.connect('button-release-event', self.on_release)
+        self.connect('key-press-event', self.on_key)
+        self.connect('destroy', self.on_destroy)
+        self.fullscreen()
+
+    def _origin(self):
+        '''Where the window's monitor starts, in screen coordinates'''
+        display = self.get_display()
+        monitor = display.get_monitor_at_window(self.get_window())
+        return monitor.get_geometry()
+
+    def _to_pixels(self, x0, y0, x1, y1):
+        '''A window rectangle as (x, y, width, height) in the capture'''
+        scale = self.get_scale_factor()
+        origin = self._origin()
+        (left, right) = sorted((x0, x1))
+        (top, bottom) = sorted((y0, y1))
+        x = max(0, round((left + origin.x) * scale))
+        y = max(0, round((top + origin.y) * scale))
+        width = min(self.full.props.width - x, round((right - left) * scale))
+        height = min(self.full.props.height - y,
+                     round((bottom - top) * scale))
+        return (x, y, width, height)
+
+    def _to_window(self, region):
+        scale = self.get_scale_factor()
+        origin = self._origin()
+        (x, y, width, height) = region
+        return (x / scale - origin.x, y / scale - origin.y,
+                width / scale, height / scale)
+
+    def on_draw(self, win, cr):
+        if self.surface is None:
+            self.surface = Gdk.cairo_surface_create_from_pixbuf(
+                self.full, self.get_scale_factor(), self.get_window())
+        origin = self._origin()
+        cr.set_source_surface(self.surface, -origin.x, -origin.y)
+        cr.paint()
+
+        areas = [self._to_window(r) for r in self.regions]
+        if self.start is not None:
+            areas.append(self._to_window(self._to_pixels(*self.start,
+                                                         *self.end)))
+        # Dim everything but the areas
+        cr.set_fill_rule(cairo.FILL_RULE_EVEN_ODD)
+        cr.rectangle(0, 0, self.get_allocated_width(),
+                     self.get_allocated_height())
+        for area in areas:
+            cr.rectangle(*area)
+        cr.set_source_rgba(0, 0, 0, 0.5)
+        cr.fill()
+
+        cr.set_line_width(1)
+        cr.set_source_rgb(1, 1, 1)
+        for (n, (x, y, width, height)) in enumerate(areas, 1):
+            cr.rectangle(x + 0.5, y + 0.5, width - 1, height - 1)
+            cr.stroke()
+            cr.move_to(x + 4, y + 4)
+            PangoCairo.show_layout(cr, self.create_pango_layout(str(n)))
+
+        hint = _('Drag to select areas. Return to save each, Ctrl+S to '
+                 'save them all, Backspace to undo, Escape to cancel')
+        layout = self.create_pango_layout(hint)
+        (width, height) = layout.get_pixel_size()
+        x = (self.get_allocated_width() - width) / 2
+        cr.set_source_rgba(0, 0, 0, 0.7)
+        cr.rectangle(x - 12, 12, width + 24, height + 12)
+        cr.fill()
+        cr.set_source_rgb(1, 1, 1)
+        cr.move_to(x, 18)
+        PangoCairo.show_layout(cr, layout)
+        return True
+
+    def on_press(self, win, event):
+        if event.button == Gdk.BUTTON_PRIMARY:
+            self.start = self.end = (event.x, event.y)
+        return True
+
+    def on_motion(self, win, event):
+        if self.start is not None:
+            self.end = (event.x, event.y)
+            self.queue_draw()
+        return True
+
+    def on_release(self, win, event):
+        if self.start is None or event.button != Gdk.BUTTON_PRIMARY:
+            return True
+        region = self._to_pixels(*self.start, event.x, event.y)
+        self.start = self.end = None
+        if region[2] >= MIN_SIZE and region[3] >= MIN_SIZE:
+            self.regions.append(region)
+        self.queue_draw()
+        return True
+
+    def on_key(self, win, event):
+        ctrl = event.state & Gdk.ModifierType.CONTROL_MASK
+        if event.keyval == Gdk.KEY_Escape:
+            self.finish(False, cancel=True)
+        elif event.keyval == Gdk.KEY_BackSpace and self.regions:
+            self.regions.pop()
+            self.queue_draw()
+        elif event.keyval in (Gdk.KEY_Return, Gdk.KEY_KP_Enter):
+            self.finish(False)
+        elif ctrl and event.keyval in (Gdk.KEY_s, Gdk.KEY_S):
+            self.finish(True)
+        return True
+
+    def crops(self):
+        '''A Capture for each area, sharing the full frame's pixels'''
+        crops = []
+        for (x, y, width, height) in self.regions:
+            crop = Capture(pixbuf=self.full.new_subpixbuf(x, y,
+                                                          width, height))
+            crop.mode = 'Selection'
+            crops.append(crop)
+        return crops
+
+    def finish(self, save_all, cancel=False):
+        if not cancel and not self.regions:
+            return
+        self.done = True
+        crops = [] if cancel else self.crops()
+        self.destroy()
+        self.callback(crops, save_all)
+
+    def on_destroy(self, win):
+        self.capture.discard()
+        if not self.done:
+            self.done = True
+            self.callback([], False)
+
+
+def save_all(app, crops, callback):
+    '''
+        Save every crop to the Pictures folder in the format setting at
+        once, named like KasbahSave would. callback gets a list of the
+        errors.
+    '''
+    settings = app.settings
+    fmt = settings.get_string('format')
+    options = {
+        'level': settings.get_int('png-compression'),
+        'quality': settings.get_int('jpeg-quality'),
+    }
+    folder = GLib.get_user_special_dir(GLib.UserDirectory.DIRECTORY_PICTURES)
+    time = GLib.DateTime.new_now_local().format('%Y-%m-%d %H-%M-%S')
+    errors = []
+    remaining = [len(crops)]
+
+    def saved(crop, path, error):
+        if error is None:
+            app.get_history().record(path, crop)
+        else:
+            errors.append(error)
+        remaining[0] -= 1
+        if remaining[0] == 0:
+            callback(errors)
+
+    for (n, crop) in enumerate(crops, 1):
+        name = _('Screenshot from {} ({}){}').format(
+            time, n, get_format(fmt).extension)
+        path = GLib.build_filenamev([folder, name])
+        crop.save_async(path, fmt, options, Gio.Cancellable(),
+                        lambda written, total: GLib.SOURCE_REMOVE,
+                        lambda error, c=crop, p=path: saved(c, p, error))
@@ -0,0 +1,49 @@
+# pixels.py
+#
+# Copyright 2018 Zander Brown
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+# Pixbufs as NumPy arrays, for the parts of Kasbah that work on whole
+# images at once. NumPy is optional, check numpy isn't None first.
+
+from gi.repository import GLib, GdkPixbuf
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+
+def as_array(pixbuf):
+    '''
+        pixbuf's pixels as a read only (height, width, channels) array
+        of uint8, a view rather than a copy where gdk-pixbuf allows it
+    '''
+    buf = numpy.frombuffer(pixbuf.read_pixel_bytes().get_data(),
+                           dtype=numpy.uint8)
+    n = pixbuf.props.n_channels
+    # The last row needn't be padded out to rowstride
+    return numpy.lib.stride_tricks.as_strided(
+        buf, shape=(pixbuf.props.height, pixbuf.props.width, n),
+        strides=(pixbuf.props.rowstride, n, 1), writeable=False)
+
+
+def to_pixbuf(array):
+    '''A new pixbuf holding the (height, width, 3 or 4) array'''
+    array = numpy.ascontiguousarray(array, dtype=numpy.uint8)
+    (height, width, n) = array.shape
+    return GdkPixbuf.Pixbuf.new_from_bytes(GLib.Bytes.new(array.tobytes()),
+                                           GdkPixbuf.Colorspace.RGB, n == 4,
+                                           8, width, height, width * n)
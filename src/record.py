@@ -0,0 +1,281 @@
+# record.py
+#
+# Copyright 2018 Zander Brown
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+# Recording an area of the screen to an animated PNG, or through ffmpeg
+# to anything it can write, without holding more than a few frames.
+#
+#     kasbah --record 10 --mode window --output demo.apng
+
+from gi.repository import GLib
+
+from .backend import CaptureError, RootWindowBackend, ShellBackend
+from .encoder import chunk, deflate, png_header, scanlines
+from . import trace
+
+from concurrent.futures import ThreadPoolExecutor
+
+import os
+import queue
+import resource
+import struct
+import subprocess
+import threading
+import time
+
+
+class ApngWriter(object):
+    '''
+        Streams an animated PNG to path a frame at a time. encode can
+        run on several threads at once, write and close have to be
+        called from one, with the frames in order.
+    '''
+
+    def __init__(self, path, width, height, has_alpha, fps, level=1):
+        self.width = width
+        self.height = height
+        self.level = level
+        self.sequence = 0
+        self.frames = 0
+        self.out = open(path, 'wb')
+        self.out.write(png_header(width, height, has_alpha))
+        # The frame count isn't known until the end, close fills it in
+        self.actl = self.out.tell()
+        self.out.write(chunk(b'acTL', struct.pack('>II', 0, 0)))
+
+    def encode(self, pixbuf):
+        return deflate(scanlines(pixbuf), self.level)
+
+    def write(self, data, delay):
+        '''Add a frame, shown for delay seconds'''
+        delay = min(0xffff, max(1, round(delay * 1000)))
+        fctl = struct.pack('>IIIIIHHBB', self.sequence, self.width,
+                           self.height, 0, 0, delay, 1000, 0, 0)
+        self.out.write(chunk(b'fcTL', fctl))
+        self.sequence += 1
+        if self.frames == 0:
+            # The first frame doubles as the still image
+            self.out.write(chunk(b'IDAT', data))
+        else:
+            self.out.write(chunk(b'fdAT',
+                                 struct.pack('>I', self.sequence) + data))
+            self.sequence += 1
+        self.frames += 1
+
+    def close(self):
+        self.out.write(chunk(b'IEND', b''))
+        self.out.seek(self.actl)
+        self.out.write(chunk(b'acTL', struct.pack('>II', self.frames, 0)))
+        self.out.close()
+
+
+class ProcessWriter(object):
+    '''
+        Pipes raw frames to ffmpeg, which encodes them as whatever
+        path's extension says (WebM, MP4, GIF, animated WebP...)
+    '''
+
+    def __init__(self, path, width, height, has_alpha, fps):
+        program = GLib.find_program_in_path('ffmpeg')
+        if program is None:
+            raise CaptureError(_('Recording to {} needs ffmpeg')
+                               .format(os.path.basename(path)))
+        self.fps = fps
+        self.row = width * (4 if has_alpha else 3)
+        self.process = subprocess.Popen(
+            [program, '-loglevel', 'error', '-y',
+             '-f', 'rawvideo', '-pix_fmt', 'rgba' if has_alpha else 'rgb24',
+             '-s', '{}x{}'.format(width, height), '-framerate', str(fps),
+             '-i', '-', path],
+            stdin=subprocess.PIPE)
+
+    def encode(self, pixbuf):
+        pixels = pixbuf.read_pixel_bytes().get_data()
+        stride = pixbuf.props.rowstride
+        if stride == self.row:
+            return pixels[:self.row * pixbuf.props.height]
+        return b''.join(pixels[y * stride:y * stride + self.row]
+                        for y in range(pixbuf.props.height))
+
+    def write(self, data, delay):
+        # Constant frame rate, so repeat a frame to cover any dropped
+        for i in range(max(1, round(delay * self.fps))):
+            self.process.stdin.write(data)
+
+    def close(self):
+        self.process.stdin.close()
+        if self.process.wait() != 0:
+            raise CaptureError(_('ffmpeg failed'))
+
+
+def new_writer(path, width, height, has_alpha, fps):
+    '''APNG for .png and .apng, ffmpeg for anything else'''
+    if os.path.splitext(path)[1].lower() in ('.png', '.apng'):
+        return ApngWriter(path, width, height, has_alpha, fps)
+    return ProcessWriter(path, width, height, has_alpha, fps)
+
+
+def find_area(mode, callback):
+    '''
+        callback gets the (x, y, width, height) to record for mode
+        (screen, window or area) or a CaptureError
+    '''
+    from gi.repository import Gdk
+
+    if not RootWindowBackend.available():
+        callback(CaptureError(_('Recording needs an X11 session')))
+        return
+    screen = Gdk.Screen.get_default()
+    if mode == 'window':
+        window = screen.get_active_window()
+        if window is None:
+            callback(CaptureError(_('No window is focused')))
+            return
+        extents = window.get_frame_extents()
+        callback((extents.x, extents.y, extents.width, extents.height))
+    elif mode == 'area':
+        try:
+            ShellBackend().select_area(callback)
+        except CaptureError as err:
+            callback(err)
+    else:
+        root = screen.get_root_window()
+        callback((0, 0, root.get_width(), root.get_height()))
+
+
+class Stats(object):
+    '''How a recording went, cpu is seconds of CPU time used'''
+
+    def __init__(self, frames, dropped, elapsed, cpu):
+        self.frames = frames
+        self.dropped = dropped
+        self.elapsed = elapsed
+        self.cpu = cpu
+
+    def __str__(self):
+        return _('{frames} frames, {dropped} dropped, {cpu:.0f}% CPU') \
+            .format(frames=self.frames, dropped=self.dropped,
+                    cpu=100 * self.cpu / max(self.elapsed, 1e-6))
+
+
+def _cpu_time():
+    usage = (resource.getrusage(resource.RUSAGE_SELF),
+             resource.getrusage(resource.RUSAGE_CHILDREN))
+    return sum(u.ru_utime + u.ru_stime for u in usage)
+
+
+class Recorder(object):
+    '''
+        Calls grab (which returns a pixbuf) fps times a second and
+        streams the frames into writer
+
+        Grabbing happens on the main loop, encoding on a pool of
+        workers, writing on a thread of its own. At most backlog frames
+        are in flight, a tick with none free is dropped, so memory stays
+        flat however long the recording goes on. Each frame is shown
+        until the next one was grabbed, so drops don't speed things up.
+    '''
+
+    def __init__(self, writer, grab, fps, workers=None, backlog=None):
+        self.writer = writer
+        self.grab = grab
+        self.fps = fps
+        workers = workers or max(2, (os.cpu_count() or 1) // 2)
+        self.pool = ThreadPoolExecutor(max_workers=workers)
+        self.slots = threading.BoundedSemaphore(backlog or workers * 2)
+        self.queue = queue.Queue()
+        self.frames = 0
+        self.dropped = 0
+        self.error = None
+        self.timer = None
+        self.callback = None
+
+    def start(self, callback):
+        '''
+            Start grabbing, callback gets (Stats, error) once the file
+            is finished, after stop or when something goes wrong
+        '''
+        self.callback = callback
+        self.started = time.perf_counter()
+        self.cpu = _cpu_time()
+        threading.Thread(target=self._drain, daemon=True).start()
+        self.timer = GLib.timeout_add(max(1, round(1000 / self.fps)),
+                                      self._tick)
+
+    def stop(self):
+        if self.timer is not None:
+            GLib.source_remove(self.timer)
+            self.timer = None
+            self.queue.put(None)
+
+    def _tick(self):
+        if not self.slots.acquire(blocking=False):
+            self.dropped += 1
+            return GLib.SOURCE_CONTINUE
+        try:
+            pixbuf = self.grab()
+        except CaptureError as err:
+            self.slots.release()
+            self.error = err
+            self.timer = None
+            self.queue.put(None)
+            return GLib.SOURCE_REMOVE
+        self.frames += 1
+        self.queue.put((time.perf_counter(),
+                        self.pool.submit(self.writer.encode, pixbuf)))
+        return GLib.SOURCE_CONTINUE
+
+    def _drain(self):
+        held = None
+
+        def write(data, delay):
+            try:
+                if self.error is None:
+                    with trace.span('record-write'):
+                        self.writer.write(data, delay)
+            except (OSError, CaptureError) as err:
+                self.error = err
+            self.slots.release()
+
+        while True:
+            item = self.queue.get()
+            if item is None:
+                break
+            (when, future) = item
+            try:
+                data = future.result()
+            except Exception as err:
+                self.error = self.error or err
+                self.slots.release()
+                continue
+            if held is not None:
+                write(held[1], when - held[0])
+            held = (when, data)
+        if held is not None:
+            write(held[1], 1 / self.fps)
+        try:
+            self.writer.close()
+        except (OSError, CaptureError) as err:
+            self.error = self.error or err
+        GLib.idle_add(self._finished)
+
+    def _finished(self):
+        self.pool.shutdown(wait=False)
+        stats = Stats(self.frames, self.dropped,
+                      time.perf_counter() - self.started,
+                      _cpu_time() - self.cpu)
+        self.callback(stats, self.error)
+        return GLib.SOURCE_REMOVE
@@ -0,0 +1,181 @@
+# ring.py
+#
+# Copyright 2018 Zander Brown
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+from gi.repository import Gio, GLib, GObject
+
+from .backend import RootWindowBackend
+from .capture import Capture
+from .encoder import encode_png
+from . import trace
+
+from collections import deque
+
+import hashlib
+import threading
+import warnings
+
+MIB = 1024 * 1024
+
+
+class Frame(object):
+    '''A PNG of the screen (at retro-scale) taken at time'''
+
+    def __init__(self, time, data, digest):
+        self.time = time
+        self.data = data
+        self.digest = digest
+
+    def to_capture(self):
+        capture = Capture(data=self.data)
+        capture.mode = 'Screen'
+        return capture
+
+
+class FrameRing(GObject.Object):
+    '''
+        The last retro-seconds of the screen, for when the moment has
+        already gone by the time you reach for the screenshot button
+
+        While the retro setting is on a frame is taken retro-fps times a
+        second, shrunk to retro-scale and kept as a fast PNG. Frames the
+        same as the one before share its data. The oldest are dropped
+        once they're too old or the ring is over retro-memory MiB, so it
+        never holds more than that. A tick that comes while the last
+        frame is still being compressed is skipped rather than queued.
+        With the setting off there's no timer and nothing is kept.
+
+        Only the in-process X11 grab is cheap enough to run that often,
+        anywhere else the setting is turned back off rather than start
+        a helper or a D-Bus screenshot several times a second.
+    '''
+
+    __gtype_name__ = 'KasbahFrameRing'
+
+    def __init__(self, settings):
+        super().__init__()
+        self.settings = settings
+        self.frames = deque()
+        self.size = 0
+        self.dropped = 0
+        self.backend = None
+        self.timer = None
+        self.busy = False
+        self.cancellable = None
+        settings.connect('changed', self.on_changed)
+        self.on_changed(settings, 'retro')
+
+    @GObject.Property(type=bool, default=False, nick='Keeping frames')
+    def recording(self):
+        return self.timer is not None
+
+    def on_changed(self, settings, key):
+        if not key.startswith('retro'):
+            return
+        self.stop()
+        if settings.get_boolean('retro'):
+            self.start()
+
+    def start(self):
+        if not RootWindowBackend.available():
+            warnings.warn('Recent frames need X11, turning them off')
+            self.settings.set_boolean('retro', False)
+            return
+        self.backend = RootWindowBackend()
+        self.cancellable = Gio.Cancellable()
+        interval = 1000 / self.settings.get_double('retro-fps')
+        self.timer = GLib.timeout_add(max(1, round(interval)), self.tick)
+        self.notify('recording')
+
+    def stop(self):
+        if self.timer is None:
+            return
+        GLib.source_remove(self.timer)
+        self.timer = None
+        self.cancellable.cancel()
+        self.busy = False
+        self.frames.clear()
+        self.size = 0
+        self.notify('recording')
+
+    def tick(self):
+        if self.busy:
+            self.dropped += 1
+            return GLib.SOURCE_CONTINUE
+        self.busy = True
+        taken = GLib.get_monotonic_time()
+        cancellable = self.cancellable
+        self.backend.capture('Screen', lambda c, e, t:
+                             self.on_frame(c, e, taken, cancellable))
+        return GLib.SOURCE_CONTINUE
+
+    def on_frame(self, capture, error, taken, cancellable):
+        if cancellable.is_cancelled():
+            if capture is not None:
+                capture.discard()
+            return
+        if error is not None:
+            # Stop rather than fail retro-fps times a second
+            warnings.warn('Recent frames stopped: {}'.format(error))
+            self.settings.set_boolean('retro', False)
+            return
+        scale = self.settings.get_double('retro-scale')
+        width = max(1, round(capture.get_size()[0] * scale))
+
+        def shrunk(pixbuf):
+            capture.discard()
+            if pixbuf is None:
+                self.busy = False
+                return
+            last = self.frames[-1] if self.frames else None
+            threading.Thread(target=self.compress, daemon=True,
+                             args=(pixbuf, last, taken, cancellable)).start()
+
+        capture.thumbnail_async(width, cancellable, shrunk)
+
+    def compress(self, pixbuf, last, taken, cancellable):
+        '''In a worker, pixbuf to a Frame, sharing last's data if it can'''
+        with trace.span('retro-frame'):
+            digest = hashlib.sha1(pixbuf.read_pixel_bytes().get_data()) \
+                .digest()
+            if last is not None and last.digest == digest:
+                data = last.data
+            else:
+                data = GLib.Bytes.new(encode_png(pixbuf, 1))
+        GLib.idle_add(self.push, Frame(taken, data, digest), cancellable)
+
+    def push(self, frame, cancellable):
+        if cancellable.is_cancelled():
+            # From before a restart, busy is the new run's
+            return GLib.SOURCE_REMOVE
+        self.busy = False
+        shared = bool(self.frames) and self.frames[-1].data is frame.data
+        if not shared:
+            self.size += frame.data.get_size()
+        self.frames.append(frame)
+        oldest = frame.time - \
+            self.settings.get_int('retro-seconds') * GLib.USEC_PER_SEC
+        limit = self.settings.get_int('retro-memory') * MIB
+        while self.frames and (self.frames[0].time < oldest or
+                               self.size > limit):
+            gone = self.frames.popleft()
+            if not self.frames or self.frames[0].data is not gone.data:
+                self.size -= gone.data.get_size()
+        return GLib.SOURCE_REMOVE
+
+    def snapshot(self):
+        '''The frames held now, oldest first'''
+        return list(self.frames)
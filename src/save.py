@@ -15,8 +15,16 @@
 # You should have received a copy of the GNU Affero General Public License
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
-from gi.repository import Gtk, Gio, GLib, GdkPixbuf
+from gi.repository import Gtk, Gdk, Gio, GLib
 from .gi_composites import GtkTemplate
+from . import trace
+from .capture import StitchedCapture
+from .edit import TOOLS, EditList
+from .encoder import available_formats, get_format
+from .shadow import add_shadow, add_shadow_async, inset
+
+import errno
+import warnings
 
 @GtkTemplate(ui='/org/gnome/Kasbah/save.ui')
 class KasbahSave(Gtk.ApplicationWindow):
@@ -25,13 +33,41 @@ class KasbahSave(Gtk.ApplicationWindow):
     preview = GtkTemplate.Child()
     filename = GtkTemplate.Child()
     folder = GtkTemplate.Child()
+    format = GtkTemplate.Child()
+    progress = GtkTemplate.Child()
+    previews = GtkTemplate.Child()
+    combine = GtkTemplate.Child()
+    shadow = GtkTemplate.Child()
+    tools = GtkTemplate.Child()
+    tool = GtkTemplate.Child()
+    zoom = GtkTemplate.Child()
+    zoom_box = GtkTemplate.Child()
 
-    def __init__(self, **kwargs):
+    def __init__(self, capture, **kwargs):
+        mapping = trace.begin('dialog-map')
+        self.previewing = trace.begin('preview')
         super().__init__(**kwargs)
         self.init_template()
+        self.capture = capture
+        self.saving = None
+        # Several of us open mustn't hold several full size images
+        self.store = self.props.application.get_pixel_store()
+        self.store.add(capture)
+        if isinstance(capture, StitchedCapture):
+            for (x, y, part) in capture.parts:
+                self.store.add(part)
+        # Full size copies with the edits or shadow, stored too
+        self.made = []
+        # Redactions and markup, drawn on the preview until saving
+        self.edits = EditList() if EditList.available() else None
+        self.original = None
+        # Bumped for every preview render, older ones are dropped
+        self.generation = 0
+        self.drag = None
+        self.zoomed = None
 
         action = Gio.SimpleAction.new("cancel", None)
-        action.connect("activate", lambda a, p: self.destroy())
+        action.connect("activate", self.on_cancel)
         self.add_action(action)
 
         action = Gio.SimpleAction.new("clipboard", None)
@@ -42,18 +78,30 @@ class KasbahSave(Gtk.ApplicationWindow):
         action.connect("activate", self.on_save)
         self.add_action(action)
 
-        try:
-            parts = [GLib.get_user_cache_dir(), 'kasbah.png']
-            tmpfile = GLib.build_filenamev(parts)
-            self.pixbuf = GdkPixbuf.Pixbuf.new_from_file(tmpfile)
-            mode = GdkPixbuf.InterpType.BILINEAR
-            height = self.pixbuf.props.height
-            width = self.pixbuf.props.width
-            ratio = width / 400
-            thumb = self.pixbuf.scale_simple(400, height / ratio, mode)
-            self.preview.props.pixbuf = thumb
-        except:
-            print('Should do something here')
+        action = Gio.SimpleAction.new("undo", None)
+        action.connect("activate", self.on_undo)
+        action.set_enabled(False)
+        self.add_action(action)
+
+        # The window shows straight away, the preview turns up later
+        self.cancellable = Gio.Cancellable()
+        self.connect('destroy', self.on_destroy)
+        self.connect('map-event', lambda w, e: mapping.end())
+        # Several monitors get a thumbnail each, not stitched
+        self.parts = []
+        if isinstance(capture, StitchedCapture) and len(capture.parts) > 1:
+            self.combine.show()
+            width = max(128, 400 // len(capture.parts))
+            for (x, y, part) in capture.parts:
+                image = Gtk.Image(icon_name='image-x-generic-symbolic',
+                                  pixel_size=width, visible=True)
+                self.previews.add(image)
+                self.parts.append((part, image))
+                part.thumbnail_async(width, self.cancellable,
+                                     lambda t, i=image:
+                                     self.on_part_thumbnail(t, i))
+        else:
+            capture.thumbnail_async(400, self.cancellable, self.on_thumbnail)
 
         pictures = GLib.UserDirectory.DIRECTORY_PICTURES
         filename = GLib.get_user_special_dir(pictures)
@@ -63,34 +111,368 @@ class KasbahSave(Gtk.ApplicationWindow):
         time = now.format("%Y-%m-%d %H-%M-%S")
         self.filename.set_text(_('Screenshot from {}.png').format(time))
 
+        for fmt in available_formats():
+            self.format.append(fmt.name, fmt.label)
+        self.settings = Gio.Settings.new('org.gnome.Kasbah')
+        flags = Gio.SettingsBindFlags.DEFAULT
+        self.settings.bind('format', self.format, 'active-id', flags)
+        self.settings.bind('combine-monitors', self.combine, 'active', flags)
+        self.on_combine(self.combine)
+        # Windows are captured bare, the shadow is ours to add or not
+        self.shadow.props.visible = capture.mode == 'Window'
+        self.settings.bind('window-shadow', self.shadow, 'active', flags)
+        self.preview.connect_after('draw', self.on_preview_draw)
+        if self.format.props.active_id is None:
+            self.format.props.active = 0
+        self.on_format(self.format)
+
+    @GtkTemplate.Callback
+    def on_format(self, combo):
+        fmt = get_format(combo.props.active_id)
+        name = self.filename.get_text()
+        (stem, dot, ext) = name.rpartition('.')
+        if dot:
+            name = stem
+        self.filename.set_text(name + fmt.extension)
+
+    def on_destroy(self, win):
+        self.cancellable.cancel()
+        if self.saving is not None:
+            self.saving.cancel()
+        if self.edits is not None:
+            self.edits.shutdown()
+        self.capture.discard()
+        if self.saving is None:
+            self.forget()
+
+    def forget(self):
+        '''Take the capture out of the store, nothing more needs it'''
+        self.store.remove(self.capture)
+        if isinstance(self.capture, StitchedCapture):
+            for (x, y, part) in self.capture.parts:
+                self.store.remove(part)
+        for capture in self.made:
+            self.store.remove(capture)
+        self.made = []
+
+    def on_thumbnail(self, thumb):
+        if self.previewing is not None:
+            self.previewing.end()
+            self.previewing = None
+        if thumb is not None:
+            self.original = thumb
+            self.update_preview()
+            if self.zoomed is not None:
+                self.zoomed.set_placeholder(thumb)
+
+    def on_part_thumbnail(self, thumb, image):
+        if self.previewing is not None:
+            self.previewing.end()
+            self.previewing = None
+        if thumb is not None:
+            image.props.pixbuf = thumb
+
+    def update_view(self):
+        '''Show the preview, the one for each monitor or the zoom'''
+        zoomed = self.zoom.props.active
+        combined = not self.parts or self.combine.props.active
+        self.zoom_box.props.visible = zoomed
+        self.preview.props.visible = combined and not zoomed
+        self.previews.props.visible = not combined and not zoomed
+        # Edits are made on the combined image
+        self.tools.props.visible = self.edits is not None and \
+            combined and not zoomed
+
+    @GtkTemplate.Callback
+    def on_combine(self, check):
+        self.update_view()
+        # Only stitched when it's asked for
+        if self.parts and check.props.active and self.original is None:
+            self.capture.thumbnail_async(400, self.cancellable,
+                                         self.on_thumbnail)
+
+    def shadowed(self):
+        return self.capture.mode == 'Window' and self.shadow.props.active
+
+    @GtkTemplate.Callback
+    def on_shadow(self, check):
+        self.update_preview()
+
+    @GtkTemplate.Callback
+    def on_zoom(self, toggle):
+        if toggle.props.active and self.zoomed is None:
+            # Not needed until now, so not imported at startup
+            from .zoom import KasbahZoom
+
+            self.zoomed = KasbahZoom(self.capture, visible=True)
+            if self.original is not None:
+                self.zoomed.set_placeholder(self.original)
+            self.zoom_box.pack_start(self.zoomed, True, True, 0)
+        self.update_view()
+
+    def _to_capture(self, x, y):
+        '''A point on the preview in the capture's pixels'''
+        shown = self.preview.props.pixbuf
+        allocation = self.preview.get_allocation()
+        scale = self.original.props.width / self.capture.get_size()[0]
+        # GtkImage centres the pixbuf
+        left = (allocation.width - shown.props.width) / 2
+        top = (allocation.height - shown.props.height) / 2
+        if self.shadowed():
+            # The window is off the shadow's top left corner
+            left += inset(scale * self.get_scale_factor())
+            top += inset(scale * self.get_scale_factor())
+        return ((x - left) / scale, (y - top) / scale)
+
+    @GtkTemplate.Callback
+    def on_canvas_press(self, box, event):
+        editing = self.edits is not None and self.original is not None and \
+            self.saving is None and self.tool.props.active_id in TOOLS
+        if editing and event.button == Gdk.BUTTON_PRIMARY:
+            self.drag = ((event.x, event.y), (event.x, event.y))
+        return True
+
+    @GtkTemplate.Callback
+    def on_canvas_motion(self, box, event):
+        if self.drag is not None:
+            self.drag = (self.drag[0], (event.x, event.y))
+            self.preview.queue_draw()
+        return True
+
+    @GtkTemplate.Callback
+    def on_canvas_release(self, box, event):
+        if self.drag is None or event.button != Gdk.BUTTON_PRIMARY:
+            return True
+        (start, end) = (self.drag[0], (event.x, event.y))
+        self.drag = None
+        self.preview.queue_draw()
+        if abs(end[0] - start[0]) < 2 and abs(end[1] - start[1]) < 2:
+            return True
+        operation = TOOLS[self.tool.props.active_id](
+            self._to_capture(*start), self._to_capture(*end))
+        self.edits.add(operation)
+        self.update_edits()
+        return True
+
+    def on_preview_draw(self, image, cr):
+        if self.drag is None:
+            return False
+        ((x0, y0), (x1, y1)) = self.drag
+        cr.set_source_rgb(1, 1, 1)
+        cr.set_line_width(1)
+        cr.rectangle(min(x0, x1) + 0.5, min(y0, y1) + 0.5,
+                     abs(x1 - x0), abs(y1 - y0))
+        cr.stroke()
+        return False
+
+    def on_undo(self, act, p):
+        self.edits.undo()
+        self.update_edits()
+
+    def update_edits(self):
+        '''Replay the edits on the preview'''
+        edited = bool(len(self.edits))
+        self.lookup_action('undo').set_enabled(edited)
+        # Saving a monitor at a time would lose the edits
+        self.combine.props.sensitive = not edited
+        self.update_preview()
+
+    def update_preview(self):
+        '''Show the thumbnail with the edits and shadow, if any'''
+        if self.original is None:
+            return
+        scale = self.original.props.width / self.capture.get_size()[0]
+        self.generation += 1
+        generation = self.generation
+        if self.edits is not None and len(self.edits):
+            self.edits.render_async(self.original, scale,
+                                    lambda pixbuf, error:
+                                    self.on_edited(pixbuf, generation, error))
+        else:
+            self.on_edited(self.original, generation)
+
+    def on_edited(self, pixbuf, generation, error=None):
+        if self.cancellable.is_cancelled() or generation != self.generation:
+            # Gone, or a newer render has been asked for since
+            return
+        if error is not None:
+            warnings.warn('Failed to render edits: {}'.format(error))
+            return
+        if self.shadowed():
+            # Small enough to do here
+            scale = self.original.props.width / self.capture.get_size()[0]
+            pixbuf = add_shadow(pixbuf, scale * self.get_scale_factor())
+        self.preview.props.pixbuf = pixbuf
+
+    def targets(self, capture, folder, name):
+        '''(capture, name, path, thumbnail) for each file to write'''
+        if not self.parts or self.combine.props.active:
+            return [(capture, name, GLib.build_filenamev([folder, name]),
+                     self.preview.props.pixbuf)]
+        (stem, dot, ext) = name.rpartition('.')
+        if not dot:
+            (stem, ext) = (name, '')
+        targets = []
+        for (n, (part, image)) in enumerate(self.parts, 1):
+            part_name = '{} ({}){}'.format(stem, n, dot + ext)
+            targets.append((part, part_name,
+                            GLib.build_filenamev([folder, part_name]),
+                            image.props.pixbuf))
+        return targets
+
+    def edited(self, callback):
+        '''
+            callback gets (the capture with the edits applied at full
+            size and the shadow added under them if it's on, None) or
+            (None, the error)
+        '''
+        def stored(capture, error):
+            if capture is not None and capture is not self.capture and \
+                    not self.cancellable.is_cancelled():
+                # As big as the capture, so under the same budget
+                self.made.append(capture)
+                self.store.add(capture)
+            callback(capture, error)
+
+        def finish(capture, error):
+            if error is None and self.shadowed():
+                add_shadow_async(capture, self.get_scale_factor(), stored)
+            else:
+                stored(capture, error)
+
+        if self.edits is None:
+            finish(self.capture, None)
+        else:
+            self.edits.rasterize_async(self.capture, finish)
+
     def on_clipboard(self, act, p):
-        Gtk.Clipboard.get_default(self.get_display()).set_image(self.pixbuf)
+        def offer(capture, error):
+            if error is not None:
+                warnings.warn('Failed to copy: {}'.format(error))
+                return
+            with trace.span('clipboard-offer'):
+                self.props.application.get_clipboard().offer(capture)
+
+        self.edited(offer)
+
+    def on_cancel(self, act, p):
+        if self.saving is not None:
+            self.saving.cancel()
+        else:
+            self.destroy()
+
+    def set_busy(self, busy):
+        self.filename.props.sensitive = not busy
+        self.folder.props.sensitive = not busy
+        self.combine.props.sensitive = not busy and not (
+            self.edits is not None and len(self.edits))
+        self.tools.props.sensitive = not busy
+        self.shadow.props.sensitive = not busy
+        self.lookup_action('save').set_enabled(not busy)
+        self.progress.props.visible = busy
 
     def on_save(self, act, p):
-        self.filename.props.sensitive = False
-        self.folder.props.sensitive = False
-        parts = [GLib.get_user_cache_dir(), 'kasbah.png']
-        filename = GLib.build_filenamev(parts)
-        source = Gio.File.new_for_path(filename)
-        folder = self.folder.get_filename()
-        name = self.filename.get_text()
-        path = GLib.build_filenamev([folder, name])
-        dest = Gio.File.new_for_path(path)
-        try:
-            source.move(dest, Gio.FileCopyFlags.NONE)
+        self.set_busy(True)
+        self.progress.props.fraction = 0
+        self.saving = Gio.Cancellable()
+        self.edited(self.save)
+
+    def save(self, capture, error):
+        if self.cancellable.is_cancelled():
+            self.forget()
+            return
+        if self.saving.is_cancelled() or error is not None:
+            # Cancelled while the edits were applied, or they failed
+            self.saving = None
+            self.set_busy(False)
+            if error is not None:
+                self.show_error(_('We where unable to save your screenshot'))
+            return
+        targets = self.targets(capture, self.folder.get_filename(),
+                               self.filename.get_text())
+        fmt = self.format.props.active_id
+        options = {
+            'level': self.settings.get_int('png-compression'),
+            'quality': self.settings.get_int('jpeg-quality'),
+        }
+        self.timer = trace.begin('save', format=fmt, files=len(targets))
+        fractions = [0] * len(targets)
+        results = []
+        history = self.props.application.get_history()
+        dedup = None
+        # A redacted copy can hash within a few bits of the original,
+        # linking to that would undo the redaction
+        if self.settings.get_boolean('dedup') and capture is self.capture:
+            # Not at the top, only needed with the setting on
+            from . import dedup
+
+        def progress(n, written, total):
+            fractions[n] = written / total
+            return self.on_save_progress(sum(fractions), len(fractions))
+
+        def saved(target, err, original=None):
+            results.append((target, err, original))
+            if len(results) == len(targets):
+                self.on_saved(results)
+
+        for (n, target) in enumerate(targets):
+            (capture, name, path, thumbnail) = target
+            if dedup is not None:
+                dedup.save_async(history, capture, path, fmt, options,
+                                 self.settings.get_int('dedup-threshold'),
+                                 self.saving,
+                                 lambda w, t, n=n: progress(n, w, t),
+                                 lambda err, original, target=target:
+                                 saved(target, err, original))
+            else:
+                capture.save_async(path, fmt, options, self.saving,
+                                   lambda w, t, n=n: progress(n, w, t),
+                                   lambda err, target=target:
+                                   saved(target, err))
+
+    def on_save_progress(self, written, total):
+        if self.saving is not None:
+            self.progress.props.fraction = written / total
+        return GLib.SOURCE_REMOVE
+
+    def on_saved(self, results):
+        '''results is (target, error, original) for each file'''
+        cancelled = self.saving.is_cancelled()
+        self.saving = None
+        failed = [(name, err) for ((c, name, p, t), err, o) in results
+                  if err is not None]
+        self.timer.end(error=str(failed[0][1] if failed else None))
+        if self.cancellable.is_cancelled():
+            # The window has already gone
+            self.forget()
+            return
+        if not failed:
+            history = self.props.application.get_history()
+            for ((capture, name, path, thumbnail), e, original) in results:
+                history.record(path, capture, thumbnail=thumbnail,
+                               original=original)
             self.destroy()
-        except GLib.Error as err:
-            self.filename.props.sensitive = True
-            self.folder.props.sensitive = True
-            msg = _('We where unable to save your screenshot')
-            if err.matches(Gio.io_error_quark(), Gio.IOErrorEnum.EXISTS):
-                msg = _('{file} already exists').format(file=name)
-            dlg = Gtk.MessageDialog(transient_for=self,
-                                    modal=True,
-                                    message_type=Gtk.MessageType.ERROR,
-                                    buttons=Gtk.ButtonsType.CLOSE,
-                                    text=_('Saving failed'),
-                                    secondary_text=msg)
-            dlg.connect('response', lambda d, r: d.destroy())
-            dlg.show()
+            return
+        # All or nothing, so trying again doesn't find the monitors
+        # that did get written in the way
+        for ((capture, name, path, thumbnail), err, original) in results:
+            if err is None:
+                GLib.unlink(path)
+        (name, err) = failed[0]
+        self.set_busy(False)
+        if cancelled:
+            return
+        msg = _('We where unable to save your screenshot')
+        if getattr(err, 'errno', None) == errno.EEXIST:
+            msg = _('{file} already exists').format(file=name)
+        self.show_error(msg)
 
+    def show_error(self, msg):
+        dlg = Gtk.MessageDialog(transient_for=self,
+                                modal=True,
+                                message_type=Gtk.MessageType.ERROR,
+                                buttons=Gtk.ButtonsType.CLOSE,
+                                text=_('Saving failed'),
+                                secondary_text=msg)
+        dlg.connect('response', lambda d, r: d.destroy())
+        dlg.show()
@@ -0,0 +1,195 @@
+# service.py
+#
+# Copyright 2018 Zander Brown
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+from gi.repository import Gio, GLib
+
+import threading
+
+INTERFACE = '''
+<node>
+  <interface name="org.gnome.Kasbah.Capture">
+    <method name="CaptureToFile">
+      <arg type="s" name="mode" direction="in"/>
+      <arg type="a{sv}" name="options" direction="in"/>
+      <arg type="s" name="path" direction="in"/>
+      <arg type="d" name="elapsed" direction="out"/>
+    </method>
+    <method name="Capture">
+      <arg type="s" name="mode" direction="in"/>
+      <arg type="a{sv}" name="options" direction="in"/>
+      <arg type="ay" name="image" direction="out"/>
+    </method>
+  </interface>
+</node>
+'''
+
+MODES = {
+    'screen': 'Screen',
+    'window': 'Window',
+    'area': 'Selection',
+}
+
+ERROR = 'org.gnome.Kasbah.Error.Failed'
+
+
+class CaptureService(object):
+    '''
+        Lets other processes take screenshots through a running Kasbah,
+        skipping interpreter and toolkit startup
+
+        Exported on the application's object path as
+        org.gnome.Kasbah.Capture. Options are pointer (b), shadow (b),
+        delay (d) and format (s), missing ones come from the settings.
+    '''
+
+    def __init__(self, app):
+        self.app = app
+        self.settings = app.settings
+        self.registration = None
+        self.info = Gio.DBusNodeInfo.new_for_xml(INTERFACE).interfaces[0]
+
+    def register(self, connection, object_path):
+        self.registration = connection.register_object_with_closures(
+            object_path, self.info, self.on_call, None, None)
+        self.connection = connection
+
+    def unregister(self):
+        if self.registration is not None:
+            self.connection.unregister_object(self.registration)
+            self.registration = None
+
+    def capture(self, mode, options, callback):
+        '''
+            Take a screenshot for a client, mode is one of MODES and
+            callback gets (capture, error, elapsed)
+        '''
+        def done(capture, error, elapsed):
+            self.app.release()
+            callback(capture, error, elapsed)
+
+        if mode not in MODES:
+            callback(None, _('Unknown mode {}').format(mode), 0)
+            return
+        self.app.hold()
+        self.app.get_queue().submit(
+            MODES[mode], done,
+            pointer=options.get('pointer',
+                                self.settings.get_boolean('include-pointer')),
+            shadow=options.get('shadow',
+                               self.settings.get_boolean('window-shadow')),
+            delay=options.get('delay', 0))
+
+    def encode_options(self):
+        return {
+            'level': self.settings.get_int('png-compression'),
+            'quality': self.settings.get_int('jpeg-quality'),
+        }
+
+    def encode_async(self, capture, fmt, callback):
+        '''
+            capture as fmt in a worker, callback gets (bytes, None) or
+            (None, the error) on the main loop
+        '''
+        def finish(data, error):
+            capture.discard()
+            callback(data, error)
+            return GLib.SOURCE_REMOVE
+
+        def work():
+            from .encoder import encode, get_format
+
+            native = get_format(fmt).mime_type == capture.mime_type
+            try:
+                if native and capture.data is not None:
+                    data = capture.data.get_data()
+                else:
+                    data = encode(capture.pixbuf, fmt,
+                                  **self.encode_options())
+            except GLib.Error as err:
+                GLib.idle_add(finish, None, err.message)
+            except Exception as err:
+                GLib.idle_add(finish, None, err)
+            else:
+                GLib.idle_add(finish, data, None)
+
+        threading.Thread(target=work, daemon=True).start()
+
+    def save(self, capture, path, fmt, callback):
+        '''Write capture to path, callback gets None or the error'''
+        options = self.encode_options()
+
+        def saved(error, original=None):
+            if error is None and deduplicating:
+                # So the next capture can be compared with this one
+                self.app.get_history().record(path, capture,
+                                              original=original)
+            capture.discard()
+            self.app.release()
+            callback(error)
+
+        def progress(written, total):
+            return GLib.SOURCE_REMOVE
+
+        deduplicating = self.settings.get_boolean('dedup')
+        self.app.hold()
+        if deduplicating:
+            from . import dedup
+            dedup.save_async(self.app.get_history(), capture, path, fmt,
+                             options, self.settings.get_int('dedup-threshold'),
+                             Gio.Cancellable(), progress, saved)
+        else:
+            capture.save_async(path, fmt, options, Gio.Cancellable(),
+                               progress, saved)
+
+    def on_call(self, connection, sender, object_path, interface, method,
+                params, invocation):
+        (mode, options) = params.unpack()[:2]
+        fmt = options.get('format', self.settings.get_string('format'))
+
+        def fail(error):
+            invocation.return_dbus_error(ERROR, str(error))
+
+        def encoded(data, error):
+            if error is not None:
+                fail(error)
+            else:
+                invocation.return_value(GLib.Variant('(ay)', (data,)))
+
+        def captured(capture, error, elapsed):
+            if error is not None:
+                fail(error)
+            elif method == 'Capture':
+                self.encode_async(capture, fmt, encoded)
+            else:
+                path = params.unpack()[2]
+
+                def saved(error):
+                    if error is not None:
+                        fail(error)
+                    else:
+                        result = GLib.Variant('(d)', (elapsed,))
+                        invocation.return_value(result)
+
+                self.save(capture, path, fmt, saved)
+
+        # Not imported until a client asks for something
+        from .encoder import available_formats
+
+        if fmt not in [f.name for f in available_formats()]:
+            fail(_('Unknown format {}').format(fmt))
+            return
+        self.capture(mode, options, captured)
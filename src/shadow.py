@@ -0,0 +1,139 @@
+# shadow.py
+#
+# Copyright 2018 Zander Brown
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+# The drop shadow gnome-screenshot's -e shadow adds, done here on a
+# bare capture of the window so it can be turned on and off after the
+# shot. A blurred rectangle is the product of a blurred row and a
+# blurred column, so only those two are worked out (and kept), cairo
+# multiplies them together and blends the window over the result.
+
+from gi.repository import Gdk
+import cairo
+
+from .capture import Capture, run_async
+from . import trace
+
+from functools import lru_cache
+
+import math
+
+# In logical pixels, as gnome-screenshot's effect
+RADIUS = 5
+OFFSET = 4
+OPACITY = 0.5
+
+
+def _reach(scale):
+    '''How far the blur spreads, in pixels, at scale'''
+    return max(1, round(RADIUS * 2 * scale))
+
+
+def inset(scale):
+    '''Where the window goes in the shadowed image, at scale'''
+    reach = _reach(scale)
+    return reach - min(reach, round(OFFSET * scale))
+
+
+@lru_cache(maxsize=8)
+def _kernel(reach):
+    '''Gaussian weights either side of the middle, summing to 1'''
+    sigma = reach / 2
+    weights = [math.exp(-(i * i) / (2 * sigma * sigma))
+               for i in range(-reach, reach + 1)]
+    total = sum(weights)
+    return [w / total for w in weights]
+
+
+@lru_cache(maxsize=32)
+def _profile(length, reach, column):
+    '''
+        length pixels of shadow blurred reach pixels out each side, as
+        an A8 surface one pixel high (or wide, for a column). Only the
+        column has OPACITY in it.
+    '''
+    kernel = _kernel(reach)
+    # Running total, so each pixel is one subtraction
+    totals = [0]
+    for weight in kernel:
+        totals.append(totals[-1] + weight)
+    last = len(kernel)
+    # The two are multiplied together, so only one of them is faded
+    peak = 255 * OPACITY if column else 255
+    values = bytes(round(peak *
+                         (totals[min(last, i + 1)] -
+                          totals[max(0, i + 1 - length)]))
+                   for i in range(length + 2 * reach))
+    size = len(values)
+    if column:
+        stride = cairo.ImageSurface.format_stride_for_width(cairo.FORMAT_A8,
+                                                            1)
+        data = bytearray(stride * size)
+        data[::stride] = values
+        surface = cairo.ImageSurface.create_for_data(data, cairo.FORMAT_A8,
+                                                     1, size, stride)
+    else:
+        stride = cairo.ImageSurface.format_stride_for_width(cairo.FORMAT_A8,
+                                                            size)
+        data = bytearray(stride)
+        data[:size] = values
+        surface = cairo.ImageSurface.create_for_data(data, cairo.FORMAT_A8,
+                                                     size, 1, stride)
+    return surface
+
+
+def add_shadow(pixbuf, scale=1):
+    '''A new pixbuf of pixbuf, a window, with a shadow under it'''
+    (width, height) = (pixbuf.props.width, pixbuf.props.height)
+    reach = _reach(scale)
+    with trace.span('shadow', width=width, height=height):
+        surface = cairo.ImageSurface(cairo.FORMAT_ARGB32, width + 2 * reach,
+                                     height + 2 * reach)
+        cr = cairo.Context(surface)
+        # Both stretched across the whole image, where they overlap is
+        # the column times the row
+        column = cairo.SurfacePattern(_profile(height, reach, True))
+        column.set_extend(cairo.EXTEND_REPEAT)
+        row = cairo.SurfacePattern(_profile(width, reach, False))
+        row.set_extend(cairo.EXTEND_REPEAT)
+        cr.set_source(column)
+        cr.mask(row)
+        Gdk.cairo_set_source_pixbuf(cr, pixbuf, inset(scale), inset(scale))
+        cr.paint()
+        return Gdk.pixbuf_get_from_surface(surface, 0, 0,
+                                           surface.get_width(),
+                                           surface.get_height())
+
+
+def default_scale():
+    '''The scale factor of the primary monitor'''
+    display = Gdk.Display.get_default()
+    monitor = display.get_primary_monitor() or display.get_monitor(0)
+    return monitor.get_scale_factor() if monitor is not None else 1
+
+
+def add_shadow_async(capture, scale, callback):
+    '''
+        callback gets (a new Capture of capture with a shadow under it,
+        None) or (None, the error)
+    '''
+    def work():
+        # The full size pixbuf is decoded in the worker too
+        shadowed = Capture(pixbuf=add_shadow(capture.pixbuf, scale))
+        shadowed.mode = capture.mode
+        return shadowed
+
+    run_async(work, callback)
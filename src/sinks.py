@@ -0,0 +1,190 @@
+# sinks.py
+#
+# Copyright 2018 Zander Brown
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+from gi.repository import GLib
+
+from .encoder import encode, get_format
+
+from abc import ABC, abstractmethod
+from concurrent.futures import ThreadPoolExecutor, wait
+
+import sys
+import threading
+import urllib.request
+
+
+class Sink(ABC):
+    '''Somewhere a capture can be sent, write runs in a worker thread'''
+
+    # Sinks that have to run on the main thread set this
+    main_thread = False
+
+    # Sinks that work from capture.pixbuf, not the encoded data, unset
+    # this and get None for data if nothing else wants it
+    needs_data = True
+
+    @abstractmethod
+    def write(self, data, fmt, capture):
+        pass
+
+
+class FileSink(Sink):
+    def __init__(self, path):
+        self.path = path
+
+    def write(self, data, fmt, capture):
+        with open(self.path, 'wb') as out:
+            out.write(data)
+
+    def __str__(self):
+        return self.path
+
+
+class StdoutSink(Sink):
+    def write(self, data, fmt, capture):
+        sys.stdout.buffer.write(data)
+        sys.stdout.buffer.flush()
+
+    def __str__(self):
+        return 'stdout'
+
+
+class HttpSink(Sink):
+    '''POSTs the image to url, with the format's MIME type'''
+
+    def __init__(self, url):
+        self.url = url
+
+    def write(self, data, fmt, capture):
+        mime_type = get_format(fmt).mime_type
+        request = urllib.request.Request(self.url, data=data, method='POST',
+                                         headers={'Content-Type': mime_type})
+        with urllib.request.urlopen(request, timeout=60) as response:
+            response.read()
+
+    def __str__(self):
+        return self.url
+
+
+class ClipboardSink(Sink):
+    '''Hands the capture to the application's ClipboardProvider'''
+
+    main_thread = True
+
+    def __init__(self, app):
+        self.app = app
+
+    def write(self, data, fmt, capture):
+        if not self.app.get_clipboard().offer(capture):
+            raise RuntimeError(_('Failed to take the clipboard'))
+
+    def __str__(self):
+        return 'clipboard'
+
+
+class TileSink(Sink):
+    '''Writes a tiles.TileStore manifest, only storing changed tiles'''
+
+    needs_data = False
+
+    def __init__(self, app, path):
+        self.app = app
+        self.path = path
+
+    def write(self, data, fmt, capture):
+        store = self.app.get_tile_store()
+        (width, height) = capture.get_size()
+        output = '{}-{}x{}'.format(capture.mode, width, height)
+        store.write(capture.pixbuf, self.path, output, mode=capture.mode)
+
+    def __str__(self):
+        return 'tiles:' + self.path
+
+
+def new_sink(app, output, cwd):
+    '''
+        Work out what kind of sink output (an --output argument) is,
+        - is stdout, clipboard the clipboard, http:// and https:// URLs
+        are POSTed to, tiles:path writes a tile manifest to path,
+        anything else is a path relative to cwd
+    '''
+    def resolve(path):
+        if GLib.path_is_absolute(path):
+            return path
+        return GLib.build_filenamev([cwd, path])
+
+    if output == '-':
+        return StdoutSink()
+    elif output == 'clipboard':
+        return ClipboardSink(app)
+    elif output.startswith('tiles:'):
+        return TileSink(app, resolve(output[len('tiles:'):]))
+    elif output.startswith('http://') or output.startswith('https://'):
+        return HttpSink(output)
+    return FileSink(resolve(output))
+
+
+_pool = None
+
+
+def fan_out(capture, fmt, options, sinks, callback):
+    '''
+        Encode capture once then send it to every sink at the same
+        time. callback gets a list of (sink, error) for the sinks that
+        failed, on the main loop.
+    '''
+    global _pool
+    if _pool is None:
+        _pool = ThreadPoolExecutor(max_workers=8)
+
+    def finish(data, failed):
+        for sink in sinks:
+            if sink.main_thread:
+                try:
+                    sink.write(data, fmt, capture)
+                except Exception as err:
+                    failed.append((sink, err))
+        callback(failed)
+        return GLib.SOURCE_REMOVE
+
+    def send(sink, data):
+        try:
+            sink.write(data, fmt, capture)
+        except Exception as err:
+            return (sink, err)
+
+    def work():
+        try:
+            native = get_format(fmt).mime_type == capture.mime_type
+            if not any(sink.needs_data for sink in sinks):
+                data = None
+            elif native and capture.data is not None:
+                data = capture.data.get_data()
+            else:
+                data = encode(capture.pixbuf, fmt, **options)
+        except Exception as err:
+            # Every sink fails, but the callback still runs
+            GLib.idle_add(callback, [(sink, err) for sink in sinks])
+            return
+        futures = [_pool.submit(send, sink, data)
+                   for sink in sinks if not sink.main_thread]
+        wait(futures)
+        failed = [f.result() for f in futures if f.result() is not None]
+        GLib.idle_add(finish, data, failed)
+
+    # Not on the pool, work waits for the pool
+    threading.Thread(target=work, daemon=True).start()
@@ -0,0 +1,174 @@
+# tiles.py
+#
+# Copyright 2018 Zander Brown
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+# Storage for the same screen captured over and over (monitoring, QA)
+#
+# A capture is cut into TILE_SIZE squares. Each tile is stored once,
+# compressed and named by its sha256, and the capture itself becomes a
+# small JSON manifest listing its tiles. The previous capture of each
+# output is kept in memory and compared in bulk, so only the tiles that
+# changed are hashed, and of those only the ones never seen before are
+# written.
+#
+# Rebuild a manifest with:
+#
+#     python3 -m kasbah.tiles shot.tiles shot.png
+
+from gi.repository import GLib
+
+from .pixels import as_array, numpy, to_pixbuf
+from . import trace
+
+import hashlib
+import json
+import os
+import sys
+import threading
+import time
+import zlib
+
+TILE_SIZE = 64
+
+MANIFEST_VERSION = 1
+
+
+class TileStore(object):
+    '''
+        Content addressed tiles under folder, by default in the user data
+        dir. write and rebuild are safe to call from worker threads.
+    '''
+
+    def __init__(self, folder=None):
+        if numpy is None:
+            raise RuntimeError(_('Tile storage needs NumPy'))
+        if folder is None:
+            folder = GLib.build_filenamev([GLib.get_user_data_dir(),
+                                           'kasbah', 'tiles'])
+        self.folder = folder
+        # Output name to (pixels, hashes) of its last capture
+        self.previous = {}
+        self.lock = threading.Lock()
+
+    def _blob_path(self, digest):
+        return os.path.join(self.folder, digest[:2], digest[2:])
+
+    def _put(self, digest, tile):
+        '''Store tile unless it's already here, returns bytes written'''
+        path = self._blob_path(digest)
+        if os.path.exists(path):
+            return 0
+        os.makedirs(os.path.dirname(path), mode=0o700, exist_ok=True)
+        data = zlib.compress(numpy.ascontiguousarray(tile).tobytes(), 1)
+        # Written aside and renamed so a crash never leaves half a tile
+        partial = '{}.{}.partial'.format(path, os.getpid())
+        with open(partial, 'wb') as out:
+            out.write(data)
+        os.rename(partial, path)
+        return len(data)
+
+    def _changed(self, pixels, output):
+        '''
+            (rows, columns) bool array of the tiles that differ from the
+            last capture of output, or None when there's nothing to
+            compare with
+        '''
+        previous = self.previous.get(output)
+        if previous is None or previous[0].shape != pixels.shape:
+            return None
+        (height, width) = pixels.shape[:2]
+        differ = (pixels != previous[0]).any(axis=2)
+        # OR each TILE_SIZE block of rows then of columns, reduceat
+        # copes with the short tiles along the edges
+        differ = numpy.logical_or.reduceat(
+            differ, numpy.arange(0, height, TILE_SIZE), axis=0)
+        return numpy.logical_or.reduceat(
+            differ, numpy.arange(0, width, TILE_SIZE), axis=1)
+
+    def write(self, pixbuf, manifest, output='default', **info):
+        '''
+            Store pixbuf as the manifest file manifest, compared with the
+            last capture of output (a monitor or mode name). info is
+            added to the manifest. Returns (changed, total, written), the
+            tiles hashed, the tiles in the image and the bytes written.
+        '''
+        with self.lock:
+            return self._write(pixbuf, manifest, output, info)
+
+    def _write(self, pixbuf, manifest, output, info):
+        pixels = as_array(pixbuf)
+        (height, width, channels) = pixels.shape
+        rows = -(-height // TILE_SIZE)
+        columns = -(-width // TILE_SIZE)
+        with trace.span('tiles-compare'):
+            changed = self._changed(pixels, output)
+        hashes = list(self.previous[output][1]) if changed is not None \
+            else [None] * (rows * columns)
+        if changed is None:
+            changed = numpy.ones((rows, columns), dtype=bool)
+
+        written = 0
+        with trace.span('tiles-store', changed=int(changed.sum())):
+            for (row, column) in zip(*numpy.nonzero(changed)):
+                (y, x) = (row * TILE_SIZE, column * TILE_SIZE)
+                tile = pixels[y:y + TILE_SIZE, x:x + TILE_SIZE]
+                digest = hashlib.sha256(
+                    numpy.ascontiguousarray(tile).data).hexdigest()
+                written += self._put(digest, tile)
+                hashes[row * columns + column] = digest
+
+        self.previous[output] = (pixels.copy(), hashes)
+        document = dict(info, version=MANIFEST_VERSION, width=width,
+                        height=height, channels=channels, tile=TILE_SIZE,
+                        output=output, time=time.time(), tiles=hashes)
+        data = json.dumps(document).encode()
+        partial = manifest + '.partial'
+        with open(partial, 'wb') as out:
+            out.write(data)
+        os.rename(partial, manifest)
+        written += len(data)
+        return (int(changed.sum()), rows * columns, written)
+
+    def rebuild(self, manifest):
+        '''The pixbuf manifest was written from'''
+        with open(manifest, 'rb') as source:
+            document = json.load(source)
+        if document.get('version') != MANIFEST_VERSION:
+            raise ValueError(_('Unknown tile manifest version'))
+        (width, height) = (document['width'], document['height'])
+        (channels, size) = (document['channels'], document['tile'])
+        pixels = numpy.empty((height, width, channels), dtype=numpy.uint8)
+        columns = -(-width // size)
+        for (index, digest) in enumerate(document['tiles']):
+            (y, x) = (index // columns * size, index % columns * size)
+            target = pixels[y:y + size, x:x + size]
+            with open(self._blob_path(digest), 'rb') as blob:
+                tile = numpy.frombuffer(zlib.decompress(blob.read()),
+                                        dtype=numpy.uint8)
+            target[...] = tile.reshape(target.shape)
+        return to_pixbuf(pixels)
+
+
+def main(argv):
+    if len(argv) != 2:
+        sys.exit('usage: python3 -m kasbah.tiles MANIFEST OUTPUT.png')
+    TileStore().rebuild(argv[0]).savev(argv[1], 'png', [], [])
+
+
+if __name__ == '__main__':
+    import gettext
+    gettext.install('kasbah')
+    main(sys.argv[1:])
@@ -0,0 +1,126 @@
+# trace.py
+#
+# Copyright 2018 Zander Brown
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+# Timing of each phase of a screenshot, written as Chrome trace JSON
+# (open in chrome://tracing or ui.perfetto.dev) plus a summary on stderr.
+#
+# Turned on with KASBAH_TRACE=file.json or kasbah --profile file.json
+
+import atexit
+import json
+import os
+import sys
+import threading
+import time
+
+from contextlib import contextmanager
+
+_events = []
+_output = None
+
+
+def enable(path):
+    '''Start recording, the trace is written to path on exit'''
+    global _output
+    if _output is None:
+        atexit.register(write)
+    _output = path
+
+
+def enabled():
+    return _output is not None
+
+
+def _now():
+    return time.perf_counter_ns() // 1000
+
+
+class Span(object):
+    '''A phase that started and will end somewhere else, see begin'''
+
+    def __init__(self, name, args):
+        self.name = name
+        self.args = args
+        self.start = _now()
+
+    def end(self, **args):
+        self.args.update(args)
+        _events.append({
+            'name': self.name,
+            'ph': 'X',
+            'ts': self.start,
+            'dur': _now() - self.start,
+            'pid': os.getpid(),
+            'tid': threading.get_ident(),
+            'args': self.args,
+        })
+
+
+class _NoSpan(object):
+    def end(self, **args):
+        pass
+
+
+_nothing = _NoSpan()
+
+
+def begin(name, **args):
+    '''
+        Start timing name, call end on what comes back when it's done.
+        For phases that finish in a callback.
+    '''
+    if _output is None:
+        return _nothing
+    return Span(name, args)
+
+
+@contextmanager
+def span(name, **args):
+    '''Time the body of a with block'''
+    if _output is None:
+        yield
+        return
+    timer = Span(name, args)
+    try:
+        yield
+    finally:
+        timer.end()
+
+
+def summary():
+    '''(name, count, total, mean, max) in milliseconds per phase'''
+    phases = {}
+    for event in _events:
+        phases.setdefault(event['name'], []).append(event['dur'] / 1000)
+    return [(name, len(d), sum(d), sum(d) / len(d), max(d))
+            for (name, d) in sorted(phases.items())]
+
+
+def write():
+    if _output is None:
+        return
+    with open(_output, 'w') as out:
+        json.dump({'traceEvents': _events, 'displayTimeUnit': 'ms'}, out)
+    print('{:<24} {:>6} {:>10} {:>10} {:>10}'.format(
+        'phase', 'count', 'total ms', 'mean ms', 'max ms'), file=sys.stderr)
+    for row in summary():
+        print('{:<24} {:>6} {:>10.2f} {:>10.2f} {:>10.2f}'.format(*row),
+              file=sys.stderr)
+
+
+if os.environ.get('KASBAH_TRACE'):
+    enable(os.environ['KASBAH_TRACE'])
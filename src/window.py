@@ -15,12 +15,11 @@
 # You should have received a copy of the GNU Affero General Public License
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
-from gi.repository import Gtk, Gio, GObject, GLib, GdkPixbuf
+from gi.repository import Gtk, Gdk, Gio, GObject, GLib, GdkPixbuf
 from .gi_composites import GtkTemplate
+from . import trace
 
-from .save import KasbahSave
-
-from pathlib import Path
+import warnings
 
 
 @GtkTemplate(ui='/org/gnome/Kasbah/window.ui')
@@ -59,22 +58,41 @@ class KasbahWindow(Gtk.ApplicationWindow):
         action.connect("activate", self.on_about)
         self.add_action(action)
 
+        action = Gio.SimpleAction.new("history", None)
+        action.connect("activate", self.on_history)
+        self.add_action(action)
+
+        action = Gio.SimpleAction.new("frames", None)
+        action.connect("activate", self.on_frames)
+        self.add_action(action)
+
         action = Gio.SimpleAction.new("screenshot", None)
         action.connect("activate", self.on_screenshot)
         self.add_action(action)
 
-        settings = Gio.Settings.new('org.gnome.Kasbah')
+        self.settings = settings = Gio.Settings.new('org.gnome.Kasbah')
         flags = Gio.SettingsBindFlags.DEFAULT
         settings.bind('include-pointer', self.pointer, 'active', flags)
         settings.bind('window-shadow', self.shadow, 'active', flags)
-        settings.bind('delay', self.delay, 'value', flags)
+        if settings.get_user_value('delay-seconds') is None and \
+                settings.get_user_value('delay') is not None:
+            # Set before delay could be a fraction, keep it
+            settings.set_double('delay-seconds', settings.get_int('delay'))
+            settings.reset('delay')
+        settings.bind('delay-seconds', self.delay, 'value', flags)
         settings.bind('mode', self, 'mode', flags)
 
         self.menu.props.menu_model = self.props.application. \
             get_menu_by_id('win-menu')
+        display = self.get_display()
+        display.connect('monitor-added', self.update_monitors)
+        display.connect('monitor-removed', self.update_monitors)
+        settings.connect('changed::monitors', self.update_monitors)
+        self.update_monitors()
 
         self.listbox.set_header_func(self.update_header)
         self._fix_icons()
+        self.connect('notify::scale-factor', self._fix_icons)
 
     @GObject.Property(type=str, nick='Screenshot mode')
     def mode(self):
@@ -118,6 +136,60 @@ class KasbahWindow(Gtk.ApplicationWindow):
         self._toggle_flag = True
         self.props.mode = 'Selection'
 
+    def update_monitors(self, *args):
+        '''A toggle in the menu for each monitor, kept in the monitors key'''
+        display = self.get_display()
+        chosen = self.settings.get_value('monitors').unpack()
+        section = self.props.application.get_menu_by_id('monitors')
+        section.remove_all()
+        count = display.get_n_monitors()
+        if count < 2:
+            return
+        for n in range(count):
+            name = 'monitor-{}'.format(n)
+            action = self.lookup_action(name)
+            if action is None:
+                action = Gio.SimpleAction.new_stateful(
+                    name, None, GLib.Variant('b', False))
+                action.connect('change-state', self.on_monitor, n)
+                self.add_action(action)
+            action.set_state(GLib.Variant('b', n in chosen))
+            monitor = display.get_monitor(n)
+            label = monitor.get_model() or _('Monitor {}').format(n + 1)
+            section.append(label, 'win.' + name)
+
+    def on_monitor(self, act, state, n):
+        chosen = set(self.settings.get_value('monitors').unpack())
+        if state.get_boolean():
+            chosen.add(n)
+        else:
+            chosen.discard(n)
+        self.settings.set_value('monitors',
+                                GLib.Variant('ai', sorted(chosen)))
+
+    def monitor_areas(self):
+        '''The geometries of the chosen monitors, or None for the lot'''
+        display = self.get_display()
+        areas = []
+        for n in self.settings.get_value('monitors').unpack():
+            monitor = display.get_monitor(n)
+            if monitor is not None:
+                geometry = monitor.get_geometry()
+                areas.append((geometry.x, geometry.y,
+                              geometry.width, geometry.height))
+        return areas or None
+
+    def on_history(self, act, p):
+        from .historyview import KasbahHistory
+        app = self.props.application
+        KasbahHistory(app.get_history(), application=app).present()
+
+    def on_frames(self, act, p):
+        from .frames import KasbahFrames
+        app = self.props.application
+        KasbahFrames(app.get_ring().snapshot(), transient_for=self,
+                     application=app).present()
+
     def on_about(self, act, p):
         artists = ['Tobias Bernard']
         authors = ['Jordan Petridis', 'Zander Brown']
@@ -148,85 +220,124 @@ class KasbahWindow(Gtk.ApplicationWindow):
             current.show()
             row.set_header(current)
 
-    def watch(self, pid, status):
-        self.show()
-        if status is not 0:
+    def watch(self, capture, error, elapsed):
+        queue = self.props.application.get_queue()
+        if queue.running == 0 and not queue.waiting:
+            self.show()
+        if error is not None:
             title = _('Screenshot failed')
-            secondary = _('gnome-screenshot returned a non-zero status')
             dlg = Gtk.MessageDialog(transient_for=self,
                                     modal=True,
                                     message_type=Gtk.MessageType.ERROR,
                                     buttons=Gtk.ButtonsType.CLOSE,
                                     text=title,
-                                    secondary_text=secondary)
+                                    secondary_text=str(error))
             dlg.connect('response', lambda d, r: d.destroy())
             dlg.show()
         else:
-            save = KasbahSave(transient_for=self,
+            # Not needed until now, so not imported at startup
+            from .save import KasbahSave
+            save = KasbahSave(capture,
+                              transient_for=self,
                               modal=True,
                               application=self.props.application)
             save.show()
 
     def on_screenshot(self, act, p):
-        parts = [GLib.get_user_cache_dir(), 'kasbah.png']
-        filename = GLib.build_filenamev(parts)
-        args = []
-        if Path('/.flatpak-info').exists():
-            prog = GLib.find_program_in_path('flatpak-spawn')
-            args.extend([prog, '--host', 'gnome-screenshot'])
-        else:
-            prog = GLib.find_program_in_path('gnome-screenshot')
-            args.append(prog)
-        if self.mode == 'Window':
-            args.append('-w')
-            if self.shadow.props.active:
-                args.extend(['-e', 'shadow'])
-        elif self.mode == 'Selection':
-            args.append('-a')
-        if not self.mode == 'Selection':
-            if self.pointer.props.active:
-                args.append('-p')
-            if self.delay.props.value > 0:
-                args.extend(['-d', str(int(self.delay.props.value))])
-        args.extend(['-f', filename])
-        print('Launching ' + ' '.join(args))
-        try:
+        with trace.span('window-hide'):
             self.hide()
-            flags = GLib.SpawnFlags.DO_NOT_REAP_CHILD
-            (pid, sin, sout, serr) = GLib.spawn_async(args, flags=flags)
-            GLib.child_watch_add(GLib.PRIORITY_DEFAULT_IDLE, pid, self.watch)
-        except:
+        timer = trace.begin('capture', mode=self.mode)
+
+        def done(capture, error, elapsed):
+            timer.end(error=str(error))
+            with trace.span('watch'):
+                if self.mode == 'Selection' and error is None:
+                    self.select(capture)
+                else:
+                    self.watch(capture, error, elapsed)
+
+        # Selection is done by our overlay, on a capture of the screen
+        mode = 'Screen' if self.mode == 'Selection' else self.mode
+        # Neither row applies to Selection, they're greyed out for it
+        selecting = self.mode == 'Selection'
+        delay = 0 if selecting else self.delay.props.value
+        pointer = False if selecting else self.pointer.props.active
+        queue = self.props.application.get_queue()
+        monitors = self.monitor_areas() if self.mode == 'Screen' else None
+        # Windows come bare, KasbahSave adds the shadow (it can be
+        # turned off there without taking the shot again)
+        queue.submit(mode, done,
+                     pointer=pointer,
+                     delay=delay,
+                     monitors=monitors,
+                     scheduled=self.count_down)
+
+    def count_down(self, deadline):
+        '''Show the time left until the backend's deadline'''
+        from .countdown import KasbahCountdown
+
+        KasbahCountdown(deadline, application=self.props.application).start()
+
+    def select(self, capture):
+        '''Let the user pick areas of capture, each gets a KasbahSave'''
+        from .overlay import KasbahOverlay, save_all
+
+        app = self.props.application
+
+        def saved(errors):
             self.show()
-            title = _('Screenshot failed')
-            secondary = _('Failed to launch gnome-screenshot')
-            dlg = Gtk.MessageDialog(transient_for=self,
-                                    modal=True,
-                                    message_type=Gtk.MessageType.ERROR,
-                                    buttons=Gtk.ButtonsType.CLOSE,
-                                    text=title,
-                                    secondary_text=secondary)
-            dlg.connect('response', lambda d, r: d.destroy())
-            dlg.show()
+            if errors:
+                self.watch(None, errors[0], 0)
+
+        def selected(crops, all_at_once):
+            if not crops:
+                self.show()
+            elif all_at_once:
+                save_all(app, crops, saved)
+            else:
+                self.show()
+                from .save import KasbahSave
+                for crop in crops:
+                    KasbahSave(crop, transient_for=self,
+                               application=app).show()
+
+        KasbahOverlay(capture, selected, application=app).present()
 
     # We want to set the icons from Gresource,
     # and I can't find a way to set their size in with Glade
     # so we do it manually here.
-    def _fix_icons(self):
-        path = '/org/gnome/Kasbah/'
-        size = 32
-
-        d = GdkPixbuf.Pixbuf.new_from_resource_at_scale(path + 'display-symbolic.svg',
-                                                        size,
-                                                        size,
-                                                        True)
-        w = GdkPixbuf.Pixbuf.new_from_resource_at_scale(path + 'window-symbolic.svg',
-                                                        size,
-                                                        size,
-                                                        True)
-        s = GdkPixbuf.Pixbuf.new_from_resource_at_scale(path + 'selection-symbolic.svg',
-                                                        size,
-                                                        size,
-                                                        True)
-        self.screen_img.set_from_pixbuf(d)
-        self.window_img.set_from_pixbuf(w)
-        self.selection_img.set_from_pixbuf(s)
+    def _fix_icons(self, *args):
+        scale = self.get_scale_factor()
+        for (image, name) in ((self.screen_img, 'display-symbolic.svg'),
+                              (self.window_img, 'window-symbolic.svg'),
+                              (self.selection_img, 'selection-symbolic.svg')):
+            pixbuf = icon_raster(name, 32, scale)
+            surface = Gdk.cairo_surface_create_from_pixbuf(pixbuf, scale, None)
+            image.set_from_surface(surface)
+
+
+def icon_raster(name, size, scale):
+    '''
+        The resource name rendered at size for scale, rasterising SVGs is
+        most of our startup so the result is kept in the cache dir
+    '''
+    path = '/org/gnome/Kasbah/' + name
+    svg = Gio.resources_lookup_data(path, Gio.ResourceLookupFlags.NONE)
+    # Named after the content so a changed icon is rendered again
+    cached = GLib.build_filenamev([GLib.get_user_cache_dir(), 'kasbah',
+                                   'icons', '{:08x}-{}@{}.png'.format(
+                                       svg.hash(), size, scale)])
+    try:
+        return GdkPixbuf.Pixbuf.new_from_file(cached)
+    except GLib.Error:
+        pass
+    pixbuf = GdkPixbuf.Pixbuf.new_from_resource_at_scale(path,
+                                                         size * scale,
+                                                         size * scale,
+                                                         True)
+    try:
+        GLib.mkdir_with_parents(GLib.path_get_dirname(cached), 0o700)
+        pixbuf.savev(cached, 'png', [], [])
+    except GLib.Error as err:
+        warnings.warn('Failed to cache {}: {}'.format(name, err.message))
+    return pixbuf
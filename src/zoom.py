@@ -0,0 +1,311 @@
+# zoom.py
+#
+# Copyright 2018 Zander Brown
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+from gi.repository import Gtk, Gdk, GLib, GdkPixbuf
+import cairo
+
+from . import trace
+
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+import math
+import os
+import threading
+
+# Tiles are this many pixels square at every level
+TILE = 256
+# About 64 MiB of tiles at 4 bytes a pixel
+MAX_TILES = 256
+MAX_ZOOM = 16
+ZOOM_STEP = 1.25
+
+
+class KasbahZoom(Gtk.DrawingArea):
+    '''
+        Zoom (scroll) and pan (drag) around a capture, double click
+        switches between fitting it in and actual size
+
+        The capture is cut into tiles, level 0 being the pixels as they
+        are and each level up half the size of the one below, made from
+        its four tiles there. Only the tiles in view at the level
+        nearest the zoom are asked for, and they're made on workers, so
+        drawing never scales more than a tile's worth. Until a tile is
+        ready the placeholder (a thumbnail) shows through. The least
+        recently drawn tiles go once there are more than MAX_TILES.
+    '''
+
+    __gtype_name__ = 'KasbahZoom'
+
+    def __init__(self, capture, **kwargs):
+        super().__init__(**kwargs)
+        self.capture = capture
+        (self.image_width, self.image_height) = capture.get_size()
+        # None to fit, else screen pixels per capture pixel
+        self.zoom = None
+        # The capture pixel in the middle of the view
+        self.centre = (self.image_width / 2, self.image_height / 2)
+        self.placeholder = None
+        self.drag = None
+
+        # (level, x, y) -> pixbuf, least recently drawn first
+        self.tiles = OrderedDict()
+        self.surfaces = {}
+        self.lock = threading.Lock()
+        self.pending = set()
+        self.wanted = frozenset()
+        self.destroyed = False
+        self.pool = ThreadPoolExecutor(max_workers=os.cpu_count() or 1)
+        longest = max(self.image_width, self.image_height)
+        self.top_level = max(0, math.ceil(math.log2(max(1, longest / TILE))))
+
+        self.set_size_request(640, 400)
+        self.add_events(Gdk.EventMask.BUTTON_PRESS_MASK |
+                        Gdk.EventMask.BUTTON_RELEASE_MASK |
+                        Gdk.EventMask.BUTTON_MOTION_MASK |
+                        Gdk.EventMask.SCROLL_MASK |
+                        Gdk.EventMask.SMOOTH_SCROLL_MASK)
+        self.connect('draw', self.on_draw)
+        self.connect('scroll-event', self.on_scroll)
+        self.connect('button-press-event', self.on_press)
+        self.connect('motion-notify-event', self.on_motion)
+        self.connect('button-release-event', self.on_release)
+        self.connect('destroy', self.on_destroy)
+
+    def set_placeholder(self, pixbuf):
+        '''Something to show, stretched, where tiles aren't ready yet'''
+        self.placeholder = pixbuf
+        self.queue_draw()
+
+    def on_destroy(self, widget):
+        self.destroyed = True
+        # Tiles not started yet would only be thrown away
+        self.pool.shutdown(wait=False, cancel_futures=True)
+
+    def get_scale(self):
+        if self.zoom is not None:
+            return self.zoom
+        return min(1, self.get_allocated_width() / self.image_width,
+                   self.get_allocated_height() / self.image_height)
+
+    def _origin(self, scale):
+        '''Where the capture's top left is drawn, clamped to stay in view'''
+        (view_w, view_h) = (self.get_allocated_width(),
+                            self.get_allocated_height())
+
+        def axis(view, image, centre):
+            size = image * scale
+            if size <= view:
+                return (view - size) / 2
+            return min(0, max(view - size, view / 2 - centre * scale))
+
+        return (axis(view_w, self.image_width, self.centre[0]),
+                axis(view_h, self.image_height, self.centre[1]))
+
+    def _level(self, scale):
+        if scale >= 1:
+            return 0
+        return min(self.top_level, math.floor(math.log2(1 / scale)))
+
+    def on_draw(self, area, cr):
+        with trace.span('zoom-draw'):
+            scale = self.get_scale()
+            (left, top) = self._origin(scale)
+            if self.placeholder is not None:
+                cr.save()
+                cr.translate(left, top)
+                cr.scale(self.image_width * scale /
+                         self.placeholder.props.width,
+                         self.image_height * scale /
+                         self.placeholder.props.height)
+                Gdk.cairo_set_source_pixbuf(cr, self.placeholder, 0, 0)
+                cr.paint()
+                cr.restore()
+
+            level = self._level(scale)
+            # Capture pixels a tile covers, and its size on screen
+            span = TILE << level
+            shown = span * scale
+            x0 = max(0, int(-left / scale) // span)
+            y0 = max(0, int(-top / scale) // span)
+            x1 = min(math.ceil(self.image_width / span),
+                     math.ceil((self.get_allocated_width() - left) / shown))
+            y1 = min(math.ceil(self.image_height / span),
+                     math.ceil((self.get_allocated_height() - top) / shown))
+            visible = [(level, x, y) for y in range(y0, y1)
+                       for x in range(x0, x1)]
+            self.wanted = frozenset(visible)
+            for key in visible:
+                surface = self._surface(key)
+                if surface is None:
+                    self._request(key)
+                    continue
+                cr.save()
+                cr.translate(left + key[1] * shown, top + key[2] * shown)
+                cr.scale(scale * (1 << level), scale * (1 << level))
+                cr.set_source_surface(surface, 0, 0)
+                source = cr.get_source()
+                # No seams where neighbours meet at fractional sizes
+                source.set_extend(cairo.EXTEND_PAD)
+                if scale > 1:
+                    # Zoomed in, show the pixels as they are
+                    source.set_filter(cairo.FILTER_NEAREST)
+                cr.rectangle(0, 0, surface.get_width(), surface.get_height())
+                cr.fill()
+                cr.restore()
+            self._trim()
+        return True
+
+    def _surface(self, key):
+        with self.lock:
+            pixbuf = self.tiles.get(key)
+            if pixbuf is None:
+                return None
+            self.tiles.move_to_end(key)
+        surface = self.surfaces.get(key)
+        if surface is None:
+            surface = Gdk.cairo_surface_create_from_pixbuf(pixbuf, 1, None)
+            self.surfaces[key] = surface
+        return surface
+
+    def _trim(self):
+        with self.lock:
+            while len(self.tiles) > MAX_TILES:
+                key = next(iter(self.tiles))
+                if key in self.wanted:
+                    # Everything left is in view
+                    break
+                del self.tiles[key]
+                self.surfaces.pop(key, None)
+
+    def _request(self, key):
+        if key in self.pending or self.destroyed:
+            return
+        self.pending.add(key)
+        self.pool.submit(self._make, key)
+
+    def _make(self, key):
+        '''In a worker, the tile for key if it's still in view'''
+        if key in self.wanted and not self.destroyed:
+            with trace.span('zoom-tile', level=key[0]):
+                tile = self._tile(key)
+            with self.lock:
+                self.tiles[key] = tile
+        GLib.idle_add(self._made, key)
+
+    def _made(self, key):
+        if self.destroyed:
+            return GLib.SOURCE_REMOVE
+        self.pending.discard(key)
+        if key in self.wanted:
+            self.queue_draw()
+        return GLib.SOURCE_REMOVE
+
+    def _tile(self, key, child=False):
+        '''
+            Make the tile for key from the level below, using tiles
+            already made where there are any. The ones made on the way
+            aren't kept, so a zoomed out view of a huge capture never
+            holds more than it shows.
+        '''
+        with self.lock:
+            tile = self.tiles.get(key)
+        if tile is not None:
+            return tile
+        (level, x, y) = key
+        span = TILE << level
+        # Edge tiles are short
+        width = math.ceil(min(span, self.image_width - x * span) /
+                          (1 << level))
+        height = math.ceil(min(span, self.image_height - y * span) /
+                           (1 << level))
+        if level == 0:
+            tile = self.capture.pixbuf.new_subpixbuf(x * TILE, y * TILE,
+                                                     width, height)
+            # A copy to keep, so the tile doesn't hold the full image
+            return tile if child else tile.copy()
+        half = TILE // 2
+        children = []
+        for (dx, dy) in ((0, 0), (1, 0), (0, 1), (1, 1)):
+            if dx * half < width and dy * half < height:
+                children.append((dx * half, dy * half, self._tile(
+                    (level - 1, x * 2 + dx, y * 2 + dy), True)))
+        tile = GdkPixbuf.Pixbuf.new(GdkPixbuf.Colorspace.RGB,
+                                    children[0][2].props.has_alpha, 8,
+                                    width, height)
+        for (into_x, into_y, source) in children:
+            into_w = min(width - into_x, math.ceil(source.props.width / 2))
+            into_h = min(height - into_y, math.ceil(source.props.height / 2))
+            source.scale(tile, into_x, into_y, into_w, into_h,
+                         into_x, into_y, 0.5, 0.5,
+                         GdkPixbuf.InterpType.BILINEAR)
+        return tile
+
+    def zoom_at(self, zoom, x, y):
+        '''Zoom to zoom keeping the capture pixel under (x, y) there'''
+        scale = self.get_scale()
+        (left, top) = self._origin(scale)
+        point = ((x - left) / scale, (y - top) / scale)
+        fit = min(1, self.get_allocated_width() / self.image_width,
+                  self.get_allocated_height() / self.image_height)
+        zoom = min(MAX_ZOOM, zoom)
+        if zoom <= fit:
+            self.zoom = None
+            self.centre = (self.image_width / 2, self.image_height / 2)
+        else:
+            self.zoom = zoom
+            # The point goes where the pointer is
+            view = (self.get_allocated_width(), self.get_allocated_height())
+            self.centre = (point[0] + (view[0] / 2 - x) / zoom,
+                           point[1] + (view[1] / 2 - y) / zoom)
+        self.queue_draw()
+
+    def on_scroll(self, area, event):
+        (ok, dx, dy) = event.get_scroll_deltas()
+        if not ok:
+            dy = {Gdk.ScrollDirection.UP: -1,
+                  Gdk.ScrollDirection.DOWN: 1}.get(event.direction, 0)
+        if dy:
+            self.zoom_at(self.get_scale() * ZOOM_STEP ** -dy,
+                         event.x, event.y)
+        return True
+
+    def on_press(self, area, event):
+        if event.button != Gdk.BUTTON_PRIMARY:
+            return False
+        if event.type == Gdk.EventType._2BUTTON_PRESS:
+            self.zoom_at(1 if self.zoom is None else 0, event.x, event.y)
+        else:
+            self.drag = (event.x, event.y, self.centre)
+        return True
+
+    def on_motion(self, area, event):
+        if self.drag is None:
+            return False
+        (x, y, (cx, cy)) = self.drag
+        scale = self.get_scale()
+        self.centre = (cx - (event.x - x) / scale, cy - (event.y - y) / scale)
+        # Where the view stopped at the edges, so turning back is instant
+        (left, top) = self._origin(scale)
+        self.centre = ((self.get_allocated_width() / 2 - left) / scale,
+                       (self.get_allocated_height() / 2 - top) / scale)
+        self.queue_draw()
+        return True
+
+    def on_release(self, area, event):
+        self.drag = None
+        return True
@@ -0,0 +1,68 @@
+# common.py
+#
+# Copyright 2018 Zander Brown
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+# Loads src as the kasbah package, like it is once installed, so the
+# tests run straight from a checkout with:
+#
+#     python3 -m unittest discover -s tests
+
+import gettext
+import importlib.util
+import os
+import sys
+
+gettext.install('kasbah')
+
+import gi
+
+gi.require_version('Gtk', '3.0')
+
+SRC = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                   os.pardir, 'src')
+
+if 'kasbah' not in sys.modules:
+    spec = importlib.util.spec_from_file_location(
+        'kasbah', os.path.join(SRC, '__init__.py'),
+        submodule_search_locations=[SRC])
+    sys.modules['kasbah'] = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(sys.modules['kasbah'])
+
+from gi.repository import GLib, GdkPixbuf
+
+
+def solid(width, height, rgba=0x3465a4ff, has_alpha=False):
+    '''A new pixbuf filled with rgba'''
+    pixbuf = GdkPixbuf.Pixbuf.new(GdkPixbuf.Colorspace.RGB, has_alpha, 8,
+                                  width, height)
+    pixbuf.fill(rgba)
+    return pixbuf
+
+
+def run(loop, timeout=10):
+    '''Run loop until something quits it, failing after timeout seconds'''
+    expired = []
+
+    def expire():
+        expired.append(True)
+        loop.quit()
+        return GLib.SOURCE_REMOVE
+
+    source = GLib.timeout_add_seconds(timeout, expire)
+    loop.run()
+    if expired:
+        raise AssertionError('Timed out waiting for the main loop')
+    GLib.source_remove(source)
@@ -0,0 +1,69 @@
+# test_dedup.py
+#
+# Copyright 2018 Zander Brown
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+import common
+
+from kasbah import dedup
+
+import random
+import unittest
+
+
+class NearestTest(unittest.TestCase):
+    def test_empty(self):
+        self.assertEqual(dedup.nearest(0, []), (None, None))
+
+    def test_exact(self):
+        hashes = [0x0f0f, 0xf0f0, 0xffff]
+        self.assertEqual(dedup.nearest(0xf0f0, hashes), (1, 0))
+
+    def test_closest(self):
+        hashes = [0b1111, 0b0111, 0b0000]
+        self.assertEqual(dedup.nearest(0b0011, hashes), (1, 1))
+
+    def test_many(self):
+        # Enough to take the NumPy path, when it's there
+        rng = random.Random(4)
+        hashes = [rng.getrandbits(64) for i in range(500)]
+        target = hashes[321] ^ 0b101
+        self.assertEqual(dedup.nearest(target, hashes), (321, 2))
+
+    def test_many_agrees(self):
+        rng = random.Random(9)
+        hashes = [rng.getrandbits(64) for i in range(200)]
+        target = rng.getrandbits(64)
+        (index, bits) = dedup.nearest(target, hashes)
+        self.assertEqual(bits, dedup.distance(target, hashes[index]))
+        self.assertEqual(bits, min(dedup.distance(target, h)
+                                   for h in hashes))
+
+
+class DhashTest(unittest.TestCase):
+    def test_flat(self):
+        # No column is brighter than the one before it
+        self.assertEqual(dedup.dhash(common.solid(64, 64)), 0)
+
+    def test_small_change(self):
+        pixbuf = common.solid(640, 480)
+        before = dedup.dhash(pixbuf)
+        pixbuf.new_subpixbuf(10, 10, 4, 4).fill(0xffffffff)
+        self.assertLessEqual(dedup.distance(before, dedup.dhash(pixbuf)), 2)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,102 @@
+# test_delay.py
+#
+# Copyright 2018 Zander Brown
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+import common
+
+from kasbah.backend import FakeBackend
+
+from gi.repository import GLib
+
+import unittest
+
+# How late a grab may start. The spin gets well under a millisecond,
+# this leaves room for a busy machine descheduling us.
+TOLERANCE = 0.05
+
+
+class DelayTest(unittest.TestCase):
+    def shoot(self, backend, delay, mode='Screen'):
+        '''(capture, error, deadlines) of one delayed capture'''
+        loop = GLib.MainLoop()
+        results = []
+        deadlines = []
+
+        def done(capture, error, elapsed):
+            results.append((capture, error))
+            loop.quit()
+
+        backend.capture(mode, done, delay=delay,
+                        scheduled=deadlines.append)
+        common.run(loop)
+        return results[0] + (deadlines,)
+
+    def test_on_time(self):
+        backend = FakeBackend(64, 48)
+        for delay in (0.05, 0.1, 0.25):
+            with self.subTest(delay=delay):
+                (capture, error, deadlines) = self.shoot(backend, delay)
+                self.assertIsNone(error)
+                self.assertIsNotNone(capture)
+                self.assertGreaterEqual(backend.lateness, 0)
+                self.assertLess(backend.lateness, TOLERANCE)
+
+    def test_busy_loop(self):
+        # Other work on the main loop mustn't hold the grab up
+        backend = FakeBackend(64, 48)
+
+        def busy():
+            until = GLib.get_monotonic_time() + 1000
+            while GLib.get_monotonic_time() < until:
+                pass
+            return GLib.SOURCE_CONTINUE
+
+        source = GLib.idle_add(busy)
+        try:
+            (capture, error, deadlines) = self.shoot(backend, 0.1)
+        finally:
+            GLib.source_remove(source)
+        self.assertIsNone(error)
+        self.assertGreaterEqual(backend.lateness, 0)
+        self.assertLess(backend.lateness, TOLERANCE)
+
+    def test_scheduled(self):
+        backend = FakeBackend(64, 48)
+        before = GLib.get_monotonic_time()
+        (capture, error, deadlines) = self.shoot(backend, 0.1)
+        self.assertEqual(len(deadlines), 1)
+        self.assertGreaterEqual(deadlines[0] - before,
+                                0.1 * GLib.USEC_PER_SEC)
+
+    def test_selection(self):
+        # Selections wait for the user, so a delay is ignored
+        backend = FakeBackend(64, 48)
+        (capture, error, deadlines) = self.shoot(backend, 0.1, 'Selection')
+        self.assertIsNone(error)
+        self.assertIsNotNone(capture)
+        self.assertEqual(deadlines, [])
+
+    def test_no_delay(self):
+        backend = FakeBackend(64, 48)
+        (capture, error, deadlines) = self.shoot(backend, 0)
+        self.assertIsNotNone(capture)
+        # Nothing to count down
+        self.assertEqual(deadlines, [])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,100 @@
+# test_edit.py
+#
+# Copyright 2018 Zander Brown
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+import common
+
+from kasbah.pixels import as_array, numpy
+from kasbah import edit
+
+from concurrent.futures import ThreadPoolExecutor
+
+import unittest
+
+
+@unittest.skipIf(numpy is None, 'Editing needs NumPy')
+class OperationTest(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.pool = ThreadPoolExecutor(max_workers=2)
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.pool.shutdown()
+
+    def stripes(self, height=600, width=80):
+        '''Black and white columns, worst case for a blur'''
+        array = numpy.zeros((height, width, 3), dtype=numpy.uint8)
+        array[:, ::2] = 255
+        return array
+
+    def test_area(self):
+        operation = edit.Fill((50, 40), (10, 20))
+        self.assertEqual(operation.area(1, (100, 100, 3)), (10, 20, 40, 20))
+        self.assertEqual(operation.area(0.5, (100, 100, 3)), (5, 10, 20, 10))
+        # Clipped to the array
+        self.assertEqual(operation.area(1, (30, 30, 3), 5), (5, 15, 25, 15))
+
+    def test_fill(self):
+        array = self.stripes()
+        edit.Fill((10, 10), (20, 30), (1, 2, 3)).apply(array, 1, self.pool)
+        self.assertTrue((array[10:30, 10:20] == (1, 2, 3)).all())
+        # The stripes either side are left alone
+        self.assertEqual(array[9, 10, 0], 255)
+        self.assertEqual(array[10, 9, 0], 0)
+
+    def test_blur_bands(self):
+        # Taller than a band, so the rows where bands meet are checked
+        array = self.stripes(edit.BAND * 2 + 30)
+        untouched = array.copy()
+        edit.Blur((0, 0), (80, array.shape[0]), 3).apply(array, 1, self.pool)
+        # Seven columns, three or four of them white
+        inside = array[:, 10:70]
+        self.assertTrue(((inside >= 109) & (inside <= 146)).all())
+        # The same in every row, band edges included
+        self.assertTrue((array == array[:1]).all())
+        self.assertFalse((array == untouched).all())
+
+    def test_pixelate(self):
+        array = self.stripes(100, 64)
+        edit.Pixelate((0, 0), (64, 100), 16).apply(array, 1, self.pool)
+        # Half white in every block, short last row of blocks included
+        self.assertTrue((array == 127).all())
+
+    def test_outside(self):
+        array = self.stripes()
+        untouched = array.copy()
+        edit.Blur((200, 200), (300, 300)).apply(array, 1, self.pool)
+        self.assertTrue((array == untouched).all())
+
+    def test_render_undo(self):
+        edits = edit.EditList()
+        pixbuf = common.solid(80, 60, 0xffffffff)
+        edits.add(edit.Fill((0, 0), (10, 10)))
+        edits.add(edit.Fill((0, 0), (80, 60), (9, 9, 9)))
+        edits.undo()
+        rendered = as_array(edits.render(pixbuf))
+        self.assertTrue((rendered[:10, :10] == 0).all())
+        self.assertTrue((rendered[10:] == 255).all())
+        self.assertTrue((rendered[:, 10:] == 255).all())
+        # The pixbuf itself is left alone
+        self.assertTrue((as_array(pixbuf) == 255).all())
+        edits.shutdown()
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,72 @@
+# test_encoder.py
+#
+# Copyright 2018 Zander Brown
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+import common
+
+from kasbah import encoder
+
+import os
+import unittest
+import zlib
+
+
+class DeflateTest(unittest.TestCase):
+    def check(self, raw, level=6):
+        self.assertEqual(zlib.decompress(encoder.deflate(raw, level)), raw)
+
+    def test_empty(self):
+        self.check(b'')
+
+    def test_one_band(self):
+        self.check(b'kasbah' * 1000)
+
+    def test_many_bands(self):
+        # Repeats across band edges, so the primed dictionary is used
+        self.check(os.urandom(4096) * (3 * encoder.BAND_SIZE // 4096 + 7))
+
+    def test_exact_bands(self):
+        self.check(bytes(2 * encoder.BAND_SIZE))
+
+    def test_levels(self):
+        raw = os.urandom(1024) * 2048
+        for level in (0, 1, 6, 9):
+            with self.subTest(level=level):
+                self.check(raw, level)
+
+    def test_header(self):
+        # zlib's own check, the header must be a multiple of 31
+        header = encoder.deflate(b'kasbah')[:2]
+        self.assertEqual(int.from_bytes(header, 'big') % 31, 0)
+
+
+class PngTest(unittest.TestCase):
+    def test_round_trip(self):
+        pixbuf = common.solid(300, 200, 0x3465a480, has_alpha=True)
+        data = encoder.encode(pixbuf, 'png')
+        self.assertTrue(data.startswith(encoder.PNG_SIGNATURE))
+        loader = common.GdkPixbuf.PixbufLoader()
+        loader.write(data)
+        loader.close()
+        decoded = loader.get_pixbuf()
+        self.assertEqual((decoded.props.width, decoded.props.height),
+                         (300, 200))
+        self.assertEqual(decoded.get_pixels(), pixbuf.get_pixels())
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,107 @@
+# test_jobs.py
+#
+# Copyright 2018 Zander Brown
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+import common
+
+from kasbah.backend import CaptureError, FakeBackend
+from kasbah.jobs import CaptureQueue
+
+from gi.repository import GLib
+
+import unittest
+
+
+class Settings(object):
+    '''Just what CaptureQueue reads from Gio.Settings'''
+
+    def __init__(self, **values):
+        self.values = values
+
+    def get_int(self, key):
+        return self.values[key]
+
+    def get_string(self, key):
+        return self.values[key]
+
+
+class CaptureQueueTest(unittest.TestCase):
+    def queue(self, limit, depth):
+        settings = Settings(backend='fake', **{
+            'max-concurrent-captures': limit,
+            'queue-depth': depth,
+        })
+        queue = CaptureQueue(settings)
+        queue.backend = FakeBackend(64, 48)
+        return queue
+
+    def shoot(self, queue, count):
+        '''Submit count captures, the results once they're all back'''
+        loop = GLib.MainLoop()
+        results = []
+        # Every value running takes on the way
+        running = []
+        queue.connect('notify::running',
+                      lambda q, p: running.append(q.props.running))
+
+        def done(n, capture, error, elapsed):
+            results.append((n, capture, error))
+            if len(results) == count:
+                loop.quit()
+
+        accepted = [queue.submit('Screen',
+                                 lambda c, e, t, n=n: done(n, c, e, t))
+                    for n in range(count)]
+        if len(results) < count:
+            common.run(loop)
+        return (accepted, results, running)
+
+    def test_within_limit(self):
+        queue = self.queue(2, 0)
+        (accepted, results, running) = self.shoot(queue, 2)
+        self.assertEqual(accepted, [True, True])
+        self.assertTrue(all(c is not None for (n, c, e) in results))
+        self.assertEqual(queue.props.running, 0)
+
+    def test_waits_its_turn(self):
+        queue = self.queue(1, 2)
+        (accepted, results, running) = self.shoot(queue, 3)
+        self.assertEqual(accepted, [True, True, True])
+        # One at a time, in order
+        self.assertEqual([n for (n, c, e) in results], [0, 1, 2])
+        self.assertEqual(max(running), 1)
+        self.assertEqual(running[-1], 0)
+
+    def test_refused(self):
+        queue = self.queue(1, 1)
+        (accepted, results, running) = self.shoot(queue, 3)
+        self.assertEqual(accepted, [True, True, False])
+        # Refused straight away, before the others finish
+        (n, capture, error) = results[0]
+        self.assertEqual((n, capture), (2, None))
+        self.assertIsInstance(error, CaptureError)
+        self.assertTrue(all(c is not None for (n, c, e) in results[1:]))
+
+    def test_no_depth(self):
+        # A free slot still takes the job with nowhere to wait
+        queue = self.queue(1, 0)
+        (accepted, results, running) = self.shoot(queue, 2)
+        self.assertEqual(accepted, [True, False])
+
+
+if __name__ == '__main__':
+    unittest.main()
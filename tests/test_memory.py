@@ -0,0 +1,134 @@
+# test_memory.py
+#
+# Copyright 2018 Zander Brown
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+import common
+
+from kasbah.capture import Capture
+from kasbah.encoder import encode
+from kasbah.memory import PixelStore
+
+from gi.repository import GLib
+
+import unittest
+from unittest import mock
+
+COLOURS = (0x3465a4ff, 0xf6f5f4ff, 0x2e3436ff, 0xcc0000ff)
+
+
+class PixelStoreTest(unittest.TestCase):
+    def setUp(self):
+        self.pixbufs = [common.solid(100, 80, rgba) for rgba in COLOURS]
+        self.length = self.pixbufs[0].get_byte_length()
+        # Room for two and a half
+        self.store = PixelStore(self.length * 5 // 2)
+
+    def grabbed(self, n):
+        '''A capture that can't be decoded again, so has to spill'''
+        capture = Capture(pixbuf=self.pixbufs[n].copy())
+        self.store.add(capture)
+        return capture
+
+    def assertPixels(self, capture, n):
+        self.assertEqual(capture.pixbuf.get_pixels(),
+                         self.pixbufs[n].get_pixels())
+
+    def test_under_budget(self):
+        captures = [self.grabbed(n) for n in range(2)]
+        self.assertTrue(all(c._pixbuf is not None for c in captures))
+        stats = self.store.stats()
+        self.assertEqual((stats.resident, stats.spilled, stats.evictions),
+                         (2 * self.length, 0, 0))
+
+    def test_least_recently_used(self):
+        (a, b, c) = [self.grabbed(n) for n in range(3)]
+        self.assertIsNone(a._pixbuf)
+        self.assertIsNotNone(b._pixbuf)
+        # a comes back, and b is now the one used longest ago
+        self.assertPixels(a, 0)
+        self.assertIsNone(b._pixbuf)
+        self.assertIsNotNone(c._pixbuf)
+        stats = self.store.stats()
+        self.assertEqual((stats.evictions, stats.reloads), (2, 1))
+        self.assertEqual(stats.resident, 2 * self.length)
+        # Flat colour, compressed to next to nothing
+        self.assertGreater(stats.spilled, 0)
+        self.assertLess(stats.spilled, self.length // 10)
+
+    def test_round_trip(self):
+        captures = [self.grabbed(n) for n in range(len(COLOURS))]
+        for n in reversed(range(len(COLOURS))):
+            self.assertPixels(captures[n], n)
+        for (n, capture) in enumerate(captures):
+            self.assertPixels(capture, n)
+        stats = self.store.stats()
+        self.assertGreater(stats.reloads, 0)
+        self.assertGreaterEqual(stats.reload_time, 0)
+        self.assertEqual(stats.evictions,
+                         stats.reloads + len(COLOURS) - 2)
+
+    def test_nothing_left(self):
+        captures = [self.grabbed(n) for n in range(3)]
+        self.assertPixels(captures[0], 0)
+        self.assertPixels(captures[1], 1)
+        self.store.remove(captures[2])
+        self.assertEqual(self.store.stats().spilled, 0)
+
+    def test_spill_fails(self):
+        (a, b) = [self.grabbed(n) for n in range(2)]
+        with mock.patch('zlib.compress', side_effect=MemoryError):
+            with self.assertWarns(UserWarning):
+                c = self.grabbed(2)
+        # Kept as it was rather than lost, and still counted
+        self.assertIsNotNone(a._pixbuf)
+        self.assertPixels(c, 2)
+        stats = self.store.stats()
+        self.assertEqual((stats.resident, stats.spilled, stats.evictions),
+                         (3 * self.length, 0, 0))
+
+    def test_encoded(self):
+        data = GLib.Bytes.new(encode(self.pixbufs[0], 'png'))
+        encoded = Capture(data=data)
+        self.store.add(encoded)
+        self.assertPixels(encoded, 0)
+        for n in range(1, 3):
+            self.grabbed(n)
+        # Decoded again when it's wanted, not spilled
+        self.assertIsNone(encoded._pixbuf)
+        self.assertEqual(self.store.stats().spilled, 0)
+        self.assertPixels(encoded, 0)
+        self.assertEqual(self.store.stats().reloads, 0)
+
+    def test_remove_keeps_pixels(self):
+        (a, b, c) = [self.grabbed(n) for n in range(3)]
+        # Somebody else may still have a, it mustn't lose its pixels
+        self.store.remove(a)
+        self.assertIsNone(a.store)
+        self.assertPixels(a, 0)
+        self.assertEqual(self.store.stats().spilled, 0)
+
+    def test_set_budget(self):
+        captures = [self.grabbed(n) for n in range(2)]
+        self.store.set_budget(0)
+        # The most recently used is always kept
+        self.assertIsNone(captures[0]._pixbuf)
+        self.assertIsNotNone(captures[1]._pixbuf)
+        self.assertEqual(self.store.stats().resident, self.length)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,93 @@
+# test_tiles.py
+#
+# Copyright 2018 Zander Brown
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+import common
+
+from kasbah.pixels import as_array, numpy
+from kasbah import tiles
+
+import json
+import os
+import tempfile
+import unittest
+
+
+@unittest.skipIf(numpy is None, 'Tile storage needs NumPy')
+class TileStoreTest(unittest.TestCase):
+    def setUp(self):
+        self.folder = tempfile.TemporaryDirectory()
+        self.store = tiles.TileStore(self.folder.name)
+        # Short tiles along the right and bottom edges
+        self.pixbuf = common.solid(tiles.TILE_SIZE * 3 + 10,
+                                   tiles.TILE_SIZE * 2 + 5)
+
+    def tearDown(self):
+        self.folder.cleanup()
+
+    def manifest(self, name):
+        return os.path.join(self.folder.name, name)
+
+    def test_first_write(self):
+        (changed, total, written) = self.store.write(
+            self.pixbuf, self.manifest('a.tiles'))
+        self.assertEqual((changed, total), (12, 12))
+        self.assertGreater(written, 0)
+
+    def test_unchanged(self):
+        self.store.write(self.pixbuf, self.manifest('a.tiles'))
+        (changed, total, written) = self.store.write(
+            self.pixbuf.copy(), self.manifest('b.tiles'))
+        self.assertEqual((changed, total), (0, 12))
+        with open(self.manifest('b.tiles')) as source:
+            self.assertEqual(written, len(source.read().encode()))
+
+    def test_changed_tiles(self):
+        self.store.write(self.pixbuf, self.manifest('a.tiles'))
+        after = self.pixbuf.copy()
+        # Straddles the first two tiles of the second row
+        after.new_subpixbuf(tiles.TILE_SIZE - 2, tiles.TILE_SIZE + 3,
+                            4, 4).fill(0xffffffff)
+        changed = self.store._changed(as_array(after), 'default')
+        self.assertEqual(changed.shape, (3, 4))
+        self.assertEqual([tuple(i) for i in numpy.argwhere(changed)],
+                         [(1, 0), (1, 1)])
+        (count, total, written) = self.store.write(
+            after, self.manifest('b.tiles'))
+        self.assertEqual(count, 2)
+
+    def test_outputs_apart(self):
+        self.store.write(self.pixbuf, self.manifest('a.tiles'), 'left')
+        (changed, total, written) = self.store.write(
+            self.pixbuf, self.manifest('b.tiles'), 'right')
+        self.assertEqual(changed, total)
+
+    def test_rebuild(self):
+        after = self.pixbuf.copy()
+        after.new_subpixbuf(5, 70, 100, 20).fill(0x2e3436ff)
+        self.store.write(self.pixbuf, self.manifest('a.tiles'))
+        self.store.write(after, self.manifest('b.tiles'), shot=2)
+        with open(self.manifest('b.tiles')) as source:
+            self.assertEqual(json.load(source)['shot'], 2)
+        for (pixbuf, name) in ((self.pixbuf, 'a.tiles'), (after, 'b.tiles')):
+            rebuilt = self.store.rebuild(self.manifest(name))
+            self.assertTrue(numpy.array_equal(as_array(rebuilt),
+                                              as_array(pixbuf)))
+
+
+if __name__ == '__main__':
+    unittest.main()